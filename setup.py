@@ -28,13 +28,35 @@ setup(
                         "zope.app.http",
                         "zope.schema",
                         "zope.app.publication",
+                        "zope.lifecycleevent",
+                        "zope.annotation",
+                        "zope.container",
+                        "zope.dublincore",
+                        "zope.datetime",
+                        "pytz",
+                        "zope.traversing",
+                        "zope.browserpage",
+                        "ZODB",
+                        "zope.security",
+                        "zope.configuration",
+                        "zope.authentication",
+                        "zope.browserresource",
+                        "transaction",
                         ],
 
     extras_require = dict(
         test = ["zope.securitypolicy",
                 "zope.app.wsgi",
+                "zope.testbrowser",
                 ]),
 
+    entry_points = """
+    [console_scripts]
+    conditionalviews-benchmark = z3c.conditionalviews.benchmark:main
+    conditionalviews-loadtest = z3c.conditionalviews.loadtest:main
+    conditionalviews-replay = z3c.conditionalviews.replay:main
+    """,
+
     include_package_data = True,
     zip_safe = False,
     )
@@ -10,6 +10,9 @@
 # FOR A PARTICULAR PURPOSE.
 ##############################################################################
 
+import time
+
+import transaction
 import zope.component
 import zope.publisher.http
 import zope.publisher.publish
@@ -18,37 +21,141 @@ import zope.app.http.interfaces
 import zope.app.publication.http
 import zope.app.publication.interfaces
 
+import cas
+import dispatch
 import interfaces
+import readonly
+import utils
 
-def validate(context, request, func, viewobj, *args, **kw):
+def registeredValidators(view = None):
+    """
+    Return the (name, validator) pairs of the validators of the view, as
+    configured by the `conditional:view` directive, or of all the registered
+    validators.
+    """
+    entry = dispatch.lookup(view)
+    if entry is not None and entry.validators is not None:
+        return entry.validators
+    return zope.component.getUtilitiesFor(interfaces.IHTTPValidator)
+
+
+def getValidators(view = None):
+    return [validator
+            for validator_name, validator in registeredValidators(view)]
+
+
+def getMeasuredValidators(metrics, view = None):
+    return metrics.instrument(registeredValidators(view))
+
+
+def invalidStatus(context, request, view, validators):
+    """
+    Return the status of the response to an invalid request, or None if the
+    request is valid according to `validators`.
+    """
     # count the number of invalid and evaulated validators, if evaluated is
     # greater then zero and equal to hte invalid count then the request is
     # invalid.
     evaluated = invalid = 0
 
-    validators = [validator
-                  for validator_name, validator in
-                  zope.component.getUtilitiesFor(interfaces.IHTTPValidator)]
-
-    invalidStatus = 999
+    status = 999
     for validator in validators:
-        if validator.evaluate(context, request, viewobj):
+        if validator.evaluate(context, request, view):
             evaluated += 1
-            if not validator.valid(context, request, viewobj):
+            if not validator.valid(context, request, view):
                 invalid += 1
-                invalidStatus = validator.invalidStatus(
-                    context, request, viewobj)
+                status = validator.invalidStatus(context, request, view)
 
     if evaluated > 0 and evaluated == invalid:
+        return status
+    return None
+
+
+class NullTrace(object):
+    """
+    Used when a request is not traced.
+    """
+
+    def span(self, name, **attributes):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_TRACE = NullTrace()
+
+
+def validate(context, request, func, viewobj, *args, **kw):
+    tracer = zope.component.queryUtility(interfaces.IValidationTracer)
+    trace = tracer is not None and tracer.start(request, viewobj) or None
+    if trace is None:
+        return _validate(NULL_TRACE, context, request, func, viewobj,
+                         *args, **kw)
+
+    request.annotations[utils.TRACE_KEY] = trace
+    try:
+        return trace.run(_validate, trace, context, request, func, viewobj,
+                         *args, **kw)
+    finally:
+        del request.annotations[utils.TRACE_KEY]
+        trace.finish()
+
+
+def _validate(trace, context, request, func, viewobj, *args, **kw):
+    with trace.span("lookup"):
+        metrics = zope.component.queryUtility(interfaces.IValidationMetrics)
+        if metrics is not None:
+            validators = getMeasuredValidators(metrics, viewobj)
+        else:
+            validators = getValidators(viewobj)
+        fetcher = zope.component.queryUtility(
+            interfaces.IValidatorDataFetcher)
+
+    if fetcher is not None:
+        with trace.span("fetch"):
+            validators = fetcher.fetch(context, request, viewobj, validators)
+
+    with trace.span("decision"):
+        status = invalidStatus(context, request, viewobj, validators)
+
+    if status is not None:
         # The request is invalid so we do not process it.
-        request.response.setStatus(invalidStatus)
+        request.response.setStatus(status)
         result = ""
+        rendertime = None
     else:
-        # The request is valid so we do process it.
-        result = func(viewobj, *args, **kw)
+        # The request is valid so we do process it, unless a response filter
+        # has already got a result for this request.
+        result = rendertime = None
+        for filter_name, responsefilter in sorted(
+                zope.component.getUtilitiesFor(
+                    interfaces.ICachingResponseFilter)):
+            with trace.span("cache", filter = filter_name):
+                result = responsefilter.lookup(context, request, viewobj)
+            if result is not None:
+                break
+        if result is None:
+            with trace.span("render"):
+                start = time.time()
+                result = func(viewobj, *args, **kw)
+                rendertime = time.time() - start
+            if request.method not in ("GET", "HEAD"):
+                # The view can have changed the validator data.
+                request.annotations.pop(utils.DATA_KEY, None)
 
-    for validator in validators:
-        validator.updateResponse(context, request, viewobj)
+    with trace.span("update"):
+        for validator in validators:
+            validator.updateResponse(context, request, viewobj)
+
+        for filter_name, responsefilter in sorted(
+                zope.component.getUtilitiesFor(interfaces.IResponseFilter)):
+            result = responsefilter.filter(context, request, viewobj, result)
+
+    if metrics is not None:
+        metrics.record(viewobj, status, rendertime, result)
 
     return result
 
@@ -88,20 +195,41 @@ class ConditionalHTTPRequest(zope.publisher.http.HTTPRequest):
     zope.interface.classProvides(
         zope.app.publication.interfaces.IHTTPRequestFactory)
 
+    readonly = False
+
     def setPublication(self, publication):
         super(ConditionalHTTPRequest, self).setPublication(
-            ConditionalPublication(publication))
+            ConditionalPublication(publication, self.readonly))
+
+
+class ReadOnlyConditionalHTTPRequest(ConditionalHTTPRequest):
+    """
+    Conditional request whose transaction is aborted instead of committed
+    when it ends as a `304 Not Modified` or `412 Precondition Failed`, or
+    when a safe method changed nothing, see `readonly.py`.
+    """
+
+    readonly = True
 
 
 class ConditionalPublication(object):
 
-    def __init__(self, publication):
+    def __init__(self, publication, readonly = False):
         self._publication = publication
+        self.readonly = readonly
         for name in zope.publisher.interfaces.IPublication:
-            if name not in ("callObject",):
+            if name not in ("beforeTraversal", "callObject", "afterCall"):
                 setattr(self, name, getattr(publication, name))
 
+    def beforeTraversal(self, request):
+        # Before the content of the request is read.
+        utils.recordGeneration(request)
+        self._publication.beforeTraversal(request)
+
     def callObject(self, request, ob):
+        # Writes validated by an If-Match header fail to commit with a
+        # PreconditionFailed error, instead of a conflict error.
+        cas.enable(request)
         # Exception handling, dont try to call request.method
         if not zope.app.http.interfaces.IHTTPException.providedBy(ob):
             view = zope.component.queryMultiAdapter(
@@ -114,3 +242,25 @@ class ConditionalPublication(object):
 
         return zope.publisher.publish.mapply(
             ob, request.getPositionalArguments(), request)
+
+    def afterCall(self, request, ob):
+        if self.readonly and readonly.readOnly(request):
+            # Nothing to commit, the publication aborts doomed transactions.
+            transaction.get().doom()
+            metrics = zope.component.queryUtility(
+                interfaces.IValidationMetrics)
+            if metrics is not None:
+                metrics.count("commits_avoided")
+        try:
+            self._publication.afterCall(request, ob)
+        except cas.PreconditionFailed:
+            # The content changed since the request validated it, so the
+            # request would only fail the If-Match header when retried.
+            transaction.abort()
+            request.response.reset()
+            request.response.setStatus(412)
+            request.response.setResult("")
+            metrics = zope.component.queryUtility(
+                interfaces.IValidationMetrics)
+            if metrics is not None:
+                metrics.count("retries_avoided")
@@ -10,10 +10,17 @@
 # FOR A PARTICULAR PURPOSE.
 ##############################################################################
 
+import calendar
+import datetime
+
+import pytz
 import zope.interface
 import zope.dublincore.interfaces
 
 import interfaces
+import utils
+
+SYNTHESIZED_KEY = "z3c.conditionalviews.synthesized"
 
 class LastModificationDate(object):
     """
@@ -67,3 +74,155 @@ class LastModificationDate(object):
     @property
     def lastmodified(self):
         return self.dcadapter.modified
+
+###############################################################################
+#
+# Validator data synthesized from the other validator data of a view, see
+# synthesized.zcml.
+#
+###############################################################################
+
+_marker = object()
+
+def _synthesize(context, request, view, iface, func):
+    # Computed once per request. While it is computed, the other synthesized
+    # validator data is not, which would only look this data up again.
+    annotations = getattr(request, "annotations", None)
+    if annotations is None:
+        return func()
+    synthesized = annotations.setdefault(SYNTHESIZED_KEY, {})
+    key = utils.validatorDataKey(context, view, iface)
+    value = synthesized.get(key, _marker)
+    if value is _marker:
+        synthesized[key] = None
+        try:
+            value = func()
+        finally:
+            del synthesized[key]
+        synthesized[key] = value
+    return value
+
+
+class SynthesizedETag(object):
+    """
+    A weak entity tag computed from the last modification date of a view,
+    and the identity of the content.
+
+      >>> import zope.component
+      >>> from zope.publisher.browser import TestRequest
+      >>> from zope.interface.verify import verifyObject
+
+      >>> class Content(object):
+      ...    _p_oid = '\\x00' * 7 + '\\x2a'
+      >>> class View(object):
+      ...    __name__ = 'index.html'
+      >>> class LastModified(object):
+      ...    zope.interface.implements(interfaces.ILastModificationDate)
+      ...    def __init__(self, context, request, view):
+      ...        pass
+      ...    lastmodified = datetime.datetime(2007, 3, 2, 13, 34, 23)
+      >>> gsm = zope.component.getGlobalSiteManager()
+      >>> gsm.registerAdapter(LastModified, (Content, None, None))
+
+      >>> content, request, view = Content(), TestRequest(), View()
+      >>> etag = SynthesizedETag(content, request, view)
+      >>> verifyObject(interfaces.IETag, etag)
+      True
+      >>> etag.weak, etag.etag
+      (True, '000000000000002a-index.html-42ab1aa6275c0')
+
+    Content without a last modification date gets no entity tag.
+
+      >>> gsm.unregisterAdapter(LastModified, (Content, None, None))
+      True
+      >>> SynthesizedETag(content, TestRequest(), view).etag is None
+      True
+
+    """
+    zope.interface.implements(interfaces.IETag)
+
+    weak = True
+
+    def __init__(self, context, request, view):
+        self.etag = _synthesize(
+            context, request, view, interfaces.IETag,
+            lambda: self.synthesize(context, request, view))
+
+    def synthesize(self, context, request, view):
+        data = utils.queryValidatorData(
+            context, request, view, interfaces.ILastModificationDate)
+        lastmodified = getattr(data, "lastmodified", None)
+        key = utils.contentKey(context)
+        if lastmodified is None or key is None:
+            return None
+        microseconds = calendar.timegm(lastmodified.utctimetuple()) * \
+                       1000000 + lastmodified.microsecond
+        return "%s-%s-%x" % (
+            key, getattr(view, "__name__", None) or "", microseconds)
+
+
+class SynthesizedLastModificationDate(object):
+    """
+    The last modification date of a view, taken from the timestamp of its
+    entity tag.
+
+      >>> import zope.component
+      >>> from zope.publisher.browser import TestRequest
+      >>> from zope.interface.verify import verifyObject
+
+      >>> class TimestampedETag(object):
+      ...    zope.interface.implements(interfaces.ITimestampedETag)
+      ...    def __init__(self, context, request, view):
+      ...        pass
+      ...    weak = False
+      ...    etag = 'a8f5f167f44f4964e6c998dee827110c'
+      ...    timestamp = datetime.datetime(2007, 3, 2, 13, 34, 23)
+      >>> gsm = zope.component.getGlobalSiteManager()
+      >>> gsm.registerAdapter(TimestampedETag, (None, None, None))
+
+      >>> lmd = SynthesizedLastModificationDate(None, TestRequest(), None)
+      >>> verifyObject(interfaces.ILastModificationDate, lmd)
+      True
+      >>> lmd.lastmodified
+      datetime.datetime(2007, 3, 2, 13, 34, 23, tzinfo=<UTC>)
+
+      >>> gsm.unregisterAdapter(TimestampedETag, (None, None, None))
+      True
+
+    Both can be registered at the same time, for content with neither.
+
+      >>> gsm.registerAdapter(SynthesizedETag, (None, None, None))
+      >>> gsm.registerAdapter(SynthesizedLastModificationDate,
+      ...                     (None, None, None),
+      ...                     interfaces.ILastModificationDate)
+      >>> request = TestRequest()
+      >>> SynthesizedLastModificationDate(
+      ...    None, request, None).lastmodified is None
+      True
+      >>> SynthesizedETag(None, request, None).etag is None
+      True
+      >>> gsm.unregisterAdapter(SynthesizedETag, (None, None, None))
+      True
+      >>> gsm.unregisterAdapter(SynthesizedLastModificationDate,
+      ...                       (None, None, None),
+      ...                       interfaces.ILastModificationDate)
+      True
+
+    """
+    zope.interface.implements(interfaces.ILastModificationDate)
+
+    def __init__(self, context, request, view):
+        self.lastmodified = _synthesize(
+            context, request, view, interfaces.ILastModificationDate,
+            lambda: self.synthesize(context, request, view))
+
+    def synthesize(self, context, request, view):
+        data = utils.queryValidatorData(
+            context, request, view, interfaces.IETag)
+        if not interfaces.ITimestampedETag.providedBy(data) or \
+               data.timestamp is None:
+            return None
+        timestamp = data.timestamp
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo = pytz.utc)
+        return timestamp
@@ -0,0 +1,265 @@
+##############################################################################
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+##############################################################################
+"""
+Entity tags and last modification dates for containers that change when
+ever anything inside the container changes.
+
+  >>> import zope.component
+  >>> import zope.component.event
+  >>> import zope.annotation.attribute
+  >>> import zope.annotation.interfaces
+  >>> import zope.container.btree
+  >>> import zope.lifecycleevent
+  >>> import zope.location.interfaces
+  >>> from zope.interface.verify import verifyObject
+  >>> from zope.publisher.browser import TestRequest
+
+  >>> class Folder(zope.container.btree.BTreeContainer):
+  ...    zope.interface.implements(
+  ...        zope.annotation.interfaces.IAttributeAnnotatable)
+  >>> class Document(object):
+  ...    zope.interface.implements(
+  ...        zope.location.interfaces.IContained)
+  ...    __name__ = __parent__ = None
+
+  >>> gsm = zope.component.getGlobalSiteManager()
+  >>> gsm.registerAdapter(zope.annotation.attribute.AttributeAnnotations)
+  >>> gsm.registerHandler(zope.component.event.objectEventNotify)
+  >>> gsm.registerHandler(contentModified)
+  >>> gsm.registerHandler(contentMoved)
+
+Until anything has changed inside a container we know nothing about it, so
+no validator data is available and requests are never validated.
+
+  >>> root = Folder()
+  >>> request = TestRequest()
+  >>> ContainerETag(root, request, None).etag is None
+  True
+  >>> ContainerLastModificationDate(root, request, None).lastmodified is None
+  True
+
+  >>> folder = root['folder'] = Folder()
+
+Adding a document to the folder updates the data of the folder and of all its
+parents.
+
+  >>> doc = Document()
+  >>> folder['doc'] = doc
+
+  >>> data = getAggregateData(folder)
+  >>> verifyObject(interfaces.IAggregateValidatorData, data)
+  True
+
+  >>> etag = ContainerETag(folder, request, None)
+  >>> verifyObject(interfaces.IETag, etag)
+  True
+  >>> folderetag = etag.etag
+  >>> len(folderetag)
+  32
+  >>> rootetag = ContainerETag(root, request, None).etag
+  >>> rootetag is not None
+  True
+
+  >>> lmd = ContainerLastModificationDate(folder, request, None)
+  >>> verifyObject(interfaces.ILastModificationDate, lmd)
+  True
+  >>> lmd.lastmodified.tzinfo is not None
+  True
+
+Modifying the document changes both entity tags again.
+
+  >>> zope.lifecycleevent.modified(doc)
+  >>> ContainerETag(folder, request, None).etag != folderetag
+  True
+  >>> ContainerETag(root, request, None).etag != rootetag
+  True
+
+And so does removing it.
+
+  >>> folderetag = ContainerETag(folder, request, None).etag
+  >>> del folder['doc']
+  >>> ContainerETag(folder, request, None).etag != folderetag
+  True
+
+The last modification date never goes backwards.
+
+  >>> import datetime
+  >>> lastmodified = getAggregateData(folder).lastmodified
+  >>> getAggregateData(folder).update(
+  ...    'old', datetime.datetime(2000, 1, 1, 12, 0, 0))
+  >>> getAggregateData(folder).lastmodified == lastmodified
+  True
+
+Since every change is written to all the parents of the content, concurrent
+changes in different parts of the site would conflict on the parents. These
+conflicts are resolved by combining both digests, and taking the latest
+modification date.
+
+  >>> old = {'digest': 'a', 'lastmodified': None}
+  >>> saved = {'digest': 'b', 'lastmodified': datetime.datetime(2007, 1, 1)}
+  >>> new = {'digest': 'c', 'lastmodified': datetime.datetime(2007, 1, 2)}
+  >>> resolved = AggregateData()._p_resolveConflict(old, saved, new)
+  >>> resolved['digest'] == hashlib.md5('bc').hexdigest()
+  True
+  >>> resolved['lastmodified']
+  datetime.datetime(2007, 1, 2, 0, 0)
+
+Cleanup
+-------
+
+  >>> gsm.unregisterAdapter(zope.annotation.attribute.AttributeAnnotations)
+  True
+  >>> gsm.unregisterHandler(zope.component.event.objectEventNotify)
+  True
+  >>> gsm.unregisterHandler(contentModified)
+  True
+  >>> gsm.unregisterHandler(contentMoved)
+  True
+
+"""
+
+import datetime
+import hashlib
+import time
+
+import persistent
+import pytz
+import zope.component
+import zope.interface
+import zope.annotation.interfaces
+import zope.container.interfaces
+import zope.dublincore.interfaces
+import zope.lifecycleevent.interfaces
+
+import interfaces
+import utils
+
+ANNOTATION_KEY = "z3c.conditionalviews.aggregate"
+
+def _utcdate(dt):
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo = pytz.utc)
+    return dt.astimezone(pytz.utc)
+
+
+class AggregateData(persistent.Persistent):
+    zope.interface.implements(interfaces.IAggregateValidatorData)
+
+    digest = None
+    lastmodified = None
+
+    def update(self, token, mtime):
+        self.digest = hashlib.md5((self.digest or "") + token).hexdigest()
+        mtime = _utcdate(mtime)
+        if self.lastmodified is None or mtime > self.lastmodified:
+            self.lastmodified = mtime
+
+    def _p_resolveConflict(self, oldState, savedState, newState):
+        state = dict(newState)
+        state["digest"] = hashlib.md5(
+            (savedState.get("digest") or "") +
+            (newState.get("digest") or "")).hexdigest()
+        state["lastmodified"] = max(savedState.get("lastmodified"),
+                                    newState.get("lastmodified"))
+        return state
+
+
+def getAggregateData(container, create = False):
+    annotations = zope.annotation.interfaces.IAnnotations(container, None)
+    if annotations is None:
+        return None
+    data = annotations.get(ANNOTATION_KEY)
+    if data is None and create:
+        data = annotations[ANNOTATION_KEY] = AggregateData()
+    return data
+
+
+def propagate(container, token, mtime):
+    """
+    Fold the change described by `token` into the aggregate data of
+    `container` and all its parents.
+    """
+    while container is not None:
+        if zope.container.interfaces.IContainer.providedBy(container):
+            data = getAggregateData(container, create = True)
+            if data is not None:
+                data.update(token, mtime)
+        container = getattr(container, "__parent__", None)
+
+
+def _token(kind, ob):
+    return "%s:%s:%s:%r" % (kind, utils.contentKey(ob),
+                            getattr(ob, "__name__", None), time.time())
+
+
+def _mtime(ob):
+    dc = zope.dublincore.interfaces.IDCTimes(ob, None)
+    mtime = dc is not None and dc.modified or None
+    return mtime or datetime.datetime.now(pytz.utc)
+
+###############################################################################
+#
+# Event handlers keeping the aggregate data up to date.
+#
+###############################################################################
+
+@zope.component.adapter(zope.interface.Interface,
+                        zope.lifecycleevent.interfaces.IObjectModifiedEvent)
+def contentModified(ob, event):
+    if zope.container.interfaces.IContainerModifiedEvent.providedBy(event):
+        # Containers are modified when an object is added or removed, which
+        # we are notified of seperately.
+        return
+    propagate(ob, _token("modified", ob), _mtime(ob))
+
+
+@zope.component.adapter(zope.interface.Interface,
+                        zope.lifecycleevent.interfaces.IObjectMovedEvent)
+def contentMoved(ob, event):
+    mtime = datetime.datetime.now(pytz.utc)
+    if event.oldParent is not None:
+        propagate(event.oldParent, _token("removed", ob), mtime)
+    if event.newParent is not None:
+        propagate(event.newParent, _token("added", ob), mtime)
+
+###############################################################################
+#
+# Validator data for containers.
+#
+###############################################################################
+
+class ContainerETag(object):
+    zope.interface.implements(interfaces.IETag)
+
+    def __init__(self, context, request, view):
+        self.context = context
+
+    # The same digest can be given to different, but semantically equivalent
+    # renderings of the container.
+    weak = True
+
+    @property
+    def etag(self):
+        data = getAggregateData(self.context)
+        return data is not None and data.digest or None
+
+
+class ContainerLastModificationDate(object):
+    zope.interface.implements(interfaces.ILastModificationDate)
+
+    def __init__(self, context, request, view):
+        self.context = context
+
+    @property
+    def lastmodified(self):
+        data = getAggregateData(self.context)
+        return data is not None and data.lastmodified or None
@@ -0,0 +1,132 @@
+##############################################################################
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+##############################################################################
+
+import json
+import StringIO
+
+import zope.component
+import zope.interface
+import zope.publisher.browser
+import zope.publisher.defaultview
+import zope.security.checker
+import zope.security.interfaces
+import zope.traversing.api
+
+import z3c.conditionalviews
+import interfaces
+
+class RevalidationView(zope.publisher.browser.BrowserView):
+    """
+    Revalidate many resources in one request.
+
+    The body of the request is a JSON list of objects, each one with the
+    `path` of a resource and the `etag` and or the `lastmodified` date of the
+    client's copy of it. Each resource is validated, as the default view of
+    the object at the path, exactly as a conditional GET request would be.
+
+    The result lists the `status` the conditional GET request would have
+    got for each resource. Resources that are still `current` get a status
+    of 304, the others get the current validator data.
+
+    The resources are validated with the layers, the `Accept` headers and
+    the credentials of the batch request.
+    """
+
+    maxbatchsize = 100
+
+    def resources(self):
+        resources = json.loads(self.request.bodyStream.read() or "null")
+        if not isinstance(resources, list):
+            raise ValueError("Expected a list of resources")
+        for resource in resources:
+            if not isinstance(resource, dict) or \
+                   not isinstance(resource.get("path"), basestring):
+                raise ValueError("Expected a path for every resource")
+        return resources
+
+    def subrequest(self, resource):
+        environ = {"REQUEST_METHOD": "GET"}
+        orig = getattr(self.request, "_orig_env", self.request._environ)
+        for name, value in orig.items():
+            # The representation of a resource, and the principal it is
+            # rendered for, can depend on these.
+            if name.startswith("HTTP_ACCEPT") or \
+                   name == "HTTP_AUTHORIZATION":
+                environ[name] = value
+        if resource.get("etag"):
+            environ["HTTP_IF_NONE_MATCH"] = str(resource["etag"])
+        if resource.get("lastmodified"):
+            environ["HTTP_IF_MODIFIED_SINCE"] = str(resource["lastmodified"])
+        request = zope.publisher.browser.BrowserRequest(
+            StringIO.StringIO(""), environ)
+        zope.interface.directlyProvides(
+            request, zope.interface.directlyProvidedBy(self.request))
+        request.setPrincipal(self.request.principal)
+        return request
+
+    def revalidate(self, resource):
+        path = resource["path"]
+        try:
+            ob = zope.traversing.api.traverse(self.context, path)
+        except (zope.security.interfaces.Unauthorized,
+                zope.security.interfaces.Forbidden):
+            return {"path": path, "status": 403, "current": False}
+        except (LookupError, TypeError):
+            return {"path": path, "status": 404, "current": False}
+
+        request = self.subrequest(resource)
+        name = zope.publisher.defaultview.queryDefaultViewName(ob, request)
+        view = name and zope.component.queryMultiAdapter(
+            (ob, request), name = name)
+        if view is None:
+            return {"path": path, "status": 404, "current": False}
+        try:
+            # The user must be allowed to see the view.
+            allowed = zope.security.checker.canAccess(view, "__call__")
+        except zope.security.interfaces.ForbiddenAttribute:
+            allowed = False
+        if not allowed:
+            return {"path": path, "status": 403, "current": False}
+
+        validators = z3c.conditionalviews.getValidators(view)
+        fetcher = zope.component.queryUtility(
+            interfaces.IValidatorDataFetcher)
+        if fetcher is not None:
+            validators = fetcher.fetch(ob, request, view, validators)
+        status = z3c.conditionalviews.invalidStatus(
+            ob, request, view, validators) or 200
+        result = {"path": path, "status": status, "current": status == 304}
+        if status == 304:
+            return result
+
+        for validator in validators:
+            validator.updateResponse(ob, request, view)
+        for name, header in (("etag", "ETag"),
+                             ("lastmodified", "Last-Modified")):
+            value = request.response.getHeader(header, None)
+            if value is not None:
+                result[name] = value
+        return result
+
+    def __call__(self):
+        try:
+            resources = self.resources()
+        except ValueError:
+            self.request.response.setStatus(400)
+            return ""
+        if len(resources) > self.maxbatchsize:
+            self.request.response.setStatus(413)
+            return ""
+
+        result = [self.revalidate(resource) for resource in resources]
+        self.request.response.setHeader("Content-Type", "application/json")
+        return json.dumps({"resources": result})
@@ -0,0 +1,370 @@
+##############################################################################
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+##############################################################################
+"""
+Benchmarks of the validation of requests to conditional views.
+
+Every benchmark times one of the hot paths of a conditional view, and returns
+the best time of a call out of a number of repeats.
+
+  >>> sorted(BENCHMARKS)
+  ['etag.parseMatchList', 'lastmodification.format',
+   'lastmodification.parse', 'publication.afterCall',
+   'publication.afterCall.readonly', 'publication.callObject', 'validate.0',
+   'validate.1', 'validate.n']
+
+  >>> results = run(number = 10, repeat = 1)
+  >>> sorted(results) == sorted(BENCHMARKS)
+  True
+  >>> min(results.values()) > 0
+  True
+
+The results of a run are saved as a JSON baseline, which later runs are
+compared against. Benchmarks slower than the baseline by more than the
+threshold are regressions.
+
+  >>> import os, tempfile
+  >>> baseline = os.path.join(tempfile.mkdtemp(), 'baseline.json')
+  >>> save({'validate.0': 0.00001, 'validate.1': 0.00002}, baseline)
+  >>> compare({'validate.0': 0.0000105, 'validate.1': 0.00003},
+  ...         load(baseline), threshold = 0.1)
+  [('validate.1', 2e-05, 3e-05)]
+
+Benchmarks missing from the baseline are never regressions.
+
+  >>> compare({'validate.n': 0.1}, load(baseline), threshold = 0.1)
+  []
+
+The `conditionalviews-benchmark` script runs the benchmarks, saving them as a
+baseline or comparing them to one. It fails when there are regressions.
+
+  >>> main(['--number', '10', '--repeat', '1', '--save', baseline,
+  ...       'validate.0'])
+  validate.0 ... usec
+  0
+  >>> sorted(load(baseline))
+  [u'validate.0']
+
+  >>> save({'validate.0': 0.0000000001}, baseline)
+  >>> main(['--number', '10', '--repeat', '1', '--compare', baseline,
+  ...       'validate.0'])
+  validate.0 ... usec (0.0001 usec, +...%) REGRESSION
+  1
+
+  >>> os.remove(baseline)
+  >>> os.rmdir(os.path.dirname(baseline))
+
+"""
+
+import datetime
+import json
+import optparse
+import time
+
+import persistent
+import pytz
+import transaction
+import ZODB.DB
+import ZODB.MappingStorage
+import zope.app.publication.http
+import zope.component
+import zope.interface
+import zope.publisher.browser
+import zope.publisher.http
+import zope.publisher.interfaces
+import zope.publisher.interfaces.http
+from StringIO import StringIO
+
+import z3c.conditionalviews
+import interfaces
+import etag
+import lastmodification
+
+BENCHMARKS = {}
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+class Content(object):
+    pass
+
+
+class View(object):
+
+    def __init__(self, context, request):
+        self.context, self.request = context, request
+
+    def render(self):
+        return "rendered"
+
+    def GET(self):
+        return self.render()
+
+
+class ETag(object):
+    zope.interface.implements(interfaces.IETag)
+
+    def __init__(self, context, request, view):
+        pass
+
+    weak = False
+    etag = "xyzzy"
+
+
+class LastModificationDate(object):
+    zope.interface.implements(interfaces.ILastModificationDate)
+
+    def __init__(self, context, request, view):
+        pass
+
+    lastmodified = datetime.datetime(2007, 2, 5, 5, 43, 23, tzinfo = pytz.utc)
+
+
+class NeverEvaluated(object):
+    zope.interface.implements(interfaces.IHTTPValidator)
+
+    def evaluate(self, context, request, view):
+        return False
+
+    def valid(self, context, request, view):
+        return True
+
+    def invalidStatus(self, context, request, view):
+        return 304
+
+    def updateResponse(self, context, request, view):
+        pass
+
+
+class Publication(object):
+    # Only callObject is used.
+
+    def __getattr__(self, name):
+        return None
+
+
+def requests(number, **environ):
+    return [zope.publisher.browser.TestRequest(environ = environ)
+            for i in range(number)]
+
+
+def timed(func, args):
+    start = time.time()
+    for arg in args:
+        func(arg)
+    return time.time() - start
+
+
+def registered(validators, func):
+    """
+    Call `func` with the `validators` and the validator data registered.
+    """
+    gsm = zope.component.getGlobalSiteManager()
+    gsm.registerAdapter(ETag, (Content, None, None))
+    gsm.registerAdapter(LastModificationDate, (Content, None, None))
+    for name, validator in validators:
+        gsm.registerUtility(validator, name = name)
+    try:
+        return func()
+    finally:
+        for name, validator in validators:
+            gsm.unregisterUtility(
+                name = name, provided = interfaces.IHTTPValidator)
+        gsm.unregisterAdapter(ETag, (Content, None, None))
+        gsm.unregisterAdapter(LastModificationDate, (Content, None, None))
+
+
+def timeValidate(number, validators):
+    content = Content()
+    render = View.render.im_func
+    def validate(request):
+        z3c.conditionalviews.validate(
+            content, request, render, View(content, request))
+    return registered(validators, lambda: timed(
+        validate, requests(number, IF_NONE_MATCH = '"xyzzy"')))
+
+
+@benchmark("validate.0")
+def validate0(number):
+    return timeValidate(number, [])
+
+
+@benchmark("validate.1")
+def validate1(number):
+    return timeValidate(number, [("http.etag", etag.ETagValidator())])
+
+
+@benchmark("validate.n")
+def validateN(number):
+    validators = [("http.etag", etag.ETagValidator()),
+                  ("http.lastmodification",
+                   lastmodification.ModifiedSinceValidator())]
+    validators.extend([("test.validator%d" % index, NeverEvaluated())
+                       for index in range(8)])
+    return timeValidate(number, validators)
+
+
+@benchmark("etag.parseMatchList")
+def parseMatchList(number):
+    header = ", ".join(['W/"etag-%d"' % index for index in range(100)])
+    validator = etag.ETagValidator()
+    return timed(
+        lambda request: validator.parseMatchList(request, "If-None-Match"),
+        requests(number, IF_NONE_MATCH = header))
+
+
+@benchmark("lastmodification.parse")
+def parseModifiedSince(number):
+    validator = lastmodification.ModifiedSinceValidator()
+    mtime = LastModificationDate.lastmodified
+    return timed(
+        lambda request: validator.ifModifiedSince(
+            request, mtime, "If-Modified-Since"),
+        requests(number, IF_MODIFIED_SINCE = "Mon, 05 Feb 2007 05:43:23 GMT"))
+
+
+@benchmark("lastmodification.format")
+def formatLastModified(number):
+    validator = lastmodification.ModifiedSinceValidator()
+    content = Content()
+    return registered([], lambda: timed(
+        lambda request: validator.updateResponse(content, request, None),
+        requests(number)))
+
+
+@benchmark("publication.callObject")
+def callObject(number):
+    publication = z3c.conditionalviews.ConditionalPublication(Publication())
+    content = Content()
+    gsm = zope.component.getGlobalSiteManager()
+    gsm.registerAdapter(
+        View, (Content, zope.publisher.interfaces.http.IHTTPRequest),
+        zope.interface.Interface, name = "GET")
+    try:
+        return timed(
+            lambda request: publication.callObject(request, content),
+            [zope.publisher.http.HTTPRequest(StringIO(""), {})
+             for i in range(number)])
+    finally:
+        gsm.unregisterAdapter(
+            View, (Content, zope.publisher.interfaces.http.IHTTPRequest),
+            zope.interface.Interface, name = "GET")
+
+
+def timeAfterCall(number, readonly):
+    # A GET request answered with 304 Not Modified, after loading the
+    # content from the database.
+    db = ZODB.DB(ZODB.MappingStorage.MappingStorage())
+    connection = db.open()
+    connection.root()["content"] = persistent.Persistent()
+    transaction.commit()
+    publication = z3c.conditionalviews.ConditionalPublication(
+        zope.app.publication.http.HTTPPublication(db), readonly)
+    def afterCall(request):
+        request.response.setStatus(304)
+        publication.afterCall(request, connection.root()["content"])
+    try:
+        return timed(afterCall, requests(number))
+    finally:
+        transaction.abort()
+        connection.close()
+        db.close()
+
+
+@benchmark("publication.afterCall")
+def afterCall(number):
+    return timeAfterCall(number, False)
+
+
+@benchmark("publication.afterCall.readonly")
+def afterCallReadOnly(number):
+    return timeAfterCall(number, True)
+
+
+def run(names = None, number = 1000, repeat = 3):
+    """
+    Return the best time in seconds of one call of each benchmark.
+    """
+    results = {}
+    for name in sorted(names or BENCHMARKS):
+        func = BENCHMARKS[name]
+        results[name] = min([func(number) for i in range(repeat)]) / number
+    return results
+
+
+def save(results, path):
+    output = open(path, "w")
+    try:
+        json.dump(results, output, indent = 2, sort_keys = True)
+    finally:
+        output.close()
+
+
+def load(path):
+    input = open(path)
+    try:
+        return json.load(input)
+    finally:
+        input.close()
+
+
+def compare(results, baseline, threshold = 0.1):
+    """
+    Return the benchmarks slower than the `baseline` by more than the
+    `threshold`, as a list of (name, baseline, result).
+    """
+    return [(name, baseline[name], result)
+            for name, result in sorted(results.items())
+            if name in baseline and result > baseline[name] * (1 + threshold)]
+
+
+def main(argv = None):
+    parser = optparse.OptionParser(
+        usage = "%prog [options] [benchmark ...]",
+        description = "Benchmark the validation of conditional requests.")
+    parser.add_option("-n", "--number", type = "int", default = 1000,
+                      help = "calls to time in every repeat")
+    parser.add_option("-r", "--repeat", type = "int", default = 3,
+                      help = "repeats to take the best time of")
+    parser.add_option("-s", "--save", metavar = "FILE",
+                      help = "save the results as a baseline")
+    parser.add_option("-c", "--compare", metavar = "FILE",
+                      help = "compare the results to a baseline")
+    parser.add_option("-t", "--threshold", type = "float", default = 0.1,
+                      help = "slowdown, as a fraction of the baseline, "
+                             "reported as a regression")
+    options, names = parser.parse_args(argv)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark: %s" % name)
+
+    results = run(names, options.number, options.repeat)
+    baseline = options.compare and load(options.compare) or {}
+    regressions = dict([
+        (name, result) for name, expected, result in
+        compare(results, baseline, options.threshold)])
+    for name, result in sorted(results.items()):
+        line = "%s %.4f usec" % (name, result * 1e6)
+        if name in baseline:
+            line += " (%.4f usec, %+.1f%%)" % (
+                baseline[name] * 1e6,
+                (result / baseline[name] - 1) * 100)
+        if name in regressions:
+            line += " REGRESSION"
+        print(line)
+
+    if options.save:
+        save(results, options.save)
+    return regressions and 1 or 0
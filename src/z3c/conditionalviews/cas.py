@@ -0,0 +1,227 @@
+##############################################################################
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+##############################################################################
+"""
+Compare and swap commits of writes validated by an `If-Match` header.
+
+When another transaction changes the content after a request validated it
+with an `If-Match` header, the commit of the request fails with a conflict
+error, and the whole request is published again only to fail the `If-Match`
+header this time. Requests published by the `ConditionalHTTPRequest`
+instead remember the revision of the content they validated, and the commit
+fails with `PreconditionFailed` as soon as the content has been changed by
+another transaction. The request is answered with `412 Precondition Failed`
+straight away.
+
+  >>> import transaction
+  >>> import ZODB.DB
+  >>> import ZODB.MappingStorage
+  >>> from zope.publisher.browser import TestRequest
+  >>> from z3c.conditionalviews.tests import File
+
+  >>> db = ZODB.DB(ZODB.MappingStorage.MappingStorage())
+  >>> connection = db.open()
+  >>> connection.root()['file'] = File('v1')
+  >>> transaction.commit()
+
+  >>> def write(data, writer = None):
+  ...    request = TestRequest()
+  ...    enable(request)
+  ...    ob = connection.root()['file']
+  ...    guard(ob, request)
+  ...    ob.data = data
+  ...    if writer is not None:
+  ...        writer()
+  ...    transaction.commit()
+
+Writes not racing with another transaction commit as usual.
+
+  >>> write('v2')
+  >>> connection.root()['file'].data
+  'v2'
+
+Another transaction changing the content before the request commits fails
+the commit.
+
+  >>> def otherWriter():
+  ...    manager = transaction.TransactionManager()
+  ...    other = db.open(transaction_manager = manager)
+  ...    other.root()['file'].data = 'other'
+  ...    manager.commit()
+  ...    other.close()
+  >>> write('v3', otherWriter)
+  Traceback (most recent call last):
+  ...
+  PreconditionFailed: 0000000000000001
+  >>> transaction.abort()
+  >>> connection.root()['file'].data
+  'other'
+
+Content added by another transaction is still a ghost when the request
+validates it.  It is loaded to read its revision, so writes to it don't fail
+either.
+
+  >>> manager = transaction.TransactionManager()
+  >>> other = db.open(transaction_manager = manager)
+  >>> other.root()['new'] = File('new')
+  >>> manager.commit()
+  >>> other.close()
+
+  >>> transaction.abort()
+  >>> ob = connection.root()['new']
+  >>> ob._p_changed is None
+  True
+  >>> request = TestRequest()
+  >>> enable(request)
+  >>> guard(ob, request)
+  >>> ob.data = 'v1'
+  >>> transaction.commit()
+  >>> connection.root()['new'].data
+  'v1'
+
+The `ConditionalPublication` answers these requests with a `412 Precondition
+Failed` response, and counts the retries it avoided.
+
+  >>> import zope.component
+  >>> import zope.app.publication.http
+  >>> from z3c.conditionalviews import ConditionalPublication
+  >>> from z3c.conditionalviews.metrics import ValidationMetrics
+  >>> metrics = ValidationMetrics()
+  >>> zope.component.getGlobalSiteManager().registerUtility(metrics)
+
+  >>> publication = ConditionalPublication(
+  ...    zope.app.publication.http.HTTPPublication(db))
+  >>> request = TestRequest()
+  >>> enable(request)
+  >>> ob = connection.root()['file']
+  >>> guard(ob, request)
+  >>> ob.data = 'v4'
+  >>> otherWriter()
+  >>> request.response.setResult('Written')
+  >>> publication.afterCall(request, ob)
+  >>> request.response.getStatus()
+  412
+  >>> request.response.consumeBody()
+  ''
+  >>> connection.root()['file'].data
+  'other'
+  >>> [value for name, labels, value in metrics.collect()
+  ...  if name == 'z3c_conditionalviews_retries_avoided_total']
+  [1.0]
+
+  >>> zope.component.getGlobalSiteManager().unregisterUtility(metrics)
+  True
+
+Requests which are not published by the `ConditionalHTTPRequest` are not
+guarded.
+
+  >>> request = TestRequest()
+  >>> guard(connection.root()['file'], request)
+  >>> CAS_KEY in request.annotations
+  False
+
+  >>> connection.close()
+  >>> db.close()
+
+"""
+
+import transaction
+import transaction.interfaces
+import zope.interface
+from zope.security.proxy import removeSecurityProxy
+
+import utils
+
+# Key of the `SerialCheck` of the request in its annotations.
+CAS_KEY = "z3c.conditionalviews.cas"
+
+# Key in the request annotations marking requests whose commit can fail
+# with `PreconditionFailed`.
+ENABLED_KEY = "z3c.conditionalviews.cas.enabled"
+
+class PreconditionFailed(Exception):
+    """
+    Content validated by an `If-Match` header was changed by another
+    transaction before the request committed.
+    """
+
+
+class SerialCheck(object):
+    """
+    Fails the commit of a transaction when content validated by the
+    request has since been committed by another transaction.
+    """
+    zope.interface.implements(transaction.interfaces.IDataManager)
+
+    def __init__(self, manager):
+        self.transaction_manager = manager
+        self.transaction = manager.get()
+        # (id of the connection, oid) -> (object, serial validated)
+        self.serials = {}
+
+    def add(self, ob):
+        # Ghosts report a zero serial until they are loaded.
+        ob._p_activate()
+        self.serials.setdefault((id(ob._p_jar), ob._p_oid),
+                                (ob, ob._p_serial))
+
+    def sortKey(self):
+        # Checked before any of the connections stores anything.
+        return "\x00z3c.conditionalviews.cas"
+
+    def abort(self, txn):
+        pass
+
+    def tpc_begin(self, txn):
+        pass
+
+    def commit(self, txn):
+        for ob, serial in self.serials.values():
+            storage = ob._p_jar.db().storage
+            committed = storage.load(ob._p_oid, "")[1]
+            if committed != serial:
+                raise PreconditionFailed(utils.contentKey(ob))
+
+    def tpc_vote(self, txn):
+        pass
+
+    def tpc_finish(self, txn):
+        pass
+
+    def tpc_abort(self, txn):
+        pass
+
+
+def enable(request):
+    """
+    Let the commit of the request fail with `PreconditionFailed`.
+    """
+    request.annotations[ENABLED_KEY] = True
+
+
+def guard(context, request):
+    """
+    Fail the commit of the request if the persistent `context` has been
+    changed by another transaction since the request validated it.
+    """
+    annotations = getattr(request, "annotations", {})
+    if not annotations.get(ENABLED_KEY):
+        return
+    ob = removeSecurityProxy(context)
+    jar = getattr(ob, "_p_jar", None)
+    if jar is None or ob._p_oid is None:
+        return
+    txn = jar.transaction_manager.get()
+    check = annotations.get(CAS_KEY)
+    if check is None or check.transaction is not txn:
+        check = annotations[CAS_KEY] = SerialCheck(jar.transaction_manager)
+        txn.join(check)
+    check.add(ob)
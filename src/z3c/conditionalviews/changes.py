@@ -0,0 +1,280 @@
+##############################################################################
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+##############################################################################
+
+import collections
+import json
+import time
+
+import persistent
+import transaction
+import zope.component
+import zope.container.interfaces
+import zope.datetime
+import zope.interface
+import zope.lifecycleevent.interfaces
+import zope.publisher.browser
+import zope.security.interfaces
+import zope.traversing.api
+from BTrees.OOBTree import OOBTree
+from zope.container.contained import Contained
+
+import interfaces
+import utils
+
+# Sorts after every path, standing for all the changes of a commit.
+_END = u"\uffff"
+
+def formatToken(sequence, path = _END):
+    if path == _END:
+        return "%d" % sequence
+    return "%d%s" % (sequence, path.encode("utf-8"))
+
+
+def parseToken(token):
+    token = str(token)
+    index = token.find("/")
+    if index == -1:
+        return int(token), _END
+    return int(token[:index]), token[index:].decode("utf-8")
+
+
+class ModificationIndex(persistent.Persistent, Contained):
+    zope.interface.implements(interfaces.IModificationIndex)
+
+    def __init__(self):
+        # (sequence, path) -> (mtime, deleted)
+        self._bysequence = OOBTree()
+        # path -> sequence
+        self._bypath = OOBTree()
+        # mtime of a commit -> sequence of the commit
+        self._bytime = OOBTree()
+        # Number of the last commit. Concurrent commits conflict on it, so
+        # commits are numbered in the order they are committed.
+        self._sequence = 0
+        self._mtime = 0.0
+
+    def _transaction(self):
+        jar = self._p_jar
+        if jar is not None:
+            return jar.transaction_manager.get()
+        return transaction.get()
+
+    def index(self, path, deleted = False):
+        txn = self._transaction()
+        pending = getattr(self, "_v_pending", None)
+        if pending is None or pending[0] is not txn:
+            pending = self._v_pending = (txn, collections.OrderedDict())
+            txn.addBeforeCommitHook(self._commit, (pending[1],))
+        path = unicode(path)
+        pending[1].pop(path, None)
+        pending[1][path] = deleted
+
+    def _index(self, path, sequence, mtime, deleted):
+        old = self._bypath.get(path)
+        if old is not None:
+            del self._bysequence[(old, path)]
+        self._bysequence[(sequence, path)] = (mtime, deleted)
+        self._bypath[path] = sequence
+
+    def _commit(self, pending):
+        self._v_pending = None
+        if not pending:
+            return
+        self._sequence += 1
+        sequence = self._sequence
+        # Commit times never go back, so that they can be looked up.
+        mtime = max(round(time.time(), 6), round(self._mtime + 1e-6, 6))
+        self._mtime = mtime
+        self._bytime[mtime] = sequence
+        for path, deleted in pending.items():
+            self._index(path, sequence, mtime, deleted)
+            if deleted:
+                for subpath in list(self._bypath.keys(
+                        min = path + u"/", max = path + u"/" + _END)):
+                    self._index(subpath, sequence, mtime, True)
+
+    def changedSince(self, since, token = None, batchsize = 100):
+        if token is not None:
+            start = parseToken(token)
+            excludemin = True
+        else:
+            try:
+                start = (self._bytime[self._bytime.minKey(since)], u"")
+                excludemin = False
+            except ValueError:
+                # Nothing was committed since.
+                start = (self._sequence, _END)
+                excludemin = True
+
+        changes = []
+        more = False
+        for (sequence, path), (mtime, deleted) in self._bysequence.items(
+                min = start, excludemin = excludemin):
+            if len(changes) == batchsize:
+                more = True
+                break
+            changes.append((mtime, path, deleted, sequence))
+
+        if changes:
+            token = formatToken(changes[-1][3], changes[-1][1])
+        elif excludemin:
+            token = formatToken(*start)
+        else:
+            token = formatToken(self._sequence)
+
+        return [change[:3] for change in changes], token, more
+
+###############################################################################
+#
+# Event handlers keeping the index up to date.
+#
+###############################################################################
+
+def _path(ob):
+    try:
+        return zope.traversing.api.getPath(ob)
+    except (TypeError, LookupError):
+        # The object is not located, or is not located in a site.
+        return None
+
+
+def _indexTree(index, ob, path):
+    # Objects added or moved along with a container are at a new path too.
+    index.index(path)
+    if zope.container.interfaces.IReadContainer.providedBy(ob):
+        for name, sub in ob.items():
+            _indexTree(index, sub, u"%s/%s" % (path.rstrip(u"/"), name))
+
+
+@zope.component.adapter(zope.interface.Interface,
+                        zope.lifecycleevent.interfaces.IObjectModifiedEvent)
+def contentModified(ob, event):
+    index = zope.component.queryUtility(interfaces.IModificationIndex)
+    path = _path(ob)
+    if index is not None and path is not None:
+        index.index(path)
+
+
+@zope.component.adapter(zope.interface.Interface,
+                        zope.lifecycleevent.interfaces.IObjectMovedEvent)
+def contentMoved(ob, event):
+    if event.object is not ob:
+        # Dispatched to a sub-object of the moved object, all the
+        # sub-objects are indexed along with the object.
+        return
+
+    index = zope.component.queryUtility(interfaces.IModificationIndex)
+    if index is None:
+        return
+
+    if event.oldParent is not None:
+        parentpath = _path(event.oldParent)
+        if parentpath is not None:
+            index.index("%s/%s" % (parentpath.rstrip("/"), event.oldName),
+                        deleted = True)
+    if event.newParent is not None:
+        path = _path(ob)
+        if path is not None:
+            _indexTree(index, ob, path)
+
+###############################################################################
+#
+# Delta synchronization view.
+#
+###############################################################################
+
+class ChangesView(zope.publisher.browser.BrowserView):
+    """
+    Return, as JSON, the paths and the current entity tags of all the
+    objects changed since the date in the `If-Modified-Since` header or the
+    `since` form variable, or since the last synchronization identified by the
+    `token` form variable.
+    """
+
+    maxbatchsize = 500
+
+    def since(self):
+        header = self.request.getHeader("If-Modified-Since", None)
+        if header is None:
+            header = self.request.form.get("since", None)
+        if header is None:
+            return 0
+        try:
+            return zope.datetime.time(header.split(";", 1)[0])
+        except Exception:
+            return 0
+
+    def etag(self, root, path):
+        ob = zope.traversing.api.traverse(root, path, None)
+        if ob is None:
+            return None
+        etag = utils.queryValidatorData(
+            ob, self.request, self, interfaces.IETag)
+        if etag is None or not etag.etag:
+            return None
+        if etag.weak:
+            return 'W/"%s"' % etag.etag
+        return '"%s"' % etag.etag
+
+    def container(self, root, path):
+        # The innermost container of a removed object which is still there.
+        while path != u"/":
+            path = path.rsplit(u"/", 1)[0] or u"/"
+            ob = zope.traversing.api.traverse(root, path, None)
+            if ob is not None:
+                return ob
+        return root
+
+    def __call__(self):
+        index = zope.component.getUtility(interfaces.IModificationIndex)
+        token = self.request.form.get("token", None)
+        try:
+            batchsize = int(self.request.form.get("batchsize", 100))
+            batchsize = max(1, min(batchsize, self.maxbatchsize))
+        except ValueError:
+            batchsize = 100
+
+        try:
+            changes, nexttoken, more = index.changedSince(
+                self.since(), token, batchsize)
+        except ValueError:
+            # Invalid token
+            self.request.response.setStatus(400)
+            return ""
+
+        if not changes and token is None and \
+               self.request.getHeader("If-Modified-Since", None) is not None:
+            self.request.response.setStatus(304)
+            return ""
+
+        root = zope.traversing.api.getRoot(self.context)
+        result = []
+        for mtime, path, deleted in changes:
+            entry = {"path": path,
+                     "lastmodified": zope.datetime.rfc1123_date(mtime),
+                     "deleted": deleted}
+            try:
+                if deleted:
+                    # Only users who can see the container are told about
+                    # the objects removed from it.
+                    self.container(root, path)
+                else:
+                    entry["etag"] = self.etag(root, path)
+            except (zope.security.interfaces.Unauthorized,
+                    zope.security.interfaces.Forbidden):
+                # Don't tell the user about objects they can't see.
+                continue
+            result.append(entry)
+
+        self.request.response.setHeader("Content-Type", "application/json")
+        return json.dumps(
+            {"changes": result, "token": nexttoken, "more": more})
@@ -0,0 +1,459 @@
+##############################################################################
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+##############################################################################
+"""
+Compressed representations of conditional views.
+
+The representations are compressed with the content coding preferred by the
+client and kept in memory, keyed by the entity tag of the compressed
+representation. As long as the entity tag of the view doesn't change, the
+next client asking for the same compressed representation gets the stored
+bytes without the view being called or the representation being compressed
+again.
+
+The entity tag of a compressed representation is the entity tag of the view
+with the content coding appended, so that caches never confuse it with a
+differently encoded representation.
+
+  >>> import zope.component
+  >>> from zope.interface.verify import verifyObject
+  >>> from zope.publisher.browser import TestRequest
+
+  >>> compressionfilter = CompressionFilter(minsize = 10)
+  >>> verifyObject(interfaces.ICachingResponseFilter, compressionfilter)
+  True
+
+  >>> class CurrentETag(object):
+  ...    zope.interface.implements(interfaces.IETag)
+  ...    def __init__(self, context, request, view):
+  ...        pass
+  ...    weak = False
+  ...    etag = 'xyzzy'
+  >>> zope.component.provideAdapter(CurrentETag, (None, None, None))
+
+  >>> body = 'Hello, World!\\n' * 20
+  >>> def render(environ):
+  ...    request = TestRequest(environ = environ)
+  ...    request.response.setHeader('Content-Type', 'text/plain')
+  ...    request.response.setHeader('Content-Language', 'en')
+  ...    request.response.setHeader('ETag', '"xyzzy"')
+  ...    return request, compressionfilter.filter(None, request, None, body)
+
+Clients that don't support compression get the representation as is.
+
+  >>> request, result = render({})
+  >>> result == body
+  True
+  >>> request.response.getHeader('ETag')
+  '"xyzzy"'
+  >>> request.response.getHeader('Vary')
+  'Accept-Encoding'
+
+Otherwise the client gets the compressed representation, with its own entity
+tag.
+
+  >>> request, result = render({'HTTP_ACCEPT_ENCODING': 'deflate, gzip'})
+  >>> request.response.getHeader('Content-Encoding')
+  'gzip'
+  >>> request.response.getHeader('ETag')
+  '"xyzzy-gzip"'
+  >>> len(result) < len(body)
+  True
+  >>> import gzip, StringIO
+  >>> gzip.GzipFile(fileobj = StringIO.StringIO(result)).read() == body
+  True
+
+  >>> request, result = render(
+  ...    {'HTTP_ACCEPT_ENCODING': 'gzip;q=0.5, deflate'})
+  >>> request.response.getHeader('Content-Encoding')
+  'deflate'
+  >>> import zlib
+  >>> zlib.decompress(result) == body
+  True
+
+The next request for the compressed representation is answered from the
+cache, with the headers set by the view.
+
+  >>> request = TestRequest(environ = {'HTTP_ACCEPT_ENCODING': 'gzip'})
+  >>> cached = compressionfilter.lookup(None, request, None)
+  >>> gzip.GzipFile(fileobj = StringIO.StringIO(cached)).read() == body
+  True
+  >>> request.response.getHeader('Content-Type')
+  'text/plain'
+  >>> request.response.getHeader('Content-Language')
+  'en'
+  >>> request.response.setHeader('ETag', '"xyzzy"')
+  >>> compressionfilter.filter(None, request, None, cached) is cached
+  True
+  >>> request.response.getHeader('Content-Encoding')
+  'gzip'
+  >>> request.response.getHeader('ETag')
+  '"xyzzy-gzip"'
+
+But not if the representation has changed since, or the client doesn't want
+it compressed.
+
+  >>> CurrentETag.etag = 'plugh'
+  >>> compressionfilter.lookup(None, request, None) is None
+  True
+  >>> CurrentETag.etag = 'xyzzy'
+  >>> request = TestRequest(environ = {'HTTP_ACCEPT_ENCODING': 'identity'})
+  >>> compressionfilter.lookup(None, request, None) is None
+  True
+
+Responses setting cookies, or meant for a single client, are compressed
+but not cached, so their headers are never sent to another client.
+
+  >>> privatefilter = CompressionFilter(minsize = 10)
+  >>> request = TestRequest(environ = {'HTTP_ACCEPT_ENCODING': 'gzip'})
+  >>> request.response.setHeader('Content-Type', 'text/plain')
+  >>> request.response.setCookie('session', 'secret')
+  >>> request.response.setHeader('ETag', '"xyzzy"')
+  >>> result = privatefilter.filter(None, request, None, body)
+  >>> request.response.getHeader('Content-Encoding')
+  'gzip'
+  >>> request = TestRequest(environ = {'HTTP_ACCEPT_ENCODING': 'gzip'})
+  >>> privatefilter.lookup(None, request, None) is None
+  True
+  >>> [name for name, value in request.response.getHeaders()
+  ...  if name.lower() == 'set-cookie']
+  []
+
+  >>> request = TestRequest(environ = {'HTTP_ACCEPT_ENCODING': 'gzip'})
+  >>> request.response.setHeader('Content-Type', 'text/plain')
+  >>> request.response.setHeader('Cache-Control', 'private, max-age=60')
+  >>> request.response.setHeader('ETag', '"xyzzy"')
+  >>> result = privatefilter.filter(None, request, None, body)
+  >>> privatefilter.lookup(
+  ...    None, TestRequest(environ = {'HTTP_ACCEPT_ENCODING': 'gzip'}), None)
+
+Only the headers describing the representation are stored with it.
+
+  >>> request = TestRequest(environ = {'HTTP_ACCEPT_ENCODING': 'gzip'})
+  >>> request.response.setHeader('Content-Type', 'text/plain')
+  >>> request.response.setHeader('X-Request-Id', '42')
+  >>> request.response.setHeader('ETag', '"xyzzy"')
+  >>> result = privatefilter.filter(None, request, None, body)
+  >>> request = TestRequest(environ = {'HTTP_ACCEPT_ENCODING': 'gzip'})
+  >>> privatefilter.lookup(None, request, None) == result
+  True
+  >>> request.response.getHeader('Content-Type')
+  'text/plain'
+  >>> request.response.getHeader('X-Request-Id') is None
+  True
+
+Small representations, and representations that are not text, are never
+compressed.
+
+  >>> request = TestRequest(environ = {'HTTP_ACCEPT_ENCODING': 'gzip'})
+  >>> compressionfilter.filter(None, request, None, 'Hello')
+  'Hello'
+  >>> request.response.getHeader('Content-Encoding') is None
+  True
+
+  >>> request = TestRequest(environ = {'HTTP_ACCEPT_ENCODING': 'gzip'})
+  >>> request.response.setHeader('Content-Type', 'image/png')
+  >>> compressionfilter.filter(None, request, None, body) == body
+  True
+
+When a client revalidates its compressed copy, the `304 Not Modified`
+response carries the entity tag of the compressed representation.
+
+  >>> request = TestRequest(environ = {'HTTP_ACCEPT_ENCODING': 'gzip',
+  ...                                  'IF_NONE_MATCH': '"xyzzy-gzip"'})
+  >>> request.response.setStatus(304)
+  >>> request.response.setHeader('ETag', '"xyzzy"')
+  >>> compressionfilter.filter(None, request, None, '')
+  ''
+  >>> request.response.getHeader('ETag')
+  '"xyzzy-gzip"'
+
+A client which no longer accepts the content coding of its copy gets the
+representation again.
+
+  >>> validator = etag.ETagValidator()
+  >>> request = TestRequest(environ = {'HTTP_ACCEPT_ENCODING': 'gzip',
+  ...                                  'IF_NONE_MATCH': '"xyzzy-gzip"'})
+  >>> validator.valid(None, request, None)
+  False
+  >>> request = TestRequest(environ = {'HTTP_ACCEPT_ENCODING': 'identity',
+  ...                                  'IF_NONE_MATCH': '"xyzzy-gzip"'})
+  >>> validator.valid(None, request, None)
+  True
+
+Every variant of a negotiated view is cached with its own entity tag.
+
+  >>> class NegotiatedView(object):
+  ...    pass
+  >>> class NegotiatedETag(CurrentETag):
+  ...    zope.interface.implements(interfaces.IVariantValidatorData)
+  ...    vary = ('Accept-Language',)
+  >>> zope.component.provideAdapter(
+  ...    NegotiatedETag, (None, None, NegotiatedView), interfaces.IETag)
+
+  >>> view = NegotiatedView()
+  >>> environ = {'HTTP_ACCEPT_ENCODING': 'gzip', 'HTTP_ACCEPT_LANGUAGE': 'fr'}
+  >>> request = TestRequest(environ = environ)
+  >>> validator.updateResponse(None, request, view)
+  >>> request.response.setHeader('Content-Type', 'text/plain')
+  >>> result = compressionfilter.filter(None, request, view, body)
+  >>> request.response.getHeader('ETag')
+  '"xyzzy-v82a9e4d2-gzip"'
+  >>> compressionfilter.lookup(
+  ...    None, TestRequest(environ = environ), view) == result
+  True
+  >>> environ['HTTP_ACCEPT_LANGUAGE'] = 'en'
+  >>> compressionfilter.lookup(None, TestRequest(environ = environ), view)
+
+Cleanup
+-------
+
+  >>> zope.component.getGlobalSiteManager().unregisterAdapter(
+  ...    CurrentETag, (None, None, None), interfaces.IETag)
+  True
+  >>> zope.component.getGlobalSiteManager().unregisterAdapter(
+  ...    NegotiatedETag, (None, None, NegotiatedView), interfaces.IETag)
+  True
+
+"""
+
+import gzip
+import StringIO
+import zlib
+
+import zope.component
+import zope.interface
+
+import interfaces
+import etag
+import utils
+
+MARKER = "z3c.conditionalviews.compression"
+
+COMPRESSIBLE_TYPES = ("application/json",
+                      "application/javascript",
+                      "application/xml",
+                      "image/svg+xml",
+                      )
+
+# Headers set by the view describing the representation, stored with it and
+# restored when it is looked up. Others, like `Set-Cookie`, can be meant for
+# one client only.
+REPRESENTATION_HEADERS = ("cache-control", "content-disposition",
+                          "content-language", "content-location",
+                          "content-type", "expires", "link", "vary")
+
+def cacheable(response):
+    """
+    Return whether the representation of the `response` can be sent to
+    other clients.
+
+      >>> from zope.publisher.browser import TestRequest
+      >>> response = TestRequest().response
+      >>> cacheable(response)
+      True
+      >>> response.setHeader('Cache-Control', 'public, max-age=60')
+      >>> cacheable(response)
+      True
+      >>> response.setHeader('Cache-Control', 'no-store')
+      >>> cacheable(response)
+      False
+      >>> response = TestRequest().response
+      >>> response.setCookie('session', 'secret')
+      >>> cacheable(response)
+      False
+
+    """
+    for name, value in response.getHeaders():
+        name = name.lower()
+        if name == "set-cookie":
+            return False
+        if name == "cache-control":
+            for directive in value.split(","):
+                if directive.split("=", 1)[0].strip().lower() in (
+                        "private", "no-store"):
+                    return False
+    return True
+
+
+def compressible(contenttype):
+    contenttype = contenttype.split(";", 1)[0].strip().lower()
+    return contenttype.startswith("text/") or \
+           contenttype.endswith("+xml") or \
+           contenttype.endswith("+json") or \
+           contenttype in COMPRESSIBLE_TYPES
+
+
+def compress(body, coding):
+    if coding == "gzip":
+        data = StringIO.StringIO()
+        # Don't store the modification time so that the compressed
+        # representation only depends on the uncompressed representation.
+        gzipfile = gzip.GzipFile(
+            filename = "", mode = "wb", fileobj = data, mtime = 0)
+        gzipfile.write(body)
+        gzipfile.close()
+        return data.getvalue()
+    return zlib.compress(body)
+
+
+def acceptedCoding(request):
+    """
+    Return the supported content coding the client prefers, or None.
+
+      >>> from zope.publisher.browser import TestRequest
+      >>> def accepted(header):
+      ...    return acceptedCoding(
+      ...        TestRequest(environ = {'HTTP_ACCEPT_ENCODING': header}))
+
+      >>> acceptedCoding(TestRequest()) is None
+      True
+      >>> accepted('gzip, deflate')
+      'gzip'
+      >>> accepted('gzip;q=0.5, deflate;q=0.8')
+      'deflate'
+      >>> accepted('*')
+      'gzip'
+      >>> accepted('*, gzip;q=0')
+      'deflate'
+      >>> accepted('*;q=0, identity') is None
+      True
+      >>> accepted('br') is None
+      True
+
+    """
+    qualities = etag.codingQualities(request)
+    if not qualities:
+        return None
+
+    best = None
+    bestquality = 0.0
+    for coding in etag.CONTENT_CODINGS:
+        quality = qualities.get(coding, qualities.get("*", 0.0))
+        if quality > bestquality:
+            best, bestquality = coding, quality
+    return best
+
+
+class CompressionFilter(object):
+    zope.interface.implements(interfaces.ICachingResponseFilter)
+
+    def __init__(self, minsize = 1024, maxentries = 100,
+                 maxsize = 10 * 1024 * 1024, maxage = 3600):
+        self.minsize = minsize
+        self.cache = utils.BoundedCache(maxentries, maxsize, maxage)
+        self.etagvalidator = etag.ETagValidator()
+
+    def _key(self, context, request, view, coding):
+        # The entity tag of the variant selected by the request, as sent to
+        # the client, encoded with `coding`.
+        current = self.etagvalidator.currentETag(context, request, view)[0]
+        if current is None:
+            return None
+        # Different views can share the same entity tag.
+        return (request.getURL(), etag.encodedETag(current, coding))
+
+    def lookup(self, context, request, view):
+        if request.method not in ("GET", "HEAD") or \
+               request.get("QUERY_STRING", ""):
+            return None
+
+        coding = acceptedCoding(request)
+        if coding is None:
+            return None
+
+        key = self._key(context, request, view, coding)
+        entry = key is not None and self.cache.get(key) or None
+        if entry is None:
+            return None
+
+        body, headers = entry
+        response = request.response
+        restored = set()
+        for name, value in headers:
+            if name in restored:
+                response.addHeader(name, value)
+            else:
+                response.setHeader(name, value)
+                restored.add(name)
+        request.annotations[MARKER] = coding
+        return body
+
+    def _variantETag(self, response, coding):
+        current = response.getHeader("ETag", None)
+        if current is None:
+            return None
+        weak = current.startswith("W/")
+        variant = etag.encodedETag(current[weak and 3 or 1:-1], coding)
+        response.setHeader(
+            "ETag", '%s"%s"' % (weak and "W/" or "", variant))
+        return variant
+
+    def filter(self, context, request, view, result):
+        response = request.response
+        status = response.getStatus()
+
+        if status == 304:
+            # Tell the client which of its representations is still valid.
+            current = response.getHeader("ETag", None)
+            if current is None:
+                return result
+            current = current[current.startswith("W/") and 3 or 1:-1]
+            for match in etag.ETagValidator().parseMatchList(
+                    request, "If-None-Match"):
+                coding = etag.variantCoding(match, current)
+                if coding is not None:
+                    self._variantETag(response, coding)
+                    break
+            return result
+
+        if status not in (200, 599) or \
+               not isinstance(result, basestring) or \
+               response.getHeader("Content-Encoding", None) is not None:
+            return result
+
+        coding = request.annotations.pop(MARKER, None)
+        if coding is not None:
+            # The result was found by the lookup method.
+            utils.addVaryHeader(response, "Accept-Encoding")
+            self._variantETag(response, coding)
+            response.setHeader("Content-Encoding", coding)
+            return result
+
+        contenttype = response.getHeader("Content-Type", None)
+        if contenttype is None or not compressible(contenttype):
+            return result
+        utils.addVaryHeader(response, "Accept-Encoding")
+
+        coding = acceptedCoding(request)
+        if coding is None or len(result) < self.minsize:
+            return result
+
+        if isinstance(result, unicode):
+            if "charset=" not in contenttype.lower():
+                contenttype = "%s;charset=utf-8" % contenttype
+                response.setHeader("Content-Type", contenttype)
+            charset = contenttype.lower().split("charset=", 1)[1]
+            result = result.encode(charset.split(";", 1)[0].strip())
+
+        # Headers set by the view, restored when the body is looked up.
+        headers = [(name, value) for name, value in response.getHeaders()
+                   if name.lower() in REPRESENTATION_HEADERS]
+        self._variantETag(response, coding)
+        body = compress(result, coding)
+        key = None
+        if request.method in ("GET", "HEAD") and \
+               not request.get("QUERY_STRING", "") and cacheable(response):
+            key = self._key(context, request, view, coding)
+        if key is not None:
+            self.cache.add(key, (body, headers), len(body))
+        response.setHeader("Content-Encoding", coding)
+        return body
@@ -0,0 +1,306 @@
+##############################################################################
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+##############################################################################
+"""
+Delta encoding in HTTP, RFC 3229.
+
+A client that supports delta encoding sends an `A-IM` header listing the
+instance manipulations it understands along with the `If-None-Match` header.
+If the entity tag of the client's cached copy is still known, then instead of
+the full representation, a `226 IM Used` response containing only the
+differences is returned.
+
+The only instance manipulation supported is `diffe`, the output of the
+`diff -e` command. This is a line based diff and so is only used for textual
+representations.
+"""
+
+import difflib
+
+import zope.interface
+
+import interfaces
+import etag
+import utils
+
+IM = "diffe"
+
+def edscript(old, new):
+    """
+    Return an ed script transforming `old` into `new`, as output by the
+    `diff -e` command, or None if the difference can't be expressed as an ed
+    script.
+
+      >>> print edscript('a\\nb\\nc\\n', 'a\\nB\\nc\\nd\\n'),
+      3a
+      d
+      .
+      2c
+      B
+      .
+
+      >>> print edscript('a\\nb\\nc\\n', 'c\\n'),
+      1,2d
+
+      >>> edscript('a\\nb\\n', 'a\\nb\\n')
+      ''
+
+    Lines consisting of a single dot would end the text inserted by a
+    command, and text without a trailing newline can't be represented.
+
+      >>> edscript('a\\n', 'a\\n.\\n') is None
+      True
+      >>> edscript('a\\n', 'a\\nb') is None
+      True
+
+    """
+    if new and not new.endswith("\n"):
+        return None
+
+    oldlines = old.splitlines(True)
+    newlines = new.splitlines(True)
+    commands = []
+    matcher = difflib.SequenceMatcher(None, oldlines, newlines, False)
+    for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+        if tag == "equal":
+            continue
+
+        if i2 - i1 > 1:
+            lines = "%d,%d" % (i1 + 1, i2)
+        else:
+            lines = "%d" % i2
+
+        if tag == "delete":
+            commands.append("%sd\n" % lines)
+            continue
+
+        text = newlines[j1:j2]
+        if ".\n" in text:
+            return None
+        if tag == "insert":
+            commands.append("%da\n" % i1)
+        else:
+            commands.append("%sc\n" % lines)
+        commands.extend(text)
+        commands.append(".\n")
+
+    return "".join(commands)
+
+
+def applyEdScript(old, script):
+    """
+    Apply the ed `script` to `old`, this is what a client supporting the
+    `diffe` instance manipulation does.
+
+      >>> old = 'a\\nb\\nc\\n'
+      >>> new = 'x\\na\\nc\\nd\\ne\\n'
+      >>> applyEdScript(old, edscript(old, new)) == new
+      True
+
+    """
+    lines = old.splitlines(True)
+    script = script.splitlines(True)
+    index = 0
+    while index < len(script):
+        command = script[index].rstrip("\n")
+        index += 1
+        action = command[-1]
+        addresses = [int(address) for address in command[:-1].split(",")]
+        first, last = addresses[0], addresses[-1]
+
+        text = []
+        if action in "ac":
+            while script[index] != ".\n":
+                text.append(script[index])
+                index += 1
+            index += 1
+
+        if action == "a":
+            lines[first:first] = text
+        else:
+            lines[first - 1:last] = text
+
+    return "".join(lines)
+
+
+class DeltaStore(utils.BoundedCache):
+    """
+    Recently rendered representations are kept in memory, bounded by the
+    number of representations, their total size and their age. They are
+    keyed by their URL, since different resources can share entity tags.
+
+      >>> from zope.interface.verify import verifyObject
+      >>> store = DeltaStore(maxentries = 2, maxsize = 10, maxage = 60)
+      >>> verifyObject(interfaces.IDeltaStore, store)
+      True
+
+      >>> store.add('http://127.0.0.1/a', 'v1', 'aaa')
+      >>> store.get('http://127.0.0.1/a', 'v1')
+      'aaa'
+      >>> store.get('http://127.0.0.1/b', 'v1') is None
+      True
+
+    """
+    zope.interface.implements(interfaces.IDeltaStore)
+
+    def add(self, url, etag, body):
+        super(DeltaStore, self).add((url, etag), body, len(body))
+
+    def get(self, url, etag):
+        return super(DeltaStore, self).get((url, etag))
+
+
+class DeltaEncodingFilter(object):
+    """
+      >>> from zope.interface.verify import verifyObject
+      >>> from zope.publisher.browser import TestRequest
+
+      >>> deltafilter = DeltaEncodingFilter()
+      >>> verifyObject(interfaces.IResponseFilter, deltafilter)
+      True
+
+    When the client doesn't ask for delta encoding nothing happens, and
+    nothing is stored.
+
+      >>> request = TestRequest()
+      >>> request.response.setHeader('ETag', '"v1"')
+      >>> deltafilter.filter(None, request, None, 'a\\nb\\nc\\n')
+      'a\\nb\\nc\\n'
+      >>> deltafilter.store.get(request.getURL(), 'v1') is None
+      True
+
+    When it does, the full representation is returned the first time and
+    remembered.
+
+      >>> request = TestRequest(environ = {'A_IM': 'diffe'})
+      >>> request.response.setHeader('ETag', '"v1"')
+      >>> len(deltafilter.filter(None, request, None, 'a\\nb\\nc\\n' * 10))
+      60
+      >>> request.response.getStatus()
+      599
+
+    When the representation has changed, a client holding the previous
+    version gets the differences only.
+
+      >>> request = TestRequest(environ = {'A_IM': 'vcdiff, diffe',
+      ...                                  'IF_NONE_MATCH': '"v1"'})
+      >>> request.response.setHeader('ETag', '"v2"')
+      >>> print deltafilter.filter(None, request, None, 'a\\nb\\nc\\n' * 9),
+      28,30d
+      >>> request.response.getStatus()
+      226
+      >>> request.response.getHeader('IM')
+      'diffe'
+      >>> request.response.getHeader('Delta-Base')
+      '"v1"'
+
+    When the base version isn't known the full representation is returned.
+
+      >>> request = TestRequest(environ = {'A_IM': 'diffe',
+      ...                                  'IF_NONE_MATCH': '"v0"'})
+      >>> request.response.setHeader('ETag', '"v3"')
+      >>> len(deltafilter.filter(None, request, None, 'x\\n' * 10))
+      20
+      >>> request.response.getStatus()
+      599
+
+    As it is when the delta wouldn't be any smaller.
+
+      >>> request = TestRequest(environ = {'A_IM': 'diffe',
+      ...                                  'IF_NONE_MATCH': '"v3"'})
+      >>> request.response.setHeader('ETag', '"v4"')
+      >>> deltafilter.filter(None, request, None, 'y\\n')
+      'y\\n'
+      >>> request.response.getStatus()
+      599
+
+    Only successful responses are delta encoded.
+
+      >>> request = TestRequest(environ = {'A_IM': 'diffe',
+      ...                                  'IF_NONE_MATCH': '"v2"'})
+      >>> request.response.setHeader('ETag', '"v2"')
+      >>> request.response.setStatus(304)
+      >>> deltafilter.filter(None, request, None, '')
+      ''
+      >>> request.response.getStatus()
+      304
+
+    Resources sharing an entity tag are never delta encoded against each
+    other.
+
+      >>> request = TestRequest(environ = {'A_IM': 'diffe',
+      ...                                  'SERVER_URL': 'http://other'})
+      >>> request.response.setHeader('ETag', '"v2"')
+      >>> len(deltafilter.filter(None, request, None, 'o\\nt\\nh\\n' * 10))
+      60
+      >>> request = TestRequest(environ = {'A_IM': 'diffe',
+      ...                                  'IF_NONE_MATCH': '"v2"'})
+      >>> request.response.setHeader('ETag', '"v5"')
+      >>> print deltafilter.filter(None, request, None, 'a\\nb\\nc\\n' * 8),
+      25,27d
+      >>> request = TestRequest(environ = {'A_IM': 'diffe',
+      ...                                  'IF_NONE_MATCH': '"v2"',
+      ...                                  'SERVER_URL': 'http://other'})
+      >>> request.response.setHeader('ETag', '"v5"')
+      >>> print deltafilter.filter(None, request, None, 'o\\nt\\nh\\n' * 9),
+      28,30d
+
+    """
+    zope.interface.implements(interfaces.IResponseFilter)
+
+    def __init__(self, store = None):
+        if store is None:
+            store = DeltaStore()
+        self.store = store
+        self.etagvalidator = etag.ETagValidator()
+
+    def accepts(self, request):
+        header = request.getHeader("A-IM", None)
+        if header is None:
+            return False
+        for im in header.split(","):
+            if im.split(";", 1)[0].strip().lower() == IM:
+                return True
+        return False
+
+    def filter(self, context, request, view, result):
+        response = request.response
+        if response.getStatus() not in (200, 599) or \
+               not isinstance(result, basestring) or \
+               response.getHeader("Content-Encoding", None) is not None or \
+               not self.accepts(request):
+            return result
+
+        current = response.getHeader("ETag", None)
+        if current is None or current.startswith("W/"):
+            # Deltas can only be computed against strong entity tags.
+            return result
+        current = current[1:-1]
+        url = request.getURL()
+        self.store.add(url, current, result)
+
+        for base in self.etagvalidator.parseMatchList(
+                request, "If-None-Match"):
+            if base == current:
+                continue
+            old = self.store.get(url, base)
+            if old is None:
+                continue
+            delta = edscript(old, result)
+            if delta is None or len(delta) >= len(result):
+                continue
+
+            response.setStatus(226, "IM Used")
+            response.setHeader("IM", IM)
+            response.setHeader("Delta-Base", '"%s"' % base)
+            return delta
+
+        return result
@@ -0,0 +1,124 @@
+##############################################################################
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+##############################################################################
+"""
+Dispatch table of the validators and validator data factories of the views
+configured with the `conditional:view` directive, see `metaconfigure.py`.
+
+Entries are registered for a view class or interface. The entry of a view is
+found by walking the specifications the class of the view implements, most
+specific first, once per class.
+
+  >>> import zope.interface
+  >>> class IReport(zope.interface.Interface):
+  ...    pass
+  >>> class Report(object):
+  ...    zope.interface.implements(IReport)
+  >>> class YearlyReport(Report):
+  ...    pass
+  >>> class Page(object):
+  ...    pass
+
+  >>> register(IReport, [('http.etag', 'etag validator')], {})
+  >>> lookup(YearlyReport()).validators
+  [('http.etag', 'etag validator')]
+  >>> lookup(Page()) is None
+  True
+
+Entries registered for a class win over entries registered for the
+interfaces it implements.
+
+  >>> def etag(context, request, view):
+  ...    return 'etag of %s' % view.__class__.__name__
+  >>> register(YearlyReport, None, {interfaces.IETag: etag})
+  >>> lookup(YearlyReport()).validators is None
+  True
+  >>> queryValidatorDataFactory(YearlyReport(), interfaces.IETag)(
+  ...    None, None, YearlyReport())
+  'etag of YearlyReport'
+  >>> queryValidatorDataFactory(Report(), interfaces.IETag) is None
+  True
+
+  >>> clear()
+  >>> lookup(Report()) is None
+  True
+
+"""
+
+import zope.interface
+import zope.interface.interfaces
+from zope.security.proxy import removeSecurityProxy
+
+import interfaces
+
+class DispatchEntry(object):
+
+    def __init__(self, validators, data):
+        # (name, validator) pairs, or None for all the registered validators.
+        self.validators = validators
+        # validator data interface -> factory
+        self.data = data
+
+
+# specification of a view class or interface -> DispatchEntry
+_table = {}
+
+# view class -> DispatchEntry or None
+_resolved = {}
+
+def register(spec, validators, data):
+    """
+    Register the `validators` and validator `data` factories of the views
+    implementing `spec`, a class or an interface.
+    """
+    if not zope.interface.interfaces.IInterface.providedBy(spec):
+        spec = zope.interface.implementedBy(spec)
+    _table[spec] = DispatchEntry(validators, data)
+    _resolved.clear()
+
+
+def lookup(view):
+    """
+    Return the `DispatchEntry` of the `view`, or None.
+    """
+    if not _table:
+        return None
+    cls = removeSecurityProxy(view).__class__
+    try:
+        return _resolved[cls]
+    except KeyError:
+        pass
+    entry = None
+    for spec in zope.interface.implementedBy(cls).__sro__:
+        entry = _table.get(spec)
+        if entry is not None:
+            break
+    _resolved[cls] = entry
+    return entry
+
+
+def queryValidatorDataFactory(view, iface):
+    entry = lookup(view)
+    if entry is None:
+        return None
+    return entry.data.get(iface)
+
+
+def clear():
+    _table.clear()
+    _resolved.clear()
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:
+    pass
+else:
+    addCleanUp(clear)
@@ -15,7 +15,110 @@ import zope.component
 
 from zope.app.http.interfaces import INullResource
 
+import cas
 import interfaces
+import utils
+
+# Content codings that can be applied to a representation by this package,
+# see the compression module.
+CONTENT_CODINGS = ("gzip", "deflate")
+
+def encodedETag(etag, coding):
+    """
+    Return the entity tag of the representation with entity tag `etag`
+    encoded with the content `coding`.
+
+      >>> encodedETag('xyzzy', 'gzip')
+      'xyzzy-gzip'
+
+    """
+    return "%s-%s" % (etag, coding)
+
+
+def variantCoding(match, etag):
+    """
+    Return the content coding of the representation with entity tag `match`
+    if it is the representation with entity tag `etag` encoded by this
+    package, or None.
+
+      >>> variantCoding('xyzzy-gzip', 'xyzzy')
+      'gzip'
+      >>> variantCoding('xyzzy-deflate', 'xyzzy')
+      'deflate'
+      >>> variantCoding('xyzzy', 'xyzzy') is None
+      True
+      >>> variantCoding('xyzzy-other', 'xyzzy') is None
+      True
+
+    Entity tags ending like an encoded one are only variants of the current
+    entity tag they extend.
+
+      >>> variantCoding('report-gzip', 'report-gzip') is None
+      True
+      >>> variantCoding('report-gzip', 'xyzzy') is None
+      True
+      >>> variantCoding('report-gzip-gzip', 'report-gzip')
+      'gzip'
+
+    """
+    for coding in CONTENT_CODINGS:
+        if match == encodedETag(etag, coding):
+            return coding
+    return None
+
+
+def codingQualities(request):
+    """
+    Return the qualities of the content codings listed in the
+    `Accept-Encoding` header of the request, by coding.
+
+      >>> from zope.publisher.browser import TestRequest
+      >>> codingQualities(TestRequest())
+      {}
+      >>> sorted(codingQualities(TestRequest(environ = {
+      ...    'HTTP_ACCEPT_ENCODING': 'gzip;q=0.5, Deflate'})).items())
+      [('deflate', 1.0), ('gzip', 0.5)]
+
+    """
+    header = request.getHeader("Accept-Encoding", None)
+    if not header:
+        return {}
+
+    qualities = {}
+    for coding in header.split(","):
+        params = coding.split(";")
+        coding = params[0].strip().lower()
+        quality = 1.0
+        for param in params[1:]:
+            name, sep, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    return qualities
+
+
+def acceptsCoding(request, coding):
+    """
+    Return whether the client accepts representations encoded with the
+    content `coding`.
+
+      >>> from zope.publisher.browser import TestRequest
+      >>> acceptsCoding(TestRequest(environ = {
+      ...    'HTTP_ACCEPT_ENCODING': 'gzip'}), 'gzip')
+      True
+      >>> acceptsCoding(TestRequest(environ = {
+      ...    'HTTP_ACCEPT_ENCODING': '*, gzip;q=0'}), 'gzip')
+      False
+      >>> acceptsCoding(TestRequest(), 'gzip')
+      False
+
+    """
+    qualities = codingQualities(request)
+    return qualities.get(coding, qualities.get("*", 0.0)) > 0
+
 
 class ETagValidator(object):
     """
@@ -374,6 +477,57 @@ class ETagValidator(object):
       >>> request.response.getHeader('ETag', None) is None
       True
 
+    Content codings
+    ===============
+
+    The entity tag of a compressed representation is the entity tag of the
+    uncompressed representation with the content coding appended, see the
+    `compression` module. Both match the current entity tag, although a
+    compressed representation is only still valid for a client which accepts
+    its content coding.
+
+      >>> CurrentETag.etag = 'xyzzy'
+      >>> request = TestRequest(environ = {'IF_NONE_MATCH': '"xyzzy-gzip"',
+      ...                                  'HTTP_ACCEPT_ENCODING': 'gzip'})
+      >>> view = SimpleView(None, request)
+      >>> validator.valid(None, request, view)
+      False
+      >>> request = TestRequest(environ = {'IF_NONE_MATCH': '"xyzzy-gzip"'})
+      >>> view = SimpleView(None, request)
+      >>> validator.valid(None, request, view)
+      True
+
+      >>> request = TestRequest(environ = {'IF_MATCH': '"xyzzy-deflate"',
+      ...                                  'REQUEST_METHOD': 'PUT'})
+      >>> view = SimpleView(None, request)
+      >>> validator.valid(None, request, view)
+      True
+
+    Entity tags which merely end like the entity tag of a compressed
+    representation are compared as they are.
+
+      >>> CurrentETag.etag = 'report-gzip'
+      >>> request = TestRequest(environ = {'IF_NONE_MATCH': '"report-gzip"'})
+      >>> view = SimpleView(None, request)
+      >>> validator.valid(None, request, view)
+      False
+      >>> request = TestRequest(environ = {'IF_NONE_MATCH': '"report"',
+      ...                                  'HTTP_ACCEPT_ENCODING': 'gzip'})
+      >>> view = SimpleView(None, request)
+      >>> validator.valid(None, request, view)
+      True
+      >>> request = TestRequest(environ = {'IF_MATCH': '"report-gzip"',
+      ...                                  'REQUEST_METHOD': 'PUT'})
+      >>> view = SimpleView(None, request)
+      >>> validator.valid(None, request, view)
+      True
+      >>> request = TestRequest(environ = {'IF_MATCH': '"report"',
+      ...                                  'REQUEST_METHOD': 'PUT'})
+      >>> view = SimpleView(None, request)
+      >>> validator.valid(None, request, view)
+      False
+      >>> CurrentETag.etag = 'xyzzy'
+
     Null resources
     ==============
 
@@ -400,6 +554,44 @@ class ETagValidator(object):
       >>> validator.valid(nullresource, request, view)
       False
 
+    Variants
+    ========
+
+    Views negotiating their representation from request headers declare the
+    headers they vary on. Every variant gets its own entity tag, and the
+    headers are listed in the `Vary` header of the response.
+
+      >>> class VariantETag(CurrentETag):
+      ...    zope.interface.implements(interfaces.IVariantValidatorData)
+      ...    vary = ('Accept-Language',)
+      >>> zope.component.getGlobalSiteManager().registerAdapter(
+      ...    VariantETag, (None, IBrowserRequest, None), interfaces.IETag)
+
+      >>> request = TestRequest(environ = {'ACCEPT_LANGUAGE': 'fr'})
+      >>> view = SimpleView(None, request)
+      >>> validator.updateResponse(None, request, view)
+      >>> frenchetag = request.response.getHeader('ETag')
+      >>> frenchetag == '"%s"' % utils.variantETag(
+      ...    'xyzzy', request, ['Accept-Language'])
+      True
+      >>> request.response.getHeader('Vary')
+      'Accept-Language'
+
+    A client with the French variant can revalidate it, but not the English
+    variant.
+
+      >>> request = TestRequest(environ = {'ACCEPT_LANGUAGE': 'fr',
+      ...                                  'IF_NONE_MATCH': frenchetag})
+      >>> validator.valid(None, request, SimpleView(None, request))
+      False
+      >>> request = TestRequest(environ = {'ACCEPT_LANGUAGE': 'en',
+      ...                                  'IF_NONE_MATCH': frenchetag})
+      >>> validator.valid(None, request, SimpleView(None, request))
+      True
+
+      >>> zope.component.getGlobalSiteManager().registerAdapter(
+      ...    CurrentETag, (None, IBrowserRequest, None))
+
     Cleanup
     -------
 
@@ -410,6 +602,9 @@ class ETagValidator(object):
     """
     zope.interface.implements(interfaces.IHTTPValidator)
 
+    # Validator data used, see the prefetch module.
+    datainterface = interfaces.IETag
+
     def parseMatchList(self, request, header):
         ret = []
         matches = request.getHeader(header, None)
@@ -430,35 +625,66 @@ class ETagValidator(object):
                request.getHeader("If-Match") is not None
 
     def getDataStorage(self, context, request, view):
-        return zope.component.queryMultiAdapter(
-            (context, request, view), interfaces.IETag)
+        return utils.queryValidatorData(
+            context, request, view, self.datainterface)
 
-    def _matches(self, context, request, etag, matchset):
+    def _matches(self, context, request, etag, matchset, negotiated = False):
         if "*" in matchset:
             if INullResource.providedBy(context):
                 return False
             return True
 
-        if request.get("QUERY_STRING", "") == "" and etag in matchset:
-            return True
+        if request.get("QUERY_STRING", "") != "" or etag is None:
+            return False
+        for match in matchset:
+            if match == etag:
+                return True
+            coding = variantCoding(match, etag)
+            # The encoded representation the client has must still be
+            # acceptable to it.
+            if coding is not None and \
+                   (not negotiated or acceptsCoding(request, coding)):
+                return True
 
         return False
 
+    def currentETag(self, context, request, view):
+        """
+        Return the entity tag of the representation of the view selected by
+        the request, and whether it is weak, or `(None, False)`.
+        """
+        return self._variant(
+            request, self.getDataStorage(context, request, view))
+
+    def _variant(self, request, data):
+        etag = data is not None and data.etag or None
+        if etag is None:
+            return None, False
+        etag = utils.variantETag(etag, request, utils.varyHeaders(data))
+        return (utils.personalETag(etag, utils.principalFingerprint(request)),
+                data.weak)
+
     def valid(self, context, request, view):
-        etag = self.getDataStorage(context, request, view)
-        if etag is not None:
-            # A request can still be invalid without knowing entity tag.
-            # If-Match: "*" matches everything
-            etag = etag.etag
+        # A request can still be invalid without knowing entity tag.
+        # If-Match: "*" matches everything
+        etag = self.currentETag(context, request, view)[0]
 
         # Test the most common validator first.
         matchset = self.parseMatchList(request, "If-None-Match")
         if matchset:
-            return not self._matches(context, request, etag, matchset)
+            # The representation the client has must still be acceptable.
+            return not self._matches(
+                context, request, etag, matchset, negotiated = True)
 
         matchset = self.parseMatchList(request, "If-Match")
         if matchset:
-            return self._matches(context, request, etag, matchset)
+            if not self._matches(context, request, etag, matchset):
+                return False
+            if "*" not in matchset and \
+                   request.method not in ("GET", "HEAD"):
+                # The content must not change before the write commits.
+                cas.guard(context, request)
+            return True
 
         # Always default to True, this can happen if the requests contains
         # invalid data.
@@ -478,9 +704,13 @@ class ETagValidator(object):
     def updateResponse(self, context, request, view):
         if request.response.getHeader("ETag", None) is None and \
                request.get("QUERY_STRING", "") == "":
-            etag = self.getDataStorage(context, request, view)
-            weak = etag and etag.weak
-            etag = etag and etag.etag
+            data = self.getDataStorage(context, request, view)
+            vary = utils.varyHeaders(data)
+            if vary:
+                utils.addVaryHeader(request.response, *vary)
+            etag, weak = self._variant(request, data)
+            if etag and utils.principalFingerprint(request) is not None:
+                utils.setPrivate(request.response)
             if etag:
                 if weak:
                     request.response.setHeader("ETag", 'W/"%s"' % etag)
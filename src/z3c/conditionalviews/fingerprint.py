@@ -0,0 +1,177 @@
+##############################################################################
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+##############################################################################
+"""
+Conditional views for authenticated principals.
+
+Views rendered differently for every principal can't share an entity tag,
+or a principal logging in with the browser of another one would be told
+that the representation rendered for the other principal is still valid.
+When the `PrincipalFingerprint` utility is registered, see
+`fingerprint.zcml`, the entity tag of every view requested by an
+authenticated principal is composed with a fingerprint of the principal,
+and the response is marked `Cache-Control: private`, so that shared caches
+don't keep it. The `If-Modified-Since` header isn't evaluated for these
+requests, since a date doesn't tell which principal a representation was
+rendered for.
+
+The fingerprint is computed from the id and groups of the principal, once
+per request, and kept for every principal for a few minutes.
+
+  >>> from zope.interface.verify import verifyObject
+  >>> from zope.publisher.browser import TestRequest
+  >>> from zope.authentication.interfaces import IUnauthenticatedPrincipal
+  >>> from z3c.conditionalviews import etag, lastmodification
+
+  >>> class Principal(object):
+  ...    def __init__(self, id, groups = ()):
+  ...        self.id, self.groups = id, groups
+  >>> class Anonymous(Principal):
+  ...    zope.interface.implements(IUnauthenticatedPrincipal)
+
+  >>> def makeRequest(principal, **environ):
+  ...    request = TestRequest(environ = environ)
+  ...    request.setPrincipal(principal)
+  ...    return request
+
+  >>> fingerprinter = PrincipalFingerprint()
+  >>> verifyObject(interfaces.IPrincipalFingerprint, fingerprinter)
+  True
+  >>> fingerprinter.fingerprint(makeRequest(None)) is None
+  True
+  >>> fingerprinter.fingerprint(makeRequest(Anonymous('anonymous'))) is None
+  True
+
+  >>> alice = Principal('alice', ['editors'])
+  >>> bob = Principal('bob', ['editors'])
+  >>> fingerprint = fingerprinter.fingerprint(makeRequest(alice))
+  >>> len(fingerprint)
+  8
+  >>> fingerprinter.fingerprint(makeRequest(bob)) != fingerprint
+  True
+
+The fingerprint of a principal is only computed again once it has expired.
+
+  >>> alice.groups = ['editors', 'reviewers']
+  >>> fingerprinter.fingerprint(makeRequest(alice)) == fingerprint
+  True
+  >>> fingerprinter.cache.maxage = -1
+  >>> fingerprinter.fingerprint(makeRequest(alice)) != fingerprint
+  True
+
+Views rendered the same for all the principals of the same groups can
+share the fingerprint of the groups.
+
+  >>> groups = PrincipalFingerprint(scope = 'groups')
+  >>> groups.fingerprint(makeRequest(Principal('carol', ['editors']))) == \\
+  ...    groups.fingerprint(makeRequest(bob))
+  True
+
+Validation
+==========
+
+  >>> class ETag(object):
+  ...    zope.interface.implements(interfaces.IETag)
+  ...    def __init__(self, context, request, view):
+  ...        pass
+  ...    weak, etag = False, 'xyzzy'
+  >>> gsm = zope.component.getGlobalSiteManager()
+  >>> gsm.registerAdapter(ETag, (None, None, None))
+  >>> gsm.registerUtility(fingerprinter)
+  >>> validator = etag.ETagValidator()
+
+  >>> request = makeRequest(bob)
+  >>> validator.updateResponse(None, request, None)
+  >>> bobetag = request.response.getHeader('ETag')
+  >>> bobetag == '"xyzzy-p%s"' % fingerprinter.fingerprint(request)
+  True
+  >>> request.response.getHeader('Cache-Control')
+  'private'
+
+Only the principal the representation was rendered for can revalidate it.
+
+  >>> request = makeRequest(bob, IF_NONE_MATCH = bobetag)
+  >>> validator.valid(None, request, None)
+  False
+  >>> request = makeRequest(alice, IF_NONE_MATCH = bobetag)
+  >>> validator.valid(None, request, None)
+  True
+
+Anonymous requests are validated as before.
+
+  >>> request = makeRequest(None)
+  >>> validator.updateResponse(None, request, None)
+  >>> request.response.getHeader('ETag')
+  '"xyzzy"'
+  >>> request.response.getHeader('Cache-Control') is None
+  True
+
+  >>> request = makeRequest(
+  ...    bob, IF_MODIFIED_SINCE = 'Sat, 06 Jan 2007 12:42:12 GMT')
+  >>> lastmodification.ModifiedSinceValidator().evaluate(None, request, None)
+  False
+
+Cleanup
+-------
+
+  >>> gsm.unregisterAdapter(ETag, (None, None, None))
+  True
+  >>> gsm.unregisterUtility(fingerprinter)
+  True
+
+"""
+
+import hashlib
+
+import zope.interface
+from zope.authentication.interfaces import IUnauthenticatedPrincipal
+
+import interfaces
+import utils
+
+FINGERPRINT_KEY = "z3c.conditionalviews.fingerprint"
+
+_marker = object()
+
+class PrincipalFingerprint(object):
+    zope.interface.implements(interfaces.IPrincipalFingerprint)
+
+    def __init__(self, scope = "principal", maxentries = 10000, maxage = 300):
+        # "principal", or "groups" for the principals of the same groups to
+        # share their fingerprint.
+        self.scope = scope
+        # Group memberships changing are noticed after `maxage` seconds.
+        self.cache = utils.BoundedCache(maxentries, maxentries, maxage)
+
+    def fingerprint(self, request):
+        annotations = request.annotations
+        fingerprint = annotations.get(FINGERPRINT_KEY, _marker)
+        if fingerprint is _marker:
+            fingerprint = annotations[FINGERPRINT_KEY] = self._fingerprint(
+                getattr(request, "principal", None))
+        return fingerprint
+
+    def _fingerprint(self, principal):
+        if principal is None or \
+               IUnauthenticatedPrincipal.providedBy(principal):
+            return None
+        fingerprint = self.cache.get(principal.id)
+        if fingerprint is None:
+            fingerprint = self.compute(principal)
+            self.cache.add(principal.id, fingerprint, 1)
+        return fingerprint
+
+    def compute(self, principal):
+        parts = sorted(getattr(principal, "groups", None) or ())
+        if self.scope != "groups":
+            parts.insert(0, principal.id)
+        return hashlib.md5(
+            u"\n".join(parts).encode("utf-8")).hexdigest()[:8]
@@ -0,0 +1,311 @@
+##############################################################################
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+##############################################################################
+"""
+Caching the fragments of a page separately.
+
+Pages are often mostly static, with one or two regions that change all the
+time. A fragmented view is rendered from named `IFragment` adapters of the
+context, request and view, each with its own validator data. A fragment is
+only rendered again when its validator data changes, and the entity tag of
+the page is composed from the validator data of all its fragments, so a
+conditional request is answered without rendering any of them.
+
+From a page template, a fragment is rendered with
+`python:view.renderFragment('news')`.
+
+  >>> from zope.publisher.browser import TestRequest
+  >>> from zope.publisher.interfaces.browser import IBrowserRequest
+  >>> import z3c.conditionalviews
+  >>> from z3c.conditionalviews import etag
+
+  >>> class Content(object):
+  ...    _p_oid = '\\x00' * 7 + '\\x2a'
+  ...    news = 'Nothing happened'
+
+  >>> rendered = []
+  >>> class Chrome(Fragment):
+  ...    public = True
+  ...    def render(self):
+  ...        rendered.append(self.__name__)
+  ...        return '<h1>Site</h1>'
+  >>> class News(Fragment):
+  ...    def render(self):
+  ...        rendered.append(self.__name__)
+  ...        return '<p>%s</p>' % self.context.news
+
+  >>> class ChromeETag(object):
+  ...    zope.interface.implements(interfaces.IETag)
+  ...    def __init__(self, context, request, fragment):
+  ...        pass
+  ...    weak, etag = False, 'chrome-1'
+  >>> class NewsETag(object):
+  ...    zope.interface.implements(interfaces.IETag)
+  ...    def __init__(self, context, request, fragment):
+  ...        self.etag = str(hash(context.news))
+  ...    weak = False
+
+  >>> class Page(FragmentedView):
+  ...    __name__ = 'index.html'
+  ...    fragmentNames = ('chrome', 'news')
+  ...    @z3c.conditionalviews.ConditionalView
+  ...    def __call__(self):
+  ...        return self.renderFragment('chrome') + \\
+  ...               self.renderFragment('news')
+
+  >>> gsm = zope.component.getGlobalSiteManager()
+  >>> for name, factory, data in (('chrome', Chrome, ChromeETag),
+  ...                             ('news', News, NewsETag)):
+  ...    gsm.registerAdapter(factory, (Content, IBrowserRequest, Page),
+  ...                        interfaces.IFragment, name = name)
+  ...    gsm.registerAdapter(data, (Content, None, factory))
+  >>> gsm.registerAdapter(FragmentedViewETag, provided = interfaces.IETag)
+  >>> gsm.registerUtility(etag.ETagValidator(), name = 'http.etag')
+  >>> cache = FragmentCache()
+  >>> gsm.registerUtility(cache)
+
+  >>> content = Content()
+  >>> request = TestRequest()
+  >>> Page(content, request)()
+  '<h1>Site</h1><p>Nothing happened</p>'
+  >>> rendered
+  ['chrome', 'news']
+  >>> pageetag = request.response.getHeader('ETag')
+  >>> pageetag
+  '"..."'
+
+The page is validated without rendering any of its fragments.
+
+  >>> request = TestRequest(environ = {'IF_NONE_MATCH': pageetag})
+  >>> Page(content, request)()
+  ''
+  >>> request.response.getStatus()
+  304
+  >>> rendered
+  ['chrome', 'news']
+
+When the news change, so does the entity tag of the page, but only the news
+are rendered again.
+
+  >>> content.news = 'Something happened'
+  >>> request = TestRequest(environ = {'IF_NONE_MATCH': pageetag})
+  >>> Page(content, request)()
+  '<h1>Site</h1><p>Something happened</p>'
+  >>> request.response.getHeader('ETag') != pageetag
+  True
+  >>> rendered
+  ['chrome', 'news', 'news']
+
+Fragments are cached for each principal, unless they are declared
+`public`.
+
+  >>> class Principal(object):
+  ...    def __init__(self, id):
+  ...        self.id = id
+  >>> for id in ('bob', 'alice', 'bob'):
+  ...    request = TestRequest()
+  ...    request.setPrincipal(Principal(id))
+  ...    result = Page(content, request)()
+  >>> rendered
+  ['chrome', 'news', 'news', 'news', 'news']
+
+A page with a fragment without validator data gets no entity tag, and the
+fragment is rendered every time.
+
+  >>> gsm.unregisterAdapter(NewsETag, (Content, None, News))
+  True
+  >>> request = TestRequest()
+  >>> Page(content, request)()
+  '<h1>Site</h1><p>Something happened</p>'
+  >>> request.response.getHeader('ETag') is None
+  True
+  >>> rendered
+  ['chrome', 'news', 'news', 'news', 'news', 'news']
+
+Cleanup
+-------
+
+  >>> gsm.unregisterAdapter(ChromeETag, (Content, None, Chrome))
+  True
+  >>> for name, factory in (('chrome', Chrome), ('news', News)):
+  ...    gsm.unregisterAdapter(factory, (Content, IBrowserRequest, Page),
+  ...                          interfaces.IFragment, name = name)
+  True
+  True
+  >>> gsm.unregisterAdapter(FragmentedViewETag, provided = interfaces.IETag)
+  True
+  >>> gsm.unregisterUtility(name = 'http.etag',
+  ...    provided = interfaces.IHTTPValidator)
+  True
+  >>> gsm.unregisterUtility(cache)
+  True
+
+"""
+
+import hashlib
+import sys
+
+import zope.component
+import zope.interface
+import zope.publisher.browser
+import zope.publisher.interfaces.http
+
+import interfaces
+import utils
+
+def fragmentTag(context, request, fragment):
+    """
+    Return a string describing the validator data of the `fragment`, or
+    None if it has none.
+
+      >>> from zope.publisher.browser import TestRequest
+      >>> fragmentTag(None, TestRequest(), None) is None
+      True
+
+    """
+    data = utils.queryValidatorData(
+        context, request, fragment, interfaces.IETag)
+    if data is not None and data.etag is not None:
+        etag = utils.variantETag(data.etag, request, utils.varyHeaders(data))
+        return '%s"%s"' % (data.weak and "W/" or "", etag)
+    data = utils.queryValidatorData(
+        context, request, fragment, interfaces.ILastModificationDate)
+    if data is not None and data.lastmodified is not None:
+        # Dates are only weak validators.
+        return "W/%s" % data.lastmodified.isoformat()
+    return None
+
+
+def fragmentKey(context, request, fragment):
+    key = utils.contentKey(context)
+    if key is None:
+        return None
+    key = (key, utils.viewKey(fragment))
+    if not getattr(fragment, "public", False):
+        principal = getattr(request, "principal", None)
+        key += (getattr(principal, "id", None),
+                utils.principalFingerprint(request))
+    return key
+
+
+def renderFragment(context, request, fragment):
+    """
+    Render the `fragment`, or return the rendered fragment from the
+    `IFragmentCache` if its validator data hasn't changed.
+    """
+    cache = zope.component.queryUtility(interfaces.IFragmentCache)
+    key = cache is not None and \
+          fragmentKey(context, request, fragment) or None
+    tag = key is not None and fragmentTag(context, request, fragment) or None
+    if tag is None:
+        return fragment.render()
+    # Every variant of the fragment is kept.
+    vary = utils.varyHeaders(utils.queryValidatorData(
+        context, request, fragment, interfaces.IETag))
+    key += tuple([request.getHeader(name, None) for name in vary])
+    result = cache.get(key, tag)
+    if result is None:
+        result = fragment.render()
+        cache.set(key, tag, result)
+    return result
+
+
+class Fragment(object):
+    """
+    Base class of the fragments of a view, which only have to implement the
+    `render` method of `IFragment`.
+    """
+    zope.interface.implements(interfaces.IFragment)
+
+    __name__ = None
+    public = False
+
+    def __init__(self, context, request, view):
+        self.context = context
+        self.request = request
+        self.view = view
+
+
+class FragmentedView(zope.publisher.browser.BrowserView):
+    """
+    View rendered from the `IFragment`s named in `fragmentNames`.
+    """
+    zope.interface.implements(interfaces.IFragmentedView)
+
+    fragmentNames = ()
+
+    def fragment(self, name):
+        fragment = zope.component.getMultiAdapter(
+            (self.context, self.request, self), interfaces.IFragment,
+            name = name)
+        if fragment.__name__ is None:
+            fragment.__name__ = name
+        return fragment
+
+    def fragments(self):
+        return [self.fragment(name) for name in self.fragmentNames]
+
+    def renderFragment(self, name):
+        return renderFragment(self.context, self.request, self.fragment(name))
+
+
+class FragmentCache(object):
+    zope.interface.implements(interfaces.IFragmentCache)
+
+    def __init__(self, maxentries = 1000, maxsize = 10 * 1024 * 1024):
+        # Fragments are replaced when their validator data changes.
+        self.cache = utils.BoundedCache(maxentries, maxsize,
+                                        maxage = sys.maxint)
+
+    def get(self, key, tag, default = None):
+        entry = self.cache.get(key)
+        if entry is None or entry[0] != tag:
+            return default
+        return entry[1]
+
+    def set(self, key, tag, result):
+        self.cache.add(key, (tag, result), len(result))
+
+
+class FragmentedViewETag(object):
+    """
+    Entity tag of a fragmented view, composed from the validator data of
+    its fragments. It is weak if the validator data of any fragment is
+    weak, varies on the request headers any fragment varies on, and there is
+    none if any fragment has no validator data.
+    """
+    zope.interface.implements(interfaces.IETag,
+                              interfaces.IVariantValidatorData)
+    zope.component.adapts(zope.interface.Interface,
+                          zope.publisher.interfaces.http.IHTTPRequest,
+                          interfaces.IFragmentedView)
+
+    weak = False
+    etag = None
+    vary = ()
+
+    def __init__(self, context, request, view):
+        tags = []
+        vary = []
+        for fragment in view.fragments():
+            tag = fragmentTag(context, request, fragment)
+            if tag is None:
+                return
+            for name in utils.varyHeaders(utils.queryValidatorData(
+                    context, request, fragment, interfaces.IETag)):
+                if name not in vary:
+                    vary.append(name)
+            tags.append("%s %s" % (fragment.__name__, tag))
+            if tag.startswith("W/"):
+                self.weak = True
+        self.vary = tuple(vary)
+        self.etag = hashlib.md5(
+            "\n".join(["%s %s" % utils.viewKey(view)] + tags)).hexdigest()
@@ -31,6 +31,20 @@ class IETag(interface.Interface):
     """)
 
 
+class ITimestampedETag(IETag):
+    """
+    An entity tag computed from the state of the view at a known time, from
+    which the last modification date of the view can be synthesized, see
+    `z3c.conditionalviews.adapters.SynthesizedLastModificationDate`.
+    """
+
+    timestamp = schema.Datetime(
+        title = u"Timestamp",
+        description = u"The time the state the entity tag was computed " \
+                      u"from was last changed.",
+        required = False)
+
+
 class ILastModificationDate(interface.Interface):
     """
     Used by the ModificationSinceValidator to adapt a view in order to
@@ -44,6 +58,37 @@ class ILastModificationDate(interface.Interface):
         required = False)
 
 
+class IVariantValidatorData(interface.Interface):
+    """
+    Validator data, like an `IETag` or `ILastModificationDate`, of a view
+    whose representation is negotiated from request headers, like
+    `Accept-Language`.
+
+    The entity tag of every variant is computed from the entity tag of the
+    view and the values of these headers, and the headers are listed in the
+    `Vary` header of the response.
+    """
+
+    vary = interface.Attribute("""
+    Sequence of the names of the request headers the representation varies
+    on.
+    """)
+
+
+class IPrincipalFingerprint(interface.Interface):
+    """
+    Fingerprint of the authenticated principal of a request, composed into
+    the entity tags of all views so that every principal revalidates its
+    own representations, which are only cached privately.
+    """
+
+    def fingerprint(request):
+        """
+        Return a short string identifying the principal of the request, or
+        None if the request isn't authenticated.
+        """
+
+
 class IHTTPValidator(interface.Interface):
     """
     This adapter is responsible for validating a HTTP request against one
@@ -102,3 +147,439 @@ class IHTTPValidator(interface.Interface):
         the current data needed to invalid a request the next time they
         request the adapted view.
         """
+
+
+class IPurgeDispatcher(interface.Interface):
+    """
+    Tells a fronting HTTP cache to drop all the responses tagged with
+    some surrogate keys.
+
+    Keys are collected during a transaction and only sent to the cache once
+    the transaction has been committed, so the cache is never told to purge
+    content that was later rolled back.
+    """
+
+    def queue(keys):
+        """
+        Queue the surrogate `keys` to be purged when the current transaction
+        is successfully committed. Duplicate keys are only purged once.
+        """
+
+    def purge(keys):
+        """
+        Send the surrogate `keys` to the cache now, batching them into as
+        few requests as possible.
+        """
+
+
+class IAggregateValidatorData(interface.Interface):
+    """
+    Validator data of a container that changes whenever any object contained
+    in it, directly or indirectly, changes.
+
+    This data is maintained incrementally as objects are added, modified and
+    removed so that it can be read without loading any of the children.
+    """
+
+    digest = interface.Attribute("""
+    A rolling digest that changes each time the contents of the container
+    changes.
+    """)
+
+    lastmodified = schema.Datetime(
+        title = u"Last modification date",
+        description = u"The most recent modification date of the contents.",
+        required = False)
+
+    def update(token, mtime):
+        """
+        Record a change to the contents of the container.
+
+        `token` is a string describing the change and is folded into the
+        digest. `mtime` is the modification date of the change.
+        """
+
+
+class IModificationIndex(interface.Interface):
+    """
+    Index of the paths of all content objects ordered by the commit which
+    last modified them.
+
+    This allows a client that keeps a copy of many resources to find out in
+    one request which of them changed since it last synchronized.
+    """
+
+    def index(path, deleted = False):
+        """
+        Record that the object at `path` was modified by the current
+        transaction. If `deleted` is True then the object, and anything below
+        it, was removed. The change is numbered when the transaction
+        commits.
+        """
+
+    def changedSince(since, token = None, batchsize = 100):
+        """
+        Return a tuple `(changes, token, more)` where `changes` is a list of
+        `(mtime, path, deleted)` tuples of at most `batchsize` objects
+        modified by the transactions committed at or after `since`, given in
+        seconds since the epoch, in the order they were committed. `mtime`
+        is the time of the commit.
+
+        `token` is an opaque string that is passed back in to return the next
+        batch of changes, or to return only the changes committed since the
+        last batch was returned. `more` is True if there are more changes to
+        return.
+        """
+
+
+class IResponseFilter(interface.Interface):
+    """
+    Utility given the chance to transform the result of a conditional view.
+
+    After the `updateResponse` method of every `IHTTPValidator` has been
+    called, the result of the view is passed through all the registered
+    response filters, in the order of their names.
+    """
+
+    def filter(context, request, view, result):
+        """
+        Return the result to send to the client, which is `result` if this
+        filter does not apply to the request.
+
+        This method is called for invalid requests as well, in which case
+        the result is an empty string.
+        """
+
+
+class IDeltaStore(interface.Interface):
+    """
+    Bounded store of recently rendered bodies keyed by their URL and entity
+    tag, used to compute deltas against the version cached by a client.
+    """
+
+    def add(url, etag, body):
+        """
+        Store `body` as the representation of `url` with the entity tag
+        `etag`.
+        """
+
+    def get(url, etag):
+        """
+        Return the representation of `url` with entity tag `etag`, or None if
+        it is no longer available.
+        """
+
+
+class ICachingResponseFilter(IResponseFilter):
+    """
+    Response filter that can return a previously filtered result for a
+    valid request without the view being called at all.
+    """
+
+    def lookup(context, request, view):
+        """
+        Return the cached result to send to the client for this valid
+        request, or None if the view must be called.
+
+        When a cached result is returned, it is still passed to the
+        `filter` method of all the response filters, including this one.
+        """
+
+
+class IStaleWhileRevalidateView(interface.Interface):
+    """
+    Marker of the views whose last response may be served stale, while they
+    are rendered again in the background, by the `http.asyncrevalidate`
+    response filter.
+    """
+
+
+class IWSGIResource(interface.Interface):
+    """
+    Validator data of the resource at a path, as returned by the lookup
+    callable of the WSGI middleware.
+    """
+
+    etag = interface.Attribute("""
+    The current entity tag of the resource, or None.
+    """)
+
+    weak = interface.Attribute("""
+    Boolean value indicated that the entity tag is weak.
+    """)
+
+    lastmodified = schema.Datetime(
+        title = u"Last modification date",
+        description = u"Indicates the last time this resource changed.",
+        required = False)
+
+
+class IWSGIRequest(interface.Interface):
+    """
+    Lightweight request used by the WSGI middleware to run the validators
+    against a WSGI environment.
+    """
+
+    method = interface.Attribute("""
+    The request method.
+    """)
+
+    response = interface.Attribute("""
+    The response, supporting the `getStatus`, `setStatus`, `getHeader`
+    and `setHeader` methods.
+    """)
+
+    def getHeader(name, default = None):
+        """
+        Return the value of the request header `name`.
+        """
+
+    def get(key, default = None):
+        """
+        Return the value of `key` in the WSGI environment.
+        """
+
+
+class IValidatorDataFetcher(interface.Interface):
+    """
+    Fetch the validator data needed to validate a request in advance.
+
+    Validators declaring the validator data they use in a `datainterface`
+    attribute find the fetched data in the request, see
+    `z3c.conditionalviews.utils.queryValidatorData`.
+    """
+
+    def fetch(context, request, view, validators):
+        """
+        Fetch the validator data of all the `validators` evaluating the
+        request, and return the validators to validate the request with.
+
+        A validator whose data couldn't be fetched in time can be replaced
+        by a validator considering the request valid.
+        """
+
+
+class IValidatorDataCache(interface.Interface):
+    """
+    In process cache of validator data, keyed by the content the data was
+    computed from.
+
+    Every process has its own cache, so when content changes all the
+    processes must be told to invalidate it, see `IInvalidationBus`.
+    """
+
+    generation = interface.Attribute("""
+    Counter incremented every time data is invalidated.
+    """)
+
+    def get(key, entry, default = None):
+        """
+        Return the validator data `entry` cached for the content `key`.
+        """
+
+    def set(key, entry, data, generation = None):
+        """
+        Cache the validator data `entry` for the content `key`.
+
+        If `generation` is given and data has been invalidated since the
+        cache was at this generation, the data might already be stale and
+        is not cached.
+        """
+
+    def invalidate(keys):
+        """
+        Drop all the validator data cached for the content `keys`.
+        """
+
+    def flush():
+        """
+        Drop all the cached validator data.
+        """
+
+
+class IValidatorDataPrecomputer(interface.Interface):
+    """
+    Computes the validator data of modified content in the background, once
+    the transaction modifying it has committed, and caches it in the
+    `IValidatorDataCache`.
+    """
+
+    def queue(ob):
+        """
+        Compute the validator data of the persistent object `ob` if the
+        current transaction commits.
+        """
+
+
+class IInvalidationTransport(interface.Interface):
+    """
+    Carries invalidation messages between the processes of a cluster.
+    Delivery is not guaranteed.
+    """
+
+    def send(data):
+        """
+        Send the message `data` to all the other processes.
+        """
+
+    def receive(timeout):
+        """
+        Return the next message sent by another process, or None if no
+        message arrived within `timeout` seconds.
+        """
+
+    def close():
+        """
+        Stop sending and receiving messages.
+        """
+
+
+class IInvalidationBus(interface.Interface):
+    """
+    Tells all the processes of a cluster to invalidate the validator data
+    cached for some content.
+
+    Messages are numbered so that a process that misses a message can detect
+    it, in which case it flushes its whole cache.
+    """
+
+    def queue(keys):
+        """
+        Queue the content `keys` to be invalidated in every process when the
+        current transaction is successfully committed.
+        """
+
+    def publish(keys):
+        """
+        Invalidate the content `keys` in every process now.
+        """
+
+    def receive(data):
+        """
+        Process a message received from another process.
+        """
+
+
+class IValidationMetrics(interface.Interface):
+    """
+    Records how requests to conditional views are answered, and what the
+    validators cost.
+    """
+
+    def instrument(validators):
+        """
+        Return the validators of the (name, validator) pairs
+        `validators`, wrapped so that the calls made to them are measured.
+        """
+
+    def record(view, status, rendertime, result):
+        """
+        Record the answer to a request to `view`.
+
+        `status` is the status of an invalid request, or None. `rendertime`
+        is the number of seconds it took to call the view, or None if the
+        view wasn't called. `result` is the body of the response.
+        """
+
+    def count(name):
+        """
+        Count an event, like a conflicting write answered without a retry.
+        """
+
+    def collect():
+        """
+        Return a list of (name, labels, value) samples for all the metrics
+        recorded so far by all threads. `labels` is a sorted tuple of
+        (name, value) pairs.
+        """
+
+
+class IValidationTracer(interface.Interface):
+    """
+    Decides which requests to conditional views are traced.
+    """
+
+    def start(request, view):
+        """
+        Return a new `ITrace` for the request, or None if the request is not
+        to be traced.
+        """
+
+
+class ITrace(interface.Interface):
+    """
+    Records the spans, the timed steps, of the validation of a request.
+    """
+
+    def span(name, **attributes):
+        """
+        Return a context manager timing the step `name` of the validation.
+        """
+
+    def run(func, *args, **kw):
+        """
+        Call `func`, profiling it if asked to, and return its result.
+        """
+
+    def finish():
+        """
+        Finish the trace and export the recorded spans.
+        """
+
+
+class IFragment(interface.Interface):
+    """
+    A region of a page, like a viewlet, that is cached separately from the
+    rest of the page.
+
+    The validator data of a fragment is looked up like the data of a view,
+    by adapting `(context, request, fragment)` to `IETag` or
+    `ILastModificationDate`, and it is only rendered again when this data
+    changes.
+    """
+
+    __name__ = interface.Attribute("""
+    The name of the fragment.
+    """)
+
+    public = interface.Attribute("""
+    Boolean value indicating that the fragment is rendered the same for all
+    the principals, so one rendering of it is cached for all of them.
+    Other fragments are cached for each principal.
+    """)
+
+    def render():
+        """
+        Return the rendered fragment.
+        """
+
+
+class IFragmentedView(interface.Interface):
+    """
+    A view rendered from fragments. The entity tag of the view is composed
+    from the validator data of its fragments, see
+    `z3c.conditionalviews.fragments.FragmentedViewETag`.
+    """
+
+    def fragments():
+        """
+        Return the `IFragment`s of the view.
+        """
+
+
+class IFragmentCache(interface.Interface):
+    """
+    In process cache of rendered fragments, keyed by the validator data
+    they were rendered with.
+    """
+
+    def get(key, tag, default = None):
+        """
+        Return the fragment `key` rendered with the validator data `tag`.
+        """
+
+    def set(key, tag, result):
+        """
+        Cache the fragment `key` rendered with the validator data `tag`,
+        replacing any fragment rendered with different validator data.
+        """
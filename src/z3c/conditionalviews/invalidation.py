@@ -0,0 +1,650 @@
+##############################################################################
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+##############################################################################
+"""
+Caching validator data in process, and invalidating it in all the processes
+of a cluster when the content changes.
+
+Every process keeps its own `ValidatorDataCache`. When content changes, the
+data cached for it, and for all its parents, is invalidated at once in the
+current process, and again in all processes once the transaction commits.
+The other processes are told through an `InvalidationBus`.
+
+  >>> import transaction
+  >>> import zope.component.event
+  >>> import zope.lifecycleevent
+  >>> from zope.publisher.browser import TestRequest
+  >>> from z3c.conditionalviews import etag
+
+  >>> class Content(object):
+  ...    def __init__(self, oid, parent = None):
+  ...        self._p_oid = oid
+  ...        self.__parent__ = parent
+  >>> folder = Content('\\x00' * 7 + '\\x01')
+  >>> content = Content('\\x00' * 7 + '\\x02', folder)
+
+  >>> computed = []
+  >>> class ContentETag(object):
+  ...    zope.interface.implements(interfaces.IETag)
+  ...    def __init__(self, context, request, view):
+  ...        computed.append(context)
+  ...    weak = False
+  ...    etag = 'xyzzy'
+
+  >>> gsm = zope.component.getGlobalSiteManager()
+  >>> gsm.registerAdapter(ContentETag, (None, None, None))
+  >>> cache = ValidatorDataCache()
+  >>> gsm.registerUtility(cache)
+  >>> gsm.registerHandler(zope.component.event.objectEventNotify)
+  >>> gsm.registerHandler(contentModified, (None,
+  ...    zope.lifecycleevent.interfaces.IObjectModifiedEvent))
+
+Once cached, the entity tag of the content is no longer computed.
+
+  >>> validator = etag.ETagValidator()
+  >>> validator.getDataStorage(content, TestRequest(), None).etag
+  'xyzzy'
+  >>> validator.getDataStorage(content, TestRequest(), None).etag
+  'xyzzy'
+  >>> len(computed)
+  1
+
+Until the content or its contents are modified.
+
+  >>> zope.lifecycleevent.modified(content)
+  >>> validator.getDataStorage(content, TestRequest(), None).etag
+  'xyzzy'
+  >>> len(computed)
+  2
+
+Requests that could be modifying the content don't use the cache.
+
+  >>> request = TestRequest(environ = {'REQUEST_METHOD': 'PUT'})
+  >>> validator.getDataStorage(content, request, None).etag
+  'xyzzy'
+  >>> len(computed)
+  3
+
+Requests reading the content before the transaction modifying it commits
+cache the data computed before the modification again, so it is
+invalidated once more when the transaction commits.
+
+  >>> transaction.commit()
+  >>> validator.getDataStorage(content, TestRequest(), None).etag
+  'xyzzy'
+  >>> len(computed)
+  4
+
+The `ConditionalPublication` records the generation of the cache when a
+request starts, and data computed by a request that started before the
+content was modified is not cached either.
+
+  >>> from z3c.conditionalviews import ConditionalPublication
+  >>> class Publication(object):
+  ...    def __getattr__(self, name):
+  ...        return lambda *args: None
+  >>> request = TestRequest()
+  >>> ConditionalPublication(Publication()).beforeTraversal(request)
+  >>> request.annotations[utils.GENERATION_KEY] == cache.generation
+  True
+
+  >>> zope.lifecycleevent.modified(content)
+  >>> transaction.commit()
+  >>> validator.getDataStorage(content, request, None).etag
+  'xyzzy'
+  >>> validator.getDataStorage(content, TestRequest(), None).etag
+  'xyzzy'
+  >>> len(computed)
+  6
+  >>> validator.getDataStorage(content, TestRequest(), None).etag
+  'xyzzy'
+  >>> len(computed)
+  6
+
+Cleanup
+-------
+
+  >>> gsm.unregisterAdapter(ContentETag, (None, None, None))
+  True
+  >>> gsm.unregisterUtility(cache)
+  True
+  >>> gsm.unregisterHandler(zope.component.event.objectEventNotify)
+  True
+  >>> gsm.unregisterHandler(contentModified, (None,
+  ...    zope.lifecycleevent.interfaces.IObjectModifiedEvent))
+  True
+
+"""
+
+import collections
+import errno
+import glob
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+import uuid
+
+import transaction
+import zope.component
+import zope.interface
+
+import interfaces
+import utils
+
+logger = logging.getLogger("z3c.conditionalviews.invalidation")
+
+class ValidatorDataCache(object):
+    """
+      >>> from zope.interface.verify import verifyObject
+      >>> cache = ValidatorDataCache(maxentries = 2)
+      >>> verifyObject(interfaces.IValidatorDataCache, cache)
+      True
+
+      >>> cache.set('k1', 'etag', 'xyzzy')
+      >>> cache.set('k1', 'lastmodified', 'yesterday')
+      >>> cache.get('k1', 'etag')
+      'xyzzy'
+      >>> cache.get('k2', 'etag') is None
+      True
+
+    Invalidating a content key drops all its entries.
+
+      >>> generation = cache.generation
+      >>> cache.invalidate(['k1'])
+      >>> cache.get('k1', 'etag') is None
+      True
+      >>> cache.generation > generation
+      True
+
+    Data computed before an invalidation is not cached.
+
+      >>> cache.set('k1', 'etag', 'stale', generation)
+      >>> cache.get('k1', 'etag') is None
+      True
+
+    The least recently used content keys are dropped first.
+
+      >>> cache.set('k1', 'etag', 'a')
+      >>> cache.set('k2', 'etag', 'b')
+      >>> cache.get('k1', 'etag')
+      'a'
+      >>> cache.set('k3', 'etag', 'c')
+      >>> cache.get('k2', 'etag') is None
+      True
+      >>> cache.get('k1', 'etag')
+      'a'
+
+      >>> cache.flush()
+      >>> cache.get('k1', 'etag') is None
+      True
+
+    """
+    zope.interface.implements(interfaces.IValidatorDataCache)
+
+    def __init__(self, maxentries = 10000):
+        self.maxentries = maxentries
+        self.generation = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, entry, default = None):
+        self._lock.acquire()
+        try:
+            entries = self._entries.pop(key, None)
+            if entries is None:
+                return default
+            self._entries[key] = entries
+            return entries.get(entry, default)
+        finally:
+            self._lock.release()
+
+    def set(self, key, entry, data, generation = None):
+        self._lock.acquire()
+        try:
+            if generation is not None and generation != self.generation:
+                return
+            entries = self._entries.pop(key, None)
+            if entries is None:
+                entries = {}
+            entries[entry] = data
+            self._entries[key] = entries
+            while len(self._entries) > self.maxentries:
+                self._entries.popitem(last = False)
+        finally:
+            self._lock.release()
+
+    def invalidate(self, keys):
+        self._lock.acquire()
+        try:
+            self.generation += 1
+            for key in keys:
+                self._entries.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        self._lock.acquire()
+        try:
+            self.generation += 1
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+###############################################################################
+#
+# Transports
+#
+###############################################################################
+
+class UnixDatagramTransport(object):
+    """
+    Every process binds a UNIX datagram socket in a directory shared by all
+    the processes on the machine, and sends its messages to all the other
+    sockets in it.
+
+      >>> import shutil
+      >>> import tempfile
+      >>> from zope.interface.verify import verifyObject
+
+      >>> directory = tempfile.mkdtemp()
+      >>> one = UnixDatagramTransport(directory)
+      >>> verifyObject(interfaces.IInvalidationTransport, one)
+      True
+      >>> two = UnixDatagramTransport(directory)
+      >>> three = UnixDatagramTransport(directory)
+
+      >>> one.send('hello')
+      >>> two.receive(1), three.receive(1)
+      ('hello', 'hello')
+      >>> one.receive(0.1) is None
+      True
+
+    Sockets left behind by processes that have gone away are cleaned up.
+
+      >>> three._socket.close()
+      >>> one.send('again')
+      >>> two.receive(1)
+      'again'
+      >>> os.path.exists(three.path)
+      False
+
+      >>> one.close()
+      >>> two.close()
+      >>> sorted(os.listdir(directory))
+      []
+      >>> shutil.rmtree(directory)
+
+    """
+    zope.interface.implements(interfaces.IInvalidationTransport)
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(
+            directory, "%d-%s.sock" % (os.getpid(), uuid.uuid4().hex[:8]))
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(self.path)
+
+    def send(self, data):
+        for path in glob.glob(os.path.join(self.directory, "*.sock")):
+            if path == self.path:
+                continue
+            try:
+                self._socket.sendto(data, path)
+            except socket.error as e:
+                if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                    # Nobody is listening any more.
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                else:
+                    logger.warning("Failed to send invalidation to %s: %s",
+                                   path, e)
+
+    def receive(self, timeout):
+        self._socket.settimeout(timeout)
+        try:
+            return self._socket.recv(65536)
+        except socket.timeout:
+            return None
+
+    def close(self):
+        self._socket.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class UDPTransport(object):
+    """
+    Messages are sent to a UDP address, usually a multicast group joined by
+    all the processes of the cluster.
+
+      >>> from zope.interface.verify import verifyObject
+      >>> probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      >>> probe.bind(('127.0.0.1', 0))
+      >>> port = probe.getsockname()[1]
+      >>> probe.close()
+
+      >>> transport = UDPTransport('127.0.0.1', port)
+      >>> verifyObject(interfaces.IInvalidationTransport, transport)
+      True
+      >>> transport.send('hello')
+      >>> transport.receive(1)
+      'hello'
+      >>> transport.receive(0.1) is None
+      True
+      >>> transport.close()
+
+    """
+    zope.interface.implements(interfaces.IInvalidationTransport)
+
+    def __init__(self, address, port, ttl = 1):
+        self.address = (address, port)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self._socket.bind(("", port))
+        if 224 <= int(address.split(".", 1)[0]) <= 239:
+            self._socket.setsockopt(
+                socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+            self._socket.setsockopt(
+                socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            self._socket.setsockopt(
+                socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                struct.pack("4sl", socket.inet_aton(address),
+                            socket.INADDR_ANY))
+
+    def send(self, data):
+        try:
+            self._socket.sendto(data, self.address)
+        except socket.error as e:
+            logger.warning("Failed to send invalidation to %s:%d: %s",
+                           self.address[0], self.address[1], e)
+
+    def receive(self, timeout):
+        self._socket.settimeout(timeout)
+        try:
+            return self._socket.recv(65536)
+        except socket.timeout:
+            return None
+
+    def close(self):
+        self._socket.close()
+
+###############################################################################
+#
+# The bus
+#
+###############################################################################
+
+class InvalidationBus(object):
+    """
+      >>> import shutil
+      >>> import tempfile
+      >>> from zope.interface.verify import verifyObject
+
+    Two processes, each with its own cache.
+
+      >>> directory = tempfile.mkdtemp()
+      >>> cache1, cache2 = ValidatorDataCache(), ValidatorDataCache()
+      >>> bus1 = InvalidationBus(
+      ...    UnixDatagramTransport(directory), cache1, batchsize = 2)
+      >>> verifyObject(interfaces.IInvalidationBus, bus1)
+      True
+      >>> bus2 = InvalidationBus(UnixDatagramTransport(directory), cache2)
+
+      >>> def fill(cache):
+      ...    for key in ('k1', 'k2', 'k3', 'k4'):
+      ...        cache.set(key, 'etag', 'etag of %s' % key)
+      >>> def cached(cache):
+      ...    return [key for key in ('k1', 'k2', 'k3', 'k4')
+      ...            if cache.get(key, 'etag') is not None]
+      >>> fill(cache1); fill(cache2)
+
+    Keys queued during a transaction are coalesced, and published in batches
+    when the transaction commits.
+
+      >>> txn = transaction.begin()
+      >>> bus1.queue(['k1', 'k2'])
+      >>> bus1.queue(['k2', 'k3'])
+      >>> transaction.commit()
+      >>> cached(cache1)
+      ['k4']
+
+      >>> bus2.receive(bus2.transport.receive(1))
+      >>> cached(cache2)
+      ['k3', 'k4']
+      >>> bus2.receive(bus2.transport.receive(1))
+      >>> cached(cache2)
+      ['k4']
+
+    Nothing is published when the transaction is aborted.
+
+      >>> txn = transaction.begin()
+      >>> bus1.queue(['k4'])
+      >>> transaction.abort()
+      >>> bus2.transport.receive(0.1) is None
+      True
+
+    A process that misses a message flushes its whole cache when the next
+    message arrives.
+
+      >>> fill(cache2)
+      >>> bus1.publish(['k1'])
+      >>> lost = bus2.transport.receive(1)
+      >>> bus1.publish(['k2'])
+      >>> bus2.receive(bus2.transport.receive(1))
+      >>> cached(cache2)
+      []
+
+    Since the last message could be missed as well, the bus sends the number
+    of the last message it sent every now and then.
+
+      >>> fill(cache2)
+      >>> bus1.publish(['k1'])
+      >>> lost = bus2.transport.receive(1)
+      >>> bus1.heartbeat()
+      >>> bus2.receive(bus2.transport.receive(1))
+      >>> cached(cache2)
+      []
+
+    While nothing is missed the heartbeat changes nothing.
+
+      >>> fill(cache2)
+      >>> bus1.heartbeat()
+      >>> bus2.receive(bus2.transport.receive(1))
+      >>> cached(cache2)
+      ['k1', 'k2', 'k3', 'k4']
+
+    Normally messages are received in a thread of their own.
+
+      >>> bus2.start()
+      >>> bus1.publish(['k3'])
+      >>> for i in range(100):
+      ...    if cache2.get('k3', 'etag') is None:
+      ...        break
+      ...    time.sleep(0.01)
+      >>> cached(cache2)
+      ['k1', 'k2', 'k4']
+      >>> bus2.stop()
+
+      >>> bus1.transport.close()
+      >>> bus2.transport.close()
+      >>> shutil.rmtree(directory)
+
+    """
+    zope.interface.implements(interfaces.IInvalidationBus)
+
+    def __init__(self, transport, cache = None, batchsize = 100,
+                 heartbeat = 10):
+        self.transport = transport
+        self._cache = cache
+        self.batchsize = batchsize
+        self.heartbeatinterval = heartbeat
+        self.sender = uuid.uuid4().hex
+        self._sequence = 0
+        # sender -> sequence number of the last message received
+        self._received = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._thread = None
+        self._running = False
+
+    @property
+    def cache(self):
+        if self._cache is not None:
+            return self._cache
+        return zope.component.queryUtility(interfaces.IValidatorDataCache)
+
+    def queue(self, keys):
+        txn = transaction.get()
+        if getattr(self._local, "txn", None) is not txn:
+            self._local.txn = txn
+            self._local.keys = set()
+            txn.addAfterCommitHook(self._afterCommit, (self._local.keys,))
+        self._local.keys.update(keys)
+
+    def _afterCommit(self, status, keys):
+        self._local.txn = None
+        if status and keys:
+            self.publish(sorted(keys))
+
+    def _send(self, keys):
+        self._lock.acquire()
+        try:
+            if keys:
+                self._sequence += 1
+            data = json.dumps({"sender": self.sender,
+                               "sequence": self._sequence,
+                               "keys": keys})
+        finally:
+            self._lock.release()
+        self.transport.send(data)
+
+    def publish(self, keys):
+        cache = self.cache
+        if cache is not None:
+            cache.invalidate(keys)
+        for start in range(0, len(keys), self.batchsize):
+            self._send(keys[start:start + self.batchsize])
+
+    def heartbeat(self):
+        self._send([])
+
+    def receive(self, data):
+        try:
+            message = json.loads(data)
+            sender = message["sender"]
+            sequence = message["sequence"]
+            keys = [str(key) for key in message["keys"]]
+        except (ValueError, KeyError, TypeError):
+            logger.warning("Ignoring invalid invalidation message")
+            return
+        if sender == self.sender:
+            return
+
+        # Heartbeats carry the number of the last message sent.
+        last = self._received.get(sender, 0)
+        expected = last + (keys and 1 or 0)
+        self._received[sender] = max(sequence, last)
+
+        cache = self.cache
+        if cache is None:
+            return
+        if sequence > expected:
+            logger.info("Missed invalidations from %s, flushing the cache",
+                        sender)
+            cache.flush()
+        elif keys:
+            cache.invalidate(keys)
+
+    def _run(self):
+        lastheartbeat = time.time()
+        while self._running:
+            data = self.transport.receive(min(1, self.heartbeatinterval))
+            if data is not None and self._running:
+                self.receive(data)
+            if time.time() - lastheartbeat >= self.heartbeatinterval:
+                self.heartbeat()
+                lastheartbeat = time.time()
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target = self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+###############################################################################
+#
+# Event handlers invalidating the validator data of modified content.
+#
+###############################################################################
+
+# Keys to invalidate in the cache once the transaction of the thread commits.
+_local = threading.local()
+
+def _afterCommit(status, cache, keys):
+    _local.txn = None
+    # Other requests may have cached the data again while the transaction
+    # was committing.
+    cache.invalidate(sorted(keys))
+
+
+def _queue(cache, keys):
+    txn = transaction.get()
+    if getattr(_local, "txn", None) is not txn or _local.cache is not cache:
+        _local.txn = txn
+        _local.cache = cache
+        _local.keys = set()
+        txn.addAfterCommitHook(_afterCommit, (cache, _local.keys))
+    _local.keys.update(keys)
+
+
+def _invalidate(keys):
+    keys = [key for key in keys if key is not None]
+    if not keys:
+        return
+    cache = zope.component.queryUtility(interfaces.IValidatorDataCache)
+    if cache is not None:
+        # The current transaction must not see the data cached before.
+        cache.invalidate(keys)
+        _queue(cache, keys)
+    bus = zope.component.queryUtility(interfaces.IInvalidationBus)
+    if bus is not None:
+        bus.queue(keys)
+
+
+def contentModified(ob, event):
+    # The validator data of the containers can be computed from their
+    # contents, see the aggregate module.
+    _invalidate([utils.contentKey(ob)] + utils.parentKeys(ob))
+
+
+def contentMoved(ob, event):
+    keys = [utils.contentKey(ob)]
+    for parent in (event.oldParent, event.newParent):
+        if parent is not None:
+            keys.append(utils.contentKey(parent))
+            keys.extend(utils.parentKeys(parent))
+    _invalidate(keys)
@@ -16,6 +16,7 @@ import zope.datetime
 import zope.interface
 
 import interfaces
+import utils
 
 class ModifiedSinceValidator(object):
     """
@@ -255,6 +256,32 @@ class ModifiedSinceValidator(object):
       >>> request.response.getHeader('Last-Modified') is None
       True
 
+    Variants
+    ========
+
+    A date doesn't tell which variant of a negotiated view the client has,
+    so `If-Modified-Since` isn't evaluated for views varying on request
+    headers. The headers are listed in the `Vary` header of the response.
+
+      >>> class VariantLastModification(LastModification):
+      ...    zope.interface.implements(interfaces.IVariantValidatorData)
+      ...    vary = ('Accept-Language',)
+      >>> gsm.registerAdapter(VariantLastModification,
+      ...    (None, IBrowserRequest, None), interfaces.ILastModificationDate)
+
+      >>> request = TestRequest(environ = {'IF_MODIFIED_SINCE': format(lmt)})
+      >>> view = SimpleView(None, request)
+      >>> validator.evaluate(None, request, view)
+      False
+      >>> validator.updateResponse(None, request, view)
+      >>> request.response.getHeader('Vary')
+      'Accept-Language'
+      >>> request.response.getHeader('Last-Modified')
+      'Sat, 06 Jan 2007 12:42:13 GMT'
+
+      >>> gsm.registerAdapter(LastModification,
+      ...    (None, IBrowserRequest, None))
+
     Cleanup
     -------
 
@@ -265,6 +292,9 @@ class ModifiedSinceValidator(object):
     """
     zope.interface.implements(interfaces.IHTTPValidator)
 
+    # Validator data used, see the prefetch module.
+    datainterface = interfaces.ILastModificationDate
+
     def ifModifiedSince(self, request, mtime, header):
         headervalue = request.getHeader(header, None)
         if headervalue is not None:
@@ -284,13 +314,20 @@ class ModifiedSinceValidator(object):
         return True
 
     def evaluate(self, context, request, view):
-        return \
-             request.getHeader("If-Modified-Since", None) is not None or \
-             request.getHeader("If-UnModified-Since", None) is not None
+        if request.getHeader("If-UnModified-Since", None) is not None:
+            return True
+        if request.getHeader("If-Modified-Since", None) is None:
+            return False
+        # The date doesn't tell which variant of the view the client has,
+        # nor which principal it was rendered for.
+        if utils.principalFingerprint(request) is not None:
+            return False
+        return not utils.varyHeaders(
+            self.getDataStorage(context, request, view))
 
     def getDataStorage(self, context, request, view):
-        return zope.component.queryMultiAdapter(
-            (context, request, view), interfaces.ILastModificationDate)
+        return utils.queryValidatorData(
+            context, request, view, self.datainterface)
 
     def valid(self, context, request, view):
         if request.get("QUERY_STRING", "") != "":
@@ -298,15 +335,17 @@ class ModifiedSinceValidator(object):
             # by the ILastModificationDate does not apply to this view.
             return True
 
-        lmd = self.getDataStorage(context, request, view)
-        if lmd is None:
+        storage = self.getDataStorage(context, request, view)
+        if storage is None:
             return True
 
-        lmd = lmd.lastmodified
+        lmd = storage.lastmodified
         if lmd is None:
             return True
 
-        if request.getHeader("If-Modified-Since", None) is not None:
+        if request.getHeader("If-Modified-Since", None) is not None and \
+               not utils.varyHeaders(storage) and \
+               utils.principalFingerprint(request) is None:
             return self.ifModifiedSince(request, lmd, "If-Modified-Since")
         if request.getHeader("If-UnModified-Since", None) is not None:
             return not self.ifModifiedSince(
@@ -322,7 +361,12 @@ class ModifiedSinceValidator(object):
         if request.response.getHeader("Last-Modified", None) is None and \
                request.get("QUERY_STRING", "") == "":
             storage = self.getDataStorage(context, request, view)
+            vary = utils.varyHeaders(storage)
+            if vary:
+                utils.addVaryHeader(request.response, *vary)
             if storage is not None and storage.lastmodified is not None:
+                if utils.principalFingerprint(request) is not None:
+                    utils.setPrivate(request.response)
                 lmd = zope.datetime.rfc1123_date(
                     calendar.timegm(storage.lastmodified.utctimetuple()))
                 request.response.setHeader("Last-Modified", lmd)
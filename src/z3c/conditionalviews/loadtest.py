@@ -0,0 +1,348 @@
+##############################################################################
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+##############################################################################
+"""
+Load testing conditional publishing.
+
+The load harness serves a WSGI application, by default the one configured by
+`ftesting.zcml`, from a pool of worker threads. Concurrent clients send a mix
+of requests for a set of files:
+
+- `get`, unconditional GET requests,
+
+- `conditional`, GET requests with the `If-None-Match` header set to the
+  entity tag the client last saw,
+
+- `head`, conditional HEAD requests,
+
+- `put`, PUT requests with the `If-Match` header set to the entity tag the
+  client last saw.
+
+The test extras, `zope.app.wsgi` and `zope.securitypolicy`, are needed to
+run the application configured by `ftesting.zcml`.
+
+  >>> mix = parseMix('conditional=8,get=1,put=1')
+  >>> sorted(mix.items())
+  [('conditional', 8), ('get', 1), ('put', 1)]
+  >>> parseMix('post=1')
+  Traceback (most recent call last):
+  ...
+  ValueError: unknown request kind: post
+
+The application is run with one and then two worker threads.
+
+  >>> results = [run(application, threads, clients = 2, requests = 20,
+  ...                mix = mix, files = 3)
+  ...            for threads in (1, 2)]
+  >>> [result['threads'] for result in results]
+  [1, 2]
+  >>> [result['requests'] for result in results]
+  [40, 40]
+  >>> [result['errors'] for result in results]
+  [0, 0]
+
+Most of the requests were answered with a `304 Not Modified` response.
+
+  >>> results[0]['statuses'][304] > 10
+  True
+  >>> 0 < results[0]['notmodified'] < 1
+  True
+
+The report lists the throughput, latency percentiles and ratio of
+`304 Not Modified` responses for every number of threads.
+
+  >>> print formatReport(results)
+  threads  requests/s    p50 ms    p90 ms    p99 ms  304 ratio  errors
+        1    ...     ...       ...       ...     ...        0
+        2    ...     ...       ...       ...     ...        0
+
+  >>> percentile([3, 1, 2, 4], 0.5)
+  2
+  >>> percentile([3, 1, 2, 4], 0.99)
+  4
+  >>> percentile([], 0.5)
+
+"""
+
+import base64
+import httplib
+import optparse
+import os
+import Queue
+import random
+import StringIO
+import threading
+import time
+import wsgiref.simple_server
+
+KINDS = ("get", "conditional", "head", "put")
+
+DEFAULT_MIX = "conditional=70,get=15,head=10,put=5"
+
+def parseMix(mix):
+    """
+    Parse a mix of request kinds, like `conditional=70,get=30`, into a
+    dictionary of weights.
+    """
+    weights = {}
+    for item in mix.split(","):
+        kind, weight = item.split("=", 1)
+        kind = kind.strip()
+        if kind not in KINDS:
+            raise ValueError("unknown request kind: %s" % kind)
+        weights[kind] = int(weight)
+    return weights
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * len(values))) - 1)
+    return values[max(index, 0)]
+
+
+def makeApplication():
+    """
+    Return the application configured by `ftesting.zcml`, with an in memory
+    database.
+    """
+    import ZODB.DB
+    import ZODB.MappingStorage
+    import zope.app.appsetup.appsetup
+    import zope.app.wsgi
+    import zope.event
+    import zope.processlifetime
+
+    zope.app.appsetup.appsetup.config(
+        os.path.join(os.path.dirname(__file__), "ftesting.zcml"))
+    db = ZODB.DB(ZODB.MappingStorage.MappingStorage())
+    zope.event.notify(zope.processlifetime.DatabaseOpened(db))
+    return zope.app.wsgi.WSGIPublisherApplication(db)
+
+
+class QuietHandler(wsgiref.simple_server.WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadPoolServer(wsgiref.simple_server.WSGIServer):
+    """
+    A WSGI server handling requests in a fixed number of worker threads.
+    """
+
+    def __init__(self, application, threads, host = "127.0.0.1", port = 0):
+        wsgiref.simple_server.WSGIServer.__init__(
+            self, (host, port), QuietHandler)
+        self.set_app(application)
+        self.requests = Queue.Queue()
+        self.workers = [threading.Thread(target = self.work)
+                        for i in range(threads)]
+        self.thread = threading.Thread(target = self.serve_forever)
+
+    def get_app(self):
+        return self.limitInput
+
+    def limitInput(self, environ, start_response):
+        # wsgiref passes the socket as the input, which the publisher reads
+        # to the end.
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        environ["wsgi.input"] = StringIO.StringIO(
+            environ["wsgi.input"].read(length))
+        return self.application(environ, start_response)
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def work(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            self.shutdown_request(request)
+
+    def start(self):
+        for worker in self.workers:
+            worker.setDaemon(True)
+            worker.start()
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self, timeout = 10):
+        self.shutdown()
+        for worker in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join(timeout)
+        self.server_close()
+        # The serving thread is still running after serve_forever returns.
+        self.thread.join(timeout)
+
+
+class Client(object):
+    """
+    Sends a mix of requests for a set of files, remembering the last entity
+    tag seen of each one.
+    """
+
+    def __init__(self, address, paths, mix, authorization):
+        self.address = address
+        self.paths = paths
+        self.kinds = []
+        for kind, weight in sorted(mix.items()):
+            self.kinds.extend([kind] * weight)
+        self.authorization = authorization
+        self.etags = {}
+
+    def request(self, method, path, headers, body = None):
+        connection = httplib.HTTPConnection(*self.address)
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            response.read()
+            etag = response.getheader("ETag")
+            if etag is not None:
+                self.etags[path] = etag
+            return response.status
+        finally:
+            connection.close()
+
+    def send(self):
+        kind = random.choice(self.kinds)
+        path = random.choice(self.paths)
+        etag = self.etags.get(path)
+        # The files can only be viewed by authenticated users.
+        headers = {"Authorization": self.authorization}
+        if kind in ("conditional", "head") and etag is not None:
+            headers["If-None-Match"] = etag
+        if kind == "put":
+            headers["Content-Type"] = "text/plain"
+            if etag is not None:
+                headers["If-Match"] = etag
+            return self.request("PUT", path, headers, "x" * 100)
+        if kind == "head":
+            return self.request("HEAD", path, headers)
+        return self.request("GET", path, headers)
+
+
+def run(application, threads, clients = 10, requests = 1000, mix = None,
+        files = 10, login = "mgr", password = "mgrpw"):
+    """
+    Serve the `application` from `threads` worker threads, and send it
+    `requests` requests from every one of the `clients`.
+    """
+    mix = mix or parseMix(DEFAULT_MIX)
+    authorization = "Basic " + base64.b64encode("%s:%s" % (login, password))
+    server = ThreadPoolServer(application, threads)
+    server.start()
+    try:
+        address = server.server_address
+        paths = ["/loadtest%d" % index for index in range(files)]
+        setup = Client(address, paths, {}, authorization)
+        for path in paths:
+            setup.request("PUT", path, {"Authorization": authorization,
+                                        "Content-Type": "text/plain"},
+                          "x" * 100)
+
+        latencies = []
+        statuses = {}
+        errors = []
+        lock = threading.Lock()
+        def drive():
+            client = Client(address, paths, mix, authorization)
+            client.etags.update(setup.etags)
+            for index in range(requests):
+                start = time.time()
+                try:
+                    status = client.send()
+                except Exception as e:
+                    status = None
+                    errors.append(e)
+                latency = time.time() - start
+                lock.acquire()
+                try:
+                    latencies.append(latency)
+                    statuses[status] = statuses.get(status, 0) + 1
+                finally:
+                    lock.release()
+
+        drivers = [threading.Thread(target = drive) for i in range(clients)]
+        start = time.time()
+        for driver in drivers:
+            driver.start()
+        for driver in drivers:
+            driver.join()
+        elapsed = time.time() - start
+    finally:
+        server.stop()
+
+    total = len(latencies)
+    return {"threads": threads,
+            "requests": total,
+            "seconds": elapsed,
+            "throughput": total / elapsed,
+            "p50": percentile(latencies, 0.5),
+            "p90": percentile(latencies, 0.9),
+            "p99": percentile(latencies, 0.99),
+            "statuses": statuses,
+            "notmodified": statuses.get(304, 0) / float(total or 1),
+            "errors": len(errors) + sum([
+                count for status, count in statuses.items()
+                if status is None or status >= 500]),
+            }
+
+
+def formatReport(results):
+    lines = ["threads  requests/s    p50 ms    p90 ms    p99 ms  304 ratio"
+             "  errors"]
+    for result in results:
+        lines.append("%7d  %10.1f  %8.2f  %8.2f  %8.2f  %9.2f  %6d" % (
+            result["threads"], result["throughput"], result["p50"] * 1000,
+            result["p90"] * 1000, result["p99"] * 1000,
+            result["notmodified"], result["errors"]))
+    return "\n".join(lines)
+
+
+def main(argv = None):
+    parser = optparse.OptionParser(
+        usage = "%prog [options]",
+        description = "Load test the conditional publishing of the "
+                      "ftesting.zcml application.")
+    parser.add_option("-t", "--threads", default = "1,2,4,8",
+                      help = "comma separated numbers of worker threads")
+    parser.add_option("-c", "--clients", type = "int", default = 10,
+                      help = "concurrent clients")
+    parser.add_option("-n", "--requests", type = "int", default = 1000,
+                      help = "requests sent by every client")
+    parser.add_option("-m", "--mix", default = DEFAULT_MIX,
+                      help = "weights of the kinds of requests sent, "
+                             "from %s" % ", ".join(KINDS))
+    parser.add_option("-f", "--files", type = "int", default = 10,
+                      help = "files requested")
+    options, args = parser.parse_args(argv)
+    try:
+        mix = parseMix(options.mix)
+        threads = [int(count) for count in options.threads.split(",")]
+    except ValueError as e:
+        parser.error(str(e))
+
+    application = makeApplication()
+    results = [run(application, count, options.clients, options.requests,
+                   mix, options.files)
+               for count in threads]
+    print(formatReport(results))
+    return 0
@@ -0,0 +1,183 @@
+##############################################################################
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+##############################################################################
+"""
+The `conditional:view` directive makes existing views conditional, without
+decorating them or swapping the request factory, and names the validators
+and validator data factories applying to them.
+
+  <configure xmlns:conditional="http://namespaces.zope.org/conditional">
+    <include package="z3c.conditionalviews" file="meta.zcml" />
+
+    <conditional:view
+        for=".browser.ReportView"
+        validators="http.etag"
+        etag=".browser.ReportETag"
+        />
+  </configure>
+
+The validators are looked up once, when the configuration is executed, and
+kept in a dispatch table together with the validator data factories, see
+`dispatch.py`, so validating a request to these views doesn't query the
+component registry for them. Validators registered in local sites are not
+used for these views.
+
+  >>> import zope.configuration.config
+  >>> import zope.publisher.browser
+  >>> from zope.publisher.browser import TestRequest
+  >>> from z3c.conditionalviews import etag, lastmodification
+
+  >>> class Report(zope.publisher.browser.BrowserView):
+  ...    def __call__(self):
+  ...        return 'Report'
+
+  >>> class ReportETag(object):
+  ...    zope.interface.implements(interfaces.IETag)
+  ...    def __init__(self, context, request, view):
+  ...        pass
+  ...    weak, etag = False, 'report-1'
+
+  >>> gsm = zope.component.getGlobalSiteManager()
+  >>> etagvalidator = etag.ETagValidator()
+  >>> gsm.registerUtility(etagvalidator, name = 'http.etag')
+  >>> gsm.registerUtility(lastmodification.ModifiedSinceValidator(),
+  ...                     name = 'http.modifiedsince')
+
+  >>> context = zope.configuration.config.ConfigurationMachine()
+  >>> view(context, Report, validators = ['http.etag'], etag = ReportETag)
+  >>> context.execute_actions()
+
+The view is now conditional, and only validated by the entity tag
+validator, using the configured entity tag.
+
+  >>> [validator is etagvalidator
+  ...  for validator in z3c.conditionalviews.getValidators(Report(None, None))]
+  [True]
+
+  >>> request = TestRequest()
+  >>> Report(None, request)()
+  'Report'
+  >>> request.response.getHeader('ETag')
+  '"report-1"'
+
+  >>> request = TestRequest(environ = {'IF_NONE_MATCH': '"report-1"'})
+  >>> Report(None, request)()
+  ''
+  >>> request.response.getStatus()
+  304
+
+Views configured twice, or views which are already conditional, are
+reported.
+
+  >>> context = zope.configuration.config.ConfigurationMachine()
+  >>> view(context, Report)
+  >>> view(context, Report)
+  >>> context.execute_actions()
+  Traceback (most recent call last):
+  ...
+  ConfigurationConflictError: ...
+
+  >>> context = zope.configuration.config.ConfigurationMachine()
+  >>> view(context, Report)
+  >>> try:
+  ...    context.execute_actions()
+  ... except zope.configuration.exceptions.ConfigurationError as e:
+  ...    'Report.__call__ is already conditional' in str(e)
+  True
+
+Unknown validators are an error.
+
+  >>> class Other(zope.publisher.browser.BrowserView):
+  ...    def __call__(self):
+  ...        return 'Other'
+  >>> context = zope.configuration.config.ConfigurationMachine()
+  >>> view(context, Other, validators = ['http.missing'])
+  >>> context.execute_actions()
+  Traceback (most recent call last):
+  ...
+  ConfigurationExecutionError: ...ComponentLookupError...
+
+Views configured by interface must be conditional already.
+
+  >>> context = zope.configuration.config.ConfigurationMachine()
+  >>> view(context, zope.interface.Interface, attribute = 'render')
+  Traceback (most recent call last):
+  ...
+  ConfigurationError: Only the attribute of view classes is made conditional
+
+Cleanup
+-------
+
+  >>> dispatch.clear()
+  >>> gsm.unregisterUtility(name = 'http.etag',
+  ...    provided = interfaces.IHTTPValidator)
+  True
+  >>> gsm.unregisterUtility(name = 'http.modifiedsince',
+  ...    provided = interfaces.IHTTPValidator)
+  True
+
+"""
+
+import zope.component
+import zope.configuration.exceptions
+import zope.interface
+import zope.interface.interfaces
+
+import z3c.conditionalviews
+import dispatch
+import interfaces
+
+def makeConditional(cls, attribute):
+    for klass in cls.__mro__:
+        if attribute in klass.__dict__:
+            method = klass.__dict__[attribute]
+            break
+    else:
+        raise zope.configuration.exceptions.ConfigurationError(
+            "%s has no attribute %s" % (cls.__name__, attribute))
+    if isinstance(method, z3c.conditionalviews.ConditionalView):
+        raise zope.configuration.exceptions.ConfigurationError(
+            "%s.%s is already conditional" % (cls.__name__, attribute))
+    setattr(cls, attribute, z3c.conditionalviews.ConditionalView(method))
+
+
+def registerDispatch(for_, validators, data):
+    if validators is not None:
+        validators = [
+            (name, zope.component.getUtility(interfaces.IHTTPValidator, name))
+            for name in validators]
+    dispatch.register(for_, validators, data)
+
+
+def view(_context, for_, attribute = None, validators = None, etag = None,
+         lastmodified = None):
+    if zope.interface.interfaces.IInterface.providedBy(for_):
+        if attribute is not None:
+            raise zope.configuration.exceptions.ConfigurationError(
+                "Only the attribute of view classes is made conditional")
+    else:
+        _context.action(
+            discriminator = ("conditional:view", for_,
+                             attribute or "__call__"),
+            callable = makeConditional,
+            args = (for_, attribute or "__call__"))
+
+    data = {}
+    if etag is not None:
+        data[interfaces.IETag] = etag
+    if lastmodified is not None:
+        data[interfaces.ILastModificationDate] = lastmodified
+    _context.action(
+        discriminator = ("conditional:dispatch", for_),
+        callable = registerDispatch,
+        args = (for_, validators, data),
+        # After the validators are registered.
+        order = 1)
@@ -0,0 +1,53 @@
+##############################################################################
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+##############################################################################
+
+from zope import interface
+from zope import schema
+import zope.configuration.fields
+
+class IConditionalViewDirective(interface.Interface):
+    """
+    Make existing views conditional, and configure the validators and
+    validator data applying to them.
+    """
+
+    for_ = zope.configuration.fields.GlobalObject(
+        title = u"View class or interface",
+        description = u"The views this configuration applies to.",
+        required = True)
+
+    attribute = zope.configuration.fields.PythonIdentifier(
+        title = u"Attribute",
+        description = u"The method of the view class made conditional, " \
+                      u"`__call__` by default. Views configured by " \
+                      u"interface must already be conditional.",
+        required = False)
+
+    validators = zope.configuration.fields.Tokens(
+        title = u"Validators",
+        description = u"The names of the `IHTTPValidator` utilities " \
+                      u"validating requests to the views, all of them " \
+                      u"by default.",
+        value_type = schema.TextLine(),
+        required = False)
+
+    etag = zope.configuration.fields.GlobalObject(
+        title = u"Entity tag factory",
+        description = u"Called with the context, request and view to " \
+                      u"return the `IETag` of the view.",
+        required = False)
+
+    lastmodified = zope.configuration.fields.GlobalObject(
+        title = u"Last modification date factory",
+        description = u"Called with the context, request and view to " \
+                      u"return the `ILastModificationDate` of the view.",
+        required = False)
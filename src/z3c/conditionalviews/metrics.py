@@ -0,0 +1,409 @@
+##############################################################################
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+##############################################################################
+"""
+Metrics about the validation of requests to conditional views.
+
+When the `ValidationMetrics` utility is registered, see `metrics.zcml`, every
+call to a validator is timed and every request is counted by how it was
+answered. Every thread records its measurements in its own accumulator, so
+recording never waits on a lock. The accumulators are only added up when the
+metrics are collected, usually by the `metrics` view in the Prometheus text
+format, and the accumulators of the threads that ended are then merged into
+one.
+
+The time and bytes saved by answering a request with a `304 Not Modified` or
+`412 Precondition Failed` response are estimated from the average time it
+took to render the same view, and the average size of its responses.
+
+  >>> import zope.component
+  >>> from zope.interface.verify import verifyObject
+  >>> from zope.publisher.browser import TestRequest
+  >>> import z3c.conditionalviews
+
+  >>> metrics = ValidationMetrics()
+  >>> verifyObject(interfaces.IValidationMetrics, metrics)
+  True
+
+  >>> class Validator(object):
+  ...    zope.interface.implements(interfaces.IHTTPValidator)
+  ...    def evaluate(self, context, request, view):
+  ...        return request.getHeader('If-None-Match') is not None
+  ...    def valid(self, context, request, view):
+  ...        return request.getHeader('If-None-Match') != '"current"'
+  ...    def invalidStatus(self, context, request, view):
+  ...        return 304
+  ...    def updateResponse(self, context, request, view):
+  ...        pass
+
+  >>> gsm = zope.component.getGlobalSiteManager()
+  >>> gsm.registerUtility(Validator(), name = 'test.validator')
+  >>> gsm.registerUtility(metrics)
+
+  >>> class View(object):
+  ...    def __init__(self, context, request):
+  ...        self.context, self.request = context, request
+  ...    def render(self):
+  ...        time.sleep(0.01)
+  ...        return 'x' * 1000
+  >>> def publish(**environ):
+  ...    request = TestRequest(environ = environ)
+  ...    return z3c.conditionalviews.validate(
+  ...        None, request, View.render.im_func, View(None, request))
+
+  >>> len(publish())
+  1000
+  >>> len(publish(IF_NONE_MATCH = '"old"'))
+  1000
+  >>> publish(IF_NONE_MATCH = '"current"')
+  ''
+
+  >>> samples = dict(((name, labels), value)
+  ...                for name, labels, value in metrics.collect())
+  >>> samples[('z3c_conditionalviews_responses_total',
+  ...          (('outcome', 'rendered'),))]
+  2.0
+  >>> samples[('z3c_conditionalviews_responses_total',
+  ...          (('outcome', '304'),))]
+  1.0
+  >>> samples[('z3c_conditionalviews_validator_evaluated_total',
+  ...          (('validator', 'test.validator'),))]
+  2.0
+  >>> samples[('z3c_conditionalviews_validator_invalid_total',
+  ...          (('validator', 'test.validator'),))]
+  1.0
+  >>> samples[('z3c_conditionalviews_validator_seconds_count',
+  ...          (('method', 'evaluate'), ('validator', 'test.validator')))]
+  3.0
+  >>> samples[('z3c_conditionalviews_bytes_avoided_total', ())]
+  1000.0
+  >>> samples[('z3c_conditionalviews_render_seconds_saved_total', ())] > 0
+  True
+
+Other events are counted by name.
+
+  >>> metrics.count('retries_avoided')
+  >>> samples = dict(((name, labels), value)
+  ...                for name, labels, value in metrics.collect())
+  >>> samples[('z3c_conditionalviews_retries_avoided_total', ())]
+  1.0
+
+Measurements made in other threads are added up, and are kept once the
+threads have ended.
+
+  >>> import threading
+  >>> for i in range(3):
+  ...    thread = threading.Thread(target = publish,
+  ...                              kwargs = {'IF_NONE_MATCH': '"current"'})
+  ...    thread.start(); thread.join()
+  >>> len(metrics._accumulators)
+  5
+  >>> samples = dict(((name, labels), value)
+  ...                for name, labels, value in metrics.collect())
+  >>> samples[('z3c_conditionalviews_responses_total',
+  ...          (('outcome', '304'),))]
+  4.0
+  >>> len(metrics._accumulators)
+  2
+  >>> samples == dict(((name, labels), value)
+  ...                 for name, labels, value in metrics.collect())
+  True
+
+A validator evaluated more than once for a request, like when its data is
+fetched in advance, is only measured once.
+
+  >>> request = TestRequest(environ = {'IF_NONE_MATCH': '"old"'})
+  >>> [validator] = metrics.instrument([('test.validator', Validator())])
+  >>> validator.evaluate(None, request, None)
+  True
+  >>> validator.evaluate(None, request, None)
+  True
+  >>> samples = dict(((name, labels), value)
+  ...                for name, labels, value in metrics.collect())
+  >>> samples[('z3c_conditionalviews_validator_evaluated_total',
+  ...          (('validator', 'test.validator'),))]
+  6.0
+
+The view formats the metrics for Prometheus.
+
+  >>> request = TestRequest()
+  >>> output = MetricsView(None, request)()
+  >>> print '\\n'.join([line for line in output.splitlines()
+  ...                  if 'responses' in line or 'histogram' in line])
+  # TYPE z3c_conditionalviews_responses_total counter
+  z3c_conditionalviews_responses_total{outcome="304"} 4.0
+  z3c_conditionalviews_responses_total{outcome="rendered"} 2.0
+  # TYPE z3c_conditionalviews_validator_seconds histogram
+  >>> 'le="+Inf",method="valid",validator="test.validator"} 5.0' in output
+  True
+  >>> request.response.getHeader('Content-Type')
+  'text/plain; version=0.0.4'
+
+Cleanup
+-------
+
+  >>> gsm.unregisterUtility(metrics)
+  True
+  >>> gsm.unregisterUtility(name = 'test.validator',
+  ...    provided = interfaces.IHTTPValidator)
+  True
+
+"""
+
+import threading
+import time
+
+import zope.component
+import zope.interface
+import zope.publisher.browser
+
+import interfaces
+import utils
+
+# Upper bounds, in seconds, of the buckets of the latency histograms.
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+PREFIX = "z3c_conditionalviews_"
+
+HISTOGRAMS = (PREFIX + "validator_seconds",)
+
+class Accumulator(object):
+    """
+    Measurements made by one thread.
+    """
+
+    def __init__(self):
+        # (name, labels) -> value
+        self.counters = {}
+        # labels -> [count per bucket, ..., sum]
+        self.histograms = {}
+        # view -> [renders, render seconds, bytes rendered, invalid]
+        self.views = {}
+
+    def add(self, accumulator):
+        """
+        Add the measurements of another `accumulator` to this one.
+        """
+        # Copying the items of a dictionary is atomic.
+        for key, value in accumulator.counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+        for labels, histogram in accumulator.histograms.items():
+            total = self.histograms.setdefault(labels, [0] * len(histogram))
+            for index, value in enumerate(histogram):
+                total[index] += value
+        for key, stats in accumulator.views.items():
+            total = self.views.setdefault(key, [0, 0.0, 0, 0])
+            for index, value in enumerate(stats):
+                total[index] += value
+
+    def count(self, name, labels = (), value = 1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, labels, seconds):
+        histogram = self.histograms.get(labels)
+        if histogram is None:
+            histogram = self.histograms[labels] = [0] * (len(BUCKETS) + 2)
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                break
+        else:
+            index = len(BUCKETS)
+        histogram[index] += 1
+        histogram[-1] += seconds
+
+
+class TimedValidator(object):
+    """
+    Measures the calls made to a validator.
+    """
+    zope.interface.implements(interfaces.IHTTPValidator)
+
+    def __init__(self, name, validator, metrics):
+        self.name = name
+        self.validator = validator
+        self.metrics = metrics
+        # The requests evaluated, validators are instrumented per request.
+        self._evaluated = set()
+
+    def __getattr__(self, name):
+        # Like the `datainterface` of the validator.
+        return getattr(self.validator, name)
+
+    def _call(self, method, context, request, view):
+        start = time.time()
+        try:
+            return getattr(self.validator, method)(context, request, view)
+        finally:
+            self.metrics._accumulator().observe(
+                (("method", method), ("validator", self.name)),
+                time.time() - start)
+
+    def evaluate(self, context, request, view):
+        key = (id(context), id(request), id(view))
+        if key in self._evaluated:
+            # Already measured, by an `IValidatorDataFetcher`.
+            return self.validator.evaluate(context, request, view)
+        self._evaluated.add(key)
+        result = self._call("evaluate", context, request, view)
+        if result:
+            self.metrics._accumulator().count(
+                PREFIX + "validator_evaluated_total",
+                (("validator", self.name),))
+        return result
+
+    def valid(self, context, request, view):
+        result = self._call("valid", context, request, view)
+        if not result:
+            self.metrics._accumulator().count(
+                PREFIX + "validator_invalid_total",
+                (("validator", self.name),))
+        return result
+
+    def invalidStatus(self, context, request, view):
+        return self.validator.invalidStatus(context, request, view)
+
+    def updateResponse(self, context, request, view):
+        return self._call("updateResponse", context, request, view)
+
+
+class ValidationMetrics(object):
+    zope.interface.implements(interfaces.IValidationMetrics)
+
+    def __init__(self):
+        self._local = threading.local()
+        # (thread, accumulator) pairs, the first one holds the measurements
+        # of the threads that ended.
+        self._accumulators = [(None, Accumulator())]
+        self._lock = threading.Lock()
+
+    def _accumulator(self):
+        accumulator = getattr(self._local, "accumulator", None)
+        if accumulator is None:
+            accumulator = self._local.accumulator = Accumulator()
+            # Only done once for every thread.
+            self._lock.acquire()
+            try:
+                self._accumulators.append(
+                    (threading.currentThread(), accumulator))
+            finally:
+                self._lock.release()
+        return accumulator
+
+    def instrument(self, validators):
+        return [TimedValidator(name or validator.__class__.__name__,
+                               validator, self)
+                for name, validator in validators]
+
+    def record(self, view, status, rendertime, result):
+        accumulator = self._accumulator()
+        if status is not None:
+            outcome = str(status)
+        elif rendertime is None:
+            outcome = "cached"
+        else:
+            outcome = "rendered"
+        accumulator.count(PREFIX + "responses_total", (("outcome", outcome),))
+
+        key = utils.viewKey(view)
+        stats = accumulator.views.get(key)
+        if stats is None:
+            stats = accumulator.views[key] = [0, 0.0, 0, 0]
+        if status is not None:
+            stats[3] += 1
+        elif rendertime is not None:
+            stats[0] += 1
+            stats[1] += rendertime
+            if isinstance(result, basestring):
+                stats[2] += len(result)
+
+    def count(self, name):
+        self._accumulator().count(PREFIX + name + "_total")
+
+    def collect(self):
+        self._lock.acquire()
+        try:
+            ended = self._accumulators[0][1]
+            alive = []
+            for thread, accumulator in self._accumulators[1:]:
+                if thread.isAlive():
+                    alive.append((thread, accumulator))
+                else:
+                    # Nothing records in it anymore.
+                    ended.add(accumulator)
+            self._accumulators[1:] = alive
+            total = Accumulator()
+            total.add(ended)
+        finally:
+            self._lock.release()
+
+        for thread, accumulator in alive:
+            total.add(accumulator)
+
+        rendered = renderseconds = saved = avoided = 0
+        for renders, seconds, size, invalid in total.views.values():
+            rendered += renders
+            renderseconds += seconds
+            if renders:
+                saved += invalid * seconds / renders
+                avoided += invalid * size / float(renders)
+
+        samples = [(name, labels, float(value))
+                   for (name, labels), value in total.counters.items()]
+        samples.extend([
+            (PREFIX + "renders_total", (), float(rendered)),
+            (PREFIX + "render_seconds_total", (), float(renderseconds)),
+            (PREFIX + "render_seconds_saved_total", (), float(saved)),
+            (PREFIX + "bytes_avoided_total", (), float(avoided)),
+            ])
+        name = PREFIX + "validator_seconds"
+        for labels, histogram in total.histograms.items():
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), histogram[:-1]):
+                cumulative += count
+                samples.append((name + "_bucket",
+                                tuple(sorted(labels + (("le", str(bound)),))),
+                                float(cumulative)))
+            samples.append((name + "_count", labels, float(cumulative)))
+            samples.append((name + "_sum", labels, float(histogram[-1])))
+        return sorted(samples)
+
+
+def formatPrometheus(samples):
+    lines = []
+    family = None
+    for name, labels, value in sorted(samples):
+        samplefamily = name
+        for histogram in HISTOGRAMS:
+            if name.startswith(histogram + "_"):
+                samplefamily = histogram
+        if samplefamily != family:
+            family = samplefamily
+            lines.append("# TYPE %s %s" % (family, family in HISTOGRAMS and
+                                           "histogram" or "counter"))
+        if labels:
+            name = "%s{%s}" % (name, ",".join(
+                ['%s="%s"' % (label, str(labelvalue).replace('"', '\\"'))
+                 for label, labelvalue in labels]))
+        lines.append("%s %r" % (name, value))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsView(zope.publisher.browser.BrowserView):
+    """
+    Return the validation metrics in the Prometheus text format.
+    """
+
+    def __call__(self):
+        metrics = zope.component.getUtility(interfaces.IValidationMetrics)
+        self.request.response.setHeader(
+            "Content-Type", "text/plain; version=0.0.4")
+        return formatPrometheus(metrics.collect())
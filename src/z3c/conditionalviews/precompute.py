@@ -0,0 +1,336 @@
+##############################################################################
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+##############################################################################
+"""
+Computing the validator data of modified content in the background.
+
+Entity tags computed from the content, like digests of it, can be expensive
+to compute. Normally the first request revalidating the content after it
+changed pays for it. When the `Precomputer` utility is registered, see
+`precompute.zcml`, the validator data of the default view of modified content
+is computed in a bounded pool of threads, in their own database connections,
+once the transaction modifying the content has committed. The data is stored
+in the `IValidatorDataCache`, where the validators find it.
+
+  >>> import threading
+  >>> import transaction
+  >>> import ZODB.DB
+  >>> import ZODB.MappingStorage
+  >>> import zope.component.event
+  >>> import zope.lifecycleevent
+  >>> from zope.publisher.browser import TestRequest
+  >>> from zope.publisher.interfaces import IDefaultViewName
+  >>> from zope.publisher.interfaces.browser import IDefaultBrowserLayer
+  >>> from z3c.conditionalviews import etag, invalidation
+
+  >>> from z3c.conditionalviews.tests import File as Document
+  >>> class DocumentView(object):
+  ...    def __init__(self, context, request):
+  ...        self.context, self.request = context, request
+
+  >>> computed = []
+  >>> gate, started = threading.Event(), threading.Event()
+  >>> gate.set()
+  >>> class DocumentETag(object):
+  ...    zope.interface.implements(interfaces.IETag)
+  ...    def __init__(self, context, request, view):
+  ...        started.set()
+  ...        gate.wait()
+  ...        computed.append(context.data)
+  ...        self.etag = context.data
+  ...    weak = False
+
+  >>> gsm = zope.component.getGlobalSiteManager()
+  >>> gsm.registerAdapter(DocumentETag, (Document, None, None))
+  >>> gsm.registerAdapter(
+  ...    DocumentView, (Document, IDefaultBrowserLayer),
+  ...    zope.interface.Interface, name = 'index.html')
+  >>> gsm.registerAdapter(
+  ...    'index.html', (Document, IDefaultBrowserLayer), IDefaultViewName)
+  >>> cache = invalidation.ValidatorDataCache()
+  >>> gsm.registerUtility(cache)
+  >>> precomputer = Precomputer()
+  >>> gsm.registerUtility(precomputer)
+  >>> gsm.registerHandler(zope.component.event.objectEventNotify)
+  >>> gsm.registerHandler(contentModified, (None,
+  ...    zope.lifecycleevent.interfaces.IObjectModifiedEvent))
+
+  >>> db = ZODB.DB(ZODB.MappingStorage.MappingStorage())
+  >>> connection = db.open()
+  >>> document = connection.root()['document'] = Document('v1')
+  >>> transaction.commit()
+
+Nothing is computed until the transaction modifying the document commits,
+and a document modified many times is only computed once.
+
+  >>> document.data = 'v2'
+  >>> zope.lifecycleevent.modified(document)
+  >>> zope.lifecycleevent.modified(document)
+  >>> computed
+  []
+  >>> transaction.commit()
+  >>> precomputer.join()
+  >>> computed
+  ['v2']
+
+Requests find the precomputed entity tag in the cache.
+
+  >>> request = TestRequest()
+  >>> view = DocumentView(document, request)
+  >>> etag.ETagValidator().getDataStorage(document, request, view).etag
+  'v2'
+  >>> computed
+  ['v2']
+
+Modifications that are aborted are not computed.
+
+  >>> document.data = 'v3'
+  >>> zope.lifecycleevent.modified(document)
+  >>> transaction.abort()
+  >>> precomputer.join()
+  >>> computed
+  ['v2']
+
+Backpressure
+============
+
+Content already waiting to be computed is not queued again. When the queue
+is full, content isn't computed in the background at all, and the first
+request revalidating it computes its data as before.
+
+  >>> slow = Precomputer(maxworkers = 1, maxqueue = 1)
+  >>> root = connection.root()
+  >>> for name in ('one', 'two', 'three'):
+  ...    root[name] = Document(name)
+  >>> transaction.commit()
+
+  >>> gate.clear(); started.clear()
+  >>> slow.submit(db, [root['one']._p_oid])
+  >>> started.wait(5)
+  True
+  >>> slow.submit(db, [root['two']._p_oid, root['two']._p_oid,
+  ...                  root['three']._p_oid])
+  >>> slow.deduplicated, slow.dropped
+  (1, 1)
+  >>> gate.set()
+  >>> slow.join()
+  >>> slow.computed
+  2
+
+Cleanup
+-------
+
+  >>> slow.shutdown()
+  >>> precomputer.shutdown()
+  >>> connection.close()
+  >>> db.close()
+  >>> gsm.unregisterAdapter(DocumentETag, (Document, None, None))
+  True
+  >>> gsm.unregisterAdapter(
+  ...    DocumentView, (Document, IDefaultBrowserLayer),
+  ...    zope.interface.Interface, name = 'index.html')
+  True
+  >>> gsm.unregisterAdapter(
+  ...    'index.html', (Document, IDefaultBrowserLayer), IDefaultViewName)
+  True
+  >>> gsm.unregisterUtility(cache)
+  True
+  >>> gsm.unregisterUtility(precomputer)
+  True
+  >>> gsm.unregisterHandler(zope.component.event.objectEventNotify)
+  True
+  >>> gsm.unregisterHandler(contentModified, (None,
+  ...    zope.lifecycleevent.interfaces.IObjectModifiedEvent))
+  True
+
+"""
+
+import logging
+import Queue
+import StringIO
+import threading
+
+import transaction
+import zope.component
+import zope.component.hooks
+import zope.component.interfaces
+import zope.interface
+import zope.publisher.browser
+import zope.publisher.defaultview
+from zope.security.proxy import removeSecurityProxy
+
+import interfaces
+import utils
+
+logger = logging.getLogger("z3c.conditionalviews")
+
+class Precomputer(object):
+    zope.interface.implements(interfaces.IValidatorDataPrecomputer)
+
+    def __init__(self, maxworkers = 2, maxqueue = 1000,
+                 datainterfaces = (interfaces.IETag,
+                                   interfaces.ILastModificationDate)):
+        self.maxworkers = maxworkers
+        self.datainterfaces = datainterfaces
+        self.computed = 0
+        # Content not queued because it was already waiting.
+        self.deduplicated = 0
+        # Content not queued because the queue was full.
+        self.dropped = 0
+        self._jobs = Queue.Queue(maxqueue)
+        self._workers = []
+        # (database, oid) of the content waiting to be computed.
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def queue(self, ob):
+        ob = removeSecurityProxy(ob)
+        txn = transaction.get()
+        if getattr(self._local, "txn", None) is not txn:
+            self._local.txn = txn
+            self._local.obs = {}
+            txn.addAfterCommitHook(self._afterCommit, (self._local.obs,))
+        # New content only gets its oid when the transaction commits.
+        self._local.obs[id(ob)] = ob
+
+    def _afterCommit(self, status, obs):
+        self._local.txn = None
+        if not status:
+            return
+        oids = {}
+        for ob in obs.values():
+            jar = getattr(ob, "_p_jar", None)
+            if jar is not None and ob._p_oid is not None:
+                oids.setdefault(jar.db(), []).append(ob._p_oid)
+        for db, dboids in oids.items():
+            self.submit(db, dboids)
+
+    def submit(self, db, oids):
+        """
+        Compute the validator data of the objects `oids` of the database
+        `db`, unless they are already waiting or the queue is full.
+        """
+        dropped = 0
+        self._lock.acquire()
+        try:
+            for oid in oids:
+                key = (id(db), oid)
+                if key in self._pending:
+                    self.deduplicated += 1
+                    continue
+                # Never wait for the queue, this is called after every commit.
+                try:
+                    self._jobs.put_nowait((db, oid))
+                except Queue.Full:
+                    dropped += 1
+                    continue
+                self._pending.add(key)
+                if len(self._workers) < self.maxworkers:
+                    worker = threading.Thread(target = self._worker)
+                    worker.setDaemon(True)
+                    worker.start()
+                    self._workers.append(worker)
+            self.dropped += dropped
+        finally:
+            self._lock.release()
+        if dropped:
+            logger.debug("Precomputing queue full, dropped %d objects",
+                         dropped)
+
+    def _worker(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                if job is None:
+                    return
+                db, oid = job
+                self._lock.acquire()
+                try:
+                    # Modifications made from now on are queued again.
+                    self._pending.discard((id(db), oid))
+                finally:
+                    self._lock.release()
+                try:
+                    self.compute(db, oid)
+                except Exception:
+                    logger.exception("Failed to precompute validator data")
+                else:
+                    self.computed += 1
+            finally:
+                self._jobs.task_done()
+
+    def site(self, ob):
+        while ob is not None:
+            if zope.component.interfaces.ISite.providedBy(ob):
+                return ob
+            ob = getattr(ob, "__parent__", None)
+        return None
+
+    def compute(self, db, oid):
+        cache = zope.component.queryUtility(interfaces.IValidatorDataCache)
+        if cache is None:
+            return
+        # Data invalidated while it is computed is not cached.
+        generation = cache.generation
+
+        manager = transaction.TransactionManager()
+        connection = db.open(transaction_manager = manager)
+        try:
+            ob = connection.get(oid)
+            key = utils.contentKey(ob)
+            zope.component.hooks.setSite(self.site(ob))
+            try:
+                request = zope.publisher.browser.BrowserRequest(
+                    StringIO.StringIO(""), {"REQUEST_METHOD": "GET"})
+                # Views are looked up on the default skin, like they are
+                # for published requests.
+                zope.publisher.browser.setDefaultSkin(request)
+                name = zope.publisher.defaultview.queryDefaultViewName(
+                    ob, request)
+                view = name and zope.component.queryMultiAdapter(
+                    (ob, request), name = name)
+                if view is None:
+                    return
+                for iface in self.datainterfaces:
+                    data = utils.snapshot(utils.adaptValidatorData(
+                        ob, request, view, iface), iface)
+                    cache.set(key, (utils.viewKey(view), iface), data,
+                              generation)
+            finally:
+                zope.component.hooks.setSite(None)
+        finally:
+            manager.abort()
+            connection.close()
+
+    def join(self):
+        """
+        Wait for all the queued content to be computed.
+        """
+        self._jobs.join()
+
+    def shutdown(self):
+        self._lock.acquire()
+        try:
+            workers, self._workers = self._workers, []
+        finally:
+            self._lock.release()
+        for worker in workers:
+            self._jobs.put(None)
+        for worker in workers:
+            worker.join()
+
+
+def contentModified(ob, event):
+    precomputer = zope.component.queryUtility(
+        interfaces.IValidatorDataPrecomputer)
+    if precomputer is not None:
+        precomputer.queue(ob)
@@ -0,0 +1,339 @@
+##############################################################################
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+##############################################################################
+"""
+Fetching the validator data of all the validators at the same time.
+
+Normally the validators look up their data one after the other, so when the
+`IETag` and `ILastModificationDate` adapters get their data from an external
+store the latencies add up. When the `ConcurrentDataFetcher` utility is
+registered, see `prefetch.zcml`, the data of all the validators evaluating a
+request is looked up concurrently in a bounded pool of threads instead.
+
+The lookups run in other threads than the request, so the adapters must not
+use the database connection, or the security interaction, of the request.
+This is only useful for adapters talking to external services.
+
+  >>> import os
+  >>> import shutil
+  >>> import sqlite3
+  >>> import tempfile
+  >>> import zope.component
+  >>> from zope.interface.verify import verifyObject
+  >>> from zope.publisher.browser import TestRequest
+  >>> import z3c.conditionalviews
+  >>> from z3c.conditionalviews import etag, lastmodification
+
+Our metadata store is a SQLite database, and each lookup takes a while.
+
+  >>> tmpdir = tempfile.mkdtemp()
+  >>> dbpath = os.path.join(tmpdir, 'metadata.db')
+  >>> db = sqlite3.connect(dbpath)
+  >>> db.execute('CREATE TABLE metadata (etag TEXT, lastmodified TEXT)')
+  <sqlite3.Cursor object at ...>
+  >>> db.execute("INSERT INTO metadata VALUES ('xyzzy', '2007-02-05')")
+  <sqlite3.Cursor object at ...>
+  >>> db.commit()
+  >>> db.close()
+
+  >>> def query(column):
+  ...    time.sleep(0.2)
+  ...    db = sqlite3.connect(dbpath)
+  ...    try:
+  ...        row = db.execute('SELECT %s FROM metadata' % column).fetchone()
+  ...        return row[0]
+  ...    finally:
+  ...        db.close()
+
+  >>> class StoredETag(object):
+  ...    zope.interface.implements(interfaces.IETag)
+  ...    def __init__(self, context, request, view):
+  ...        pass
+  ...    weak = False
+  ...    @property
+  ...    def etag(self):
+  ...        return str(query('etag'))
+
+  >>> import datetime, pytz
+  >>> class StoredLastModificationDate(object):
+  ...    zope.interface.implements(interfaces.ILastModificationDate)
+  ...    def __init__(self, context, request, view):
+  ...        pass
+  ...    @property
+  ...    def lastmodified(self):
+  ...        return datetime.datetime.strptime(
+  ...            query('lastmodified'), '%Y-%m-%d').replace(tzinfo = pytz.utc)
+
+  >>> gsm = zope.component.getGlobalSiteManager()
+  >>> gsm.registerAdapter(StoredETag, (None, None, None))
+  >>> gsm.registerAdapter(StoredLastModificationDate, (None, None, None))
+  >>> gsm.registerUtility(etag.ETagValidator(), name = 'http.etag')
+  >>> gsm.registerUtility(lastmodification.ModifiedSinceValidator(),
+  ...                     name = 'http.modifiedsince')
+
+  >>> class View(object):
+  ...    def __init__(self, context, request):
+  ...        self.context, self.request = context, request
+  ...    def render(self):
+  ...        return 'rendered'
+  >>> def publish(**environ):
+  ...    request = TestRequest(environ = environ)
+  ...    view = View(None, request)
+  ...    start = time.time()
+  ...    result = z3c.conditionalviews.validate(
+  ...        None, request, View.render.im_func, view)
+  ...    return result, request.response.getStatus(), time.time() - start
+
+  >>> environ = {'IF_NONE_MATCH': '"xyzzy"',
+  ...            'IF_MODIFIED_SINCE': 'Mon, 05 Feb 2007 00:00:00 GMT'}
+
+Each validator looks up its data twice, once when validating the request and
+once when updating the response. This takes its time.
+
+  >>> result, status, elapsed = publish(**environ)
+  >>> result, status, elapsed > 0.8
+  ('', 304, True)
+
+With the fetcher the data is looked up only once, and at the same time.
+
+  >>> fetcher = ConcurrentDataFetcher(maxworkers = 4, timeout = 1)
+  >>> verifyObject(interfaces.IValidatorDataFetcher, fetcher)
+  True
+  >>> gsm.registerUtility(fetcher)
+
+  >>> publish(**environ)[:2]
+  ('', 304)
+
+The time saved is reported.
+
+  >>> fetcher.fetches, fetcher.timeouts, fetcher.saved > 0.1
+  (2, 0, True)
+
+When the data isn't available in time a safe request is considered valid,
+and the view is rendered.
+
+  >>> fetcher.timeout = 0.05
+  >>> publish(**environ)[:2]
+  ('rendered', 599)
+  >>> fetcher.fetches, fetcher.timeouts
+  (4, 2)
+
+The preconditions of unsafe requests are never skipped, their data is looked
+up again in the request instead.
+
+  >>> publish(REQUEST_METHOD = 'PUT', IF_MATCH = '"other"')[:2]
+  ('', 412)
+  >>> fetcher.fetches, fetcher.timeouts
+  (5, 3)
+
+When too many lookups are waiting for a worker, the lookup is run in the
+request.
+
+  >>> full = ConcurrentDataFetcher(maxworkers = 0, maxqueue = 1)
+  >>> full.submit(lambda: 'queued').done.isSet()
+  False
+  >>> job = full.submit(lambda: 'inline')
+  >>> job.done.isSet(), job.result
+  (True, 'inline')
+
+Cleanup
+-------
+
+  >>> fetcher.shutdown()
+  >>> gsm.unregisterUtility(fetcher)
+  True
+  >>> gsm.unregisterUtility(name = 'http.etag',
+  ...    provided = interfaces.IHTTPValidator)
+  True
+  >>> gsm.unregisterUtility(name = 'http.modifiedsince',
+  ...    provided = interfaces.IHTTPValidator)
+  True
+  >>> gsm.unregisterAdapter(StoredETag, (None, None, None))
+  True
+  >>> gsm.unregisterAdapter(StoredLastModificationDate, (None, None, None))
+  True
+  >>> shutil.rmtree(tmpdir)
+
+"""
+
+import logging
+import Queue
+import threading
+import time
+
+import zope.component
+import zope.component.hooks
+import zope.interface
+
+import interfaces
+import utils
+
+logger = logging.getLogger("z3c.conditionalviews")
+
+# Requests which can be answered without their preconditions validated.
+SAFE_METHODS = ("GET", "HEAD")
+
+class TimedOutValidator(object):
+    """
+    Stands in for a validator whose data wasn't fetched in time. It
+    considers every safe request it evaluates valid, but the preconditions
+    of unsafe requests are still validated, looking up the data again.
+    """
+    zope.interface.implements(interfaces.IHTTPValidator)
+
+    def __init__(self, validator):
+        self.validator = validator
+
+    def evaluate(self, context, request, view):
+        return self.validator.evaluate(context, request, view)
+
+    def valid(self, context, request, view):
+        if request.method in SAFE_METHODS:
+            return True
+        return self.validator.valid(context, request, view)
+
+    def invalidStatus(self, context, request, view):
+        return self.validator.invalidStatus(context, request, view)
+
+    def updateResponse(self, context, request, view):
+        # Looking up the data again would only delay the response more.
+        if request.method not in SAFE_METHODS:
+            self.validator.updateResponse(context, request, view)
+
+
+class Job(object):
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.done = threading.Event()
+        self.result = None
+        self.failed = False
+        self.duration = 0
+
+    def __call__(self):
+        start = time.time()
+        try:
+            self.result = self.func(*self.args)
+        except Exception:
+            logger.exception("Failed to fetch validator data")
+            self.failed = True
+        self.duration = time.time() - start
+        self.done.set()
+
+
+class ConcurrentDataFetcher(object):
+    zope.interface.implements(interfaces.IValidatorDataFetcher)
+
+    def __init__(self, maxworkers = 8, timeout = 0.5, maxqueue = 100):
+        self.maxworkers = maxworkers
+        self.timeout = timeout
+        self.fetches = 0
+        self.timeouts = 0
+        # Total number of seconds saved by fetching concurrently.
+        self.saved = 0.0
+        # Lookups waiting for a worker, beyond which they run in the
+        # request.
+        self._jobs = Queue.Queue(maxqueue)
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def _worker(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            job()
+
+    def submit(self, func, *args):
+        self._lock.acquire()
+        try:
+            if len(self._workers) < self.maxworkers:
+                worker = threading.Thread(target = self._worker)
+                worker.setDaemon(True)
+                worker.start()
+                self._workers.append(worker)
+        finally:
+            self._lock.release()
+        job = Job(func, args)
+        try:
+            self._jobs.put_nowait(job)
+        except Queue.Full:
+            job()
+        return job
+
+    def shutdown(self):
+        self._lock.acquire()
+        try:
+            workers, self._workers = self._workers, []
+        finally:
+            self._lock.release()
+        for worker in workers:
+            self._jobs.put(None)
+        for worker in workers:
+            worker.join()
+
+    def lookup(self, site, context, request, view, iface):
+        # The local site is thread local.
+        zope.component.hooks.setSite(site)
+        try:
+            return utils.snapshot(utils.queryValidatorData(
+                context, request, view, iface), iface)
+        finally:
+            zope.component.hooks.setSite(None)
+
+    def fetch(self, context, request, view, validators):
+        prefetched = request.annotations.setdefault(utils.DATA_KEY, {})
+        site = zope.component.hooks.getSite()
+
+        jobs = {}
+        for validator in validators:
+            iface = getattr(validator, "datainterface", None)
+            if iface is None or \
+                   not validator.evaluate(context, request, view):
+                continue
+            key = utils.validatorDataKey(context, view, iface)
+            if key not in prefetched and key not in jobs:
+                jobs[key] = self.submit(
+                    self.lookup, site, context, request, view, iface)
+
+        start = time.time()
+        deadline = start + self.timeout
+        duration = 0
+        timedout = set()
+        for key, job in jobs.items():
+            job.done.wait(max(0, deadline - time.time()))
+            if job.done.isSet() and not job.failed:
+                prefetched[key] = job.result
+                duration += job.duration
+            else:
+                timedout.add(key)
+        elapsed = time.time() - start
+
+        self._lock.acquire()
+        try:
+            self.fetches += len(jobs)
+            self.timeouts += len(timedout)
+            self.saved += max(0, duration - elapsed)
+        finally:
+            self._lock.release()
+        if jobs:
+            logger.debug("Fetched %d validator data in %.3fs, saving %.3fs",
+                         len(jobs), elapsed, max(0, duration - elapsed))
+
+        result = []
+        for validator in validators:
+            iface = getattr(validator, "datainterface", None)
+            if iface is not None and \
+                   utils.validatorDataKey(context, view, iface) in timedout:
+                validator = TimedOutValidator(validator)
+            result.append(validator)
+        return result
@@ -0,0 +1,256 @@
+##############################################################################
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+##############################################################################
+
+import httplib
+import logging
+import Queue
+import threading
+import urlparse
+
+import transaction
+import zope.component
+import zope.interface
+
+import interfaces
+import surrogatekeys
+import utils
+
+logger = logging.getLogger("z3c.conditionalviews.purge")
+
+class PurgeDispatcher(object):
+    """
+    The purge dispatcher sends the surrogate keys of modified content to a
+    fronting HTTP cache.
+
+    In order to test this we need a stand-in for the cache that records
+    the purge requests it receives.
+
+      >>> import BaseHTTPServer
+      >>> received = []
+      >>> class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+      ...    def do_PURGE(self):
+      ...        received.append((self.command, self.path,
+      ...                         self.headers.get('xkey-purge')))
+      ...        self.send_response(200)
+      ...        self.send_header('Content-Length', '0')
+      ...        self.end_headers()
+      ...    def log_message(self, *args):
+      ...        pass
+
+      >>> server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+      >>> serverthread = threading.Thread(target = server.serve_forever)
+      >>> serverthread.start()
+      >>> endpoint = 'http://127.0.0.1:%d/purge' % server.server_address[1]
+
+      >>> from zope.interface.verify import verifyObject
+      >>> dispatcher = PurgeDispatcher(endpoint, batchsize = 2)
+      >>> verifyObject(interfaces.IPurgeDispatcher, dispatcher)
+      True
+
+    Keys are sent in batches, one request per batch.
+
+      >>> dispatcher.purge(['k1', 'k2', 'k3'])
+      >>> received
+      [('PURGE', '/purge', 'k1 k2'), ('PURGE', '/purge', 'k3')]
+
+    Queued keys are only sent once the current transaction commits, and
+    are only sent once. They are sent by a background worker, so the
+    request committing the transaction never waits for the cache.
+
+      >>> del received[:]
+      >>> txn = transaction.begin()
+      >>> dispatcher.queue(['k1', 'k2'])
+      >>> dispatcher.queue(['k2'])
+      >>> received
+      []
+      >>> transaction.commit()
+      >>> dispatcher.join()
+      >>> received
+      [('PURGE', '/purge', 'k1 k2')]
+
+    Nothing is sent when the transaction is aborted.
+
+      >>> del received[:]
+      >>> txn = transaction.begin()
+      >>> dispatcher.queue(['k1'])
+      >>> transaction.abort()
+      >>> txn = transaction.begin()
+      >>> dispatcher.queue(['k3'])
+      >>> transaction.commit()
+      >>> dispatcher.join()
+      >>> received
+      [('PURGE', '/purge', 'k3')]
+
+    When the worker falls behind, the keys are sent by the committing
+    request.
+
+      >>> del received[:]
+      >>> started, gate = threading.Event(), threading.Event()
+      >>> class SlowDispatcher(PurgeDispatcher):
+      ...    def purge(self, keys):
+      ...        if keys == ['k1']:
+      ...            started.set()
+      ...            gate.wait()
+      ...        PurgeDispatcher.purge(self, keys)
+      >>> slow = SlowDispatcher(endpoint, maxqueue = 1)
+      >>> slow.dispatch(['k1'])
+      >>> started.wait()
+      True
+      >>> slow.dispatch(['k2'])
+      >>> slow.dispatch(['k3'])
+      >>> received
+      [('PURGE', '/purge', 'k3')]
+      >>> gate.set()
+      >>> slow.join()
+      >>> [keys for method, path, keys in received]
+      ['k3', 'k1', 'k2']
+      >>> slow.shutdown()
+
+    A cache that is down never breaks the application, the error is only
+    logged.
+
+      >>> PurgeDispatcher('http://127.0.0.1:1/', timeout = 1).purge(['k1'])
+
+      >>> dispatcher.shutdown()
+      >>> server.shutdown()
+      >>> serverthread.join()
+      >>> server.server_close()
+
+    """
+    zope.interface.implements(interfaces.IPurgeDispatcher)
+
+    def __init__(self, endpoint, method = "PURGE", header = "xkey-purge",
+                 batchsize = 100, timeout = 5, maxqueue = 1000):
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(endpoint)
+        self.secure = scheme == "https"
+        self.netloc = netloc
+        self.path = (path or "/") + (query and "?" + query or "")
+        self.method = method
+        self.header = header
+        self.batchsize = batchsize
+        self.timeout = timeout
+        self._local = threading.local()
+        # Purges waiting for the worker, beyond which they are sent by the
+        # committing request.
+        self._jobs = Queue.Queue(maxqueue)
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def queue(self, keys):
+        txn = transaction.get()
+        if getattr(self._local, "txn", None) is not txn:
+            self._local.txn = txn
+            self._local.keys = set()
+            txn.addAfterCommitHook(self._afterCommit, (self._local.keys,))
+        self._local.keys.update(keys)
+
+    def _afterCommit(self, status, keys):
+        self._local.txn = None
+        if status and keys:
+            self.dispatch(sorted(keys))
+
+    def dispatch(self, keys):
+        """
+        Send the `keys` to the cache from the background worker.
+        """
+        self._lock.acquire()
+        try:
+            if self._worker is None:
+                self._worker = threading.Thread(target = self._work)
+                self._worker.setDaemon(True)
+                self._worker.start()
+        finally:
+            self._lock.release()
+        try:
+            self._jobs.put_nowait(keys)
+        except Queue.Full:
+            self.purge(keys)
+
+    def _work(self):
+        while True:
+            keys = self._jobs.get()
+            try:
+                if keys is None:
+                    return
+                self.purge(keys)
+            finally:
+                self._jobs.task_done()
+
+    def join(self):
+        """
+        Wait for all the dispatched keys to be sent.
+        """
+        self._jobs.join()
+
+    def shutdown(self):
+        self._lock.acquire()
+        try:
+            worker, self._worker = self._worker, None
+        finally:
+            self._lock.release()
+        if worker is not None:
+            self._jobs.put(None)
+            worker.join()
+
+    def purge(self, keys):
+        for start in range(0, len(keys), self.batchsize):
+            batch = keys[start:start + self.batchsize]
+            try:
+                self._send(batch)
+            except Exception:
+                logger.exception("Failed to purge %d keys from %s",
+                                 len(batch), self.netloc)
+
+    def _send(self, keys):
+        if self.secure:
+            conn = httplib.HTTPSConnection(self.netloc, timeout = self.timeout)
+        else:
+            conn = httplib.HTTPConnection(self.netloc, timeout = self.timeout)
+        try:
+            conn.request(self.method, self.path, "",
+                         {self.header: " ".join(keys)})
+            response = conn.getresponse()
+            response.read()
+            if response.status >= 400:
+                logger.warning("Purge request to %s returned %d",
+                               self.netloc, response.status)
+        finally:
+            conn.close()
+
+###############################################################################
+#
+# Event handlers queuing the surrogate keys of modified content.
+#
+###############################################################################
+
+def _queue(keys):
+    dispatcher = zope.component.queryUtility(interfaces.IPurgeDispatcher)
+    keys = [key for key in keys if key is not None]
+    if dispatcher is not None and keys:
+        dispatcher.queue(keys)
+
+
+def purgeModified(ob, event):
+    _queue([utils.contentKey(ob)])
+
+
+def purgeMoved(ob, event):
+    # Added and removed events are also moved events. The containers
+    # listings have changed as well as the object itself.
+    key = utils.contentKey(ob)
+    keys = [key, utils.contentKey(event.oldParent),
+            utils.contentKey(event.newParent)]
+    if event.newParent is None and key is not None:
+        # The object has been removed so any responses rendered from its
+        # sub-objects are no longer valid.
+        keys.append(surrogatekeys.treeKey(key))
+    _queue(keys)
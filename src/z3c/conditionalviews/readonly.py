@@ -0,0 +1,145 @@
+##############################################################################
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+##############################################################################
+"""
+Aborting the transaction of requests with nothing to commit.
+
+A request answered with `304 Not Modified` or `412 Precondition Failed` by
+the validators never called its view, and a `GET` or `HEAD` request which
+changed no persistent object has nothing to write either. Yet the
+publication commits their transaction, annotating it and running its
+commit hooks, and a commit which fails with a conflict error publishes the
+whole request again. Requests published by the
+`ReadOnlyConditionalHTTPRequest` doom the transaction of these requests
+instead, so the publication aborts it.
+
+Whether a safe request changed anything is found by taking a savepoint of
+its transaction, which stores the changed objects of the database
+connections of the request.
+
+  >>> import transaction
+  >>> import ZODB.DB
+  >>> import ZODB.MappingStorage
+  >>> import zope.component
+  >>> import zope.app.publication.http
+  >>> from zope.publisher.browser import TestRequest
+  >>> from z3c.conditionalviews import ConditionalPublication
+  >>> from z3c.conditionalviews.metrics import ValidationMetrics
+  >>> from z3c.conditionalviews.tests import File
+
+  >>> db = ZODB.DB(ZODB.MappingStorage.MappingStorage())
+  >>> connection = db.open()
+  >>> connection.root()['file'] = File('v1')
+  >>> transaction.commit()
+
+  >>> metrics = ValidationMetrics()
+  >>> zope.component.getGlobalSiteManager().registerUtility(metrics)
+  >>> def avoided():
+  ...    return [value for name, labels, value in metrics.collect()
+  ...            if name == 'z3c_conditionalviews_commits_avoided_total']
+
+  >>> publication = ConditionalPublication(
+  ...    zope.app.publication.http.HTTPPublication(db), readonly = True)
+  >>> def publish(method, status = 200, data = None):
+  ...    request = TestRequest(environ = {'REQUEST_METHOD': method})
+  ...    request.annotations[CONNECTION_KEY] = connection
+  ...    request.response.setStatus(status)
+  ...    ob = connection.root()['file']
+  ...    if data is not None:
+  ...        ob.data = data
+  ...    publication.afterCall(request, ob)
+
+Requests answered by the validators are not committed, whatever they
+changed.
+
+  >>> readOnly(TestRequest(environ = {'REQUEST_METHOD': 'PUT'}))
+  False
+  >>> publish('PUT', 412, data = 'v2')
+  >>> connection.root()['file'].data
+  'v1'
+  >>> avoided()
+  [1.0]
+
+Neither are safe requests which changed nothing.
+
+  >>> publish('GET')
+  >>> avoided()
+  [2.0]
+
+Safe requests which changed something, and unsafe requests, are committed
+as usual.
+
+  >>> publish('GET', data = 'v3')
+  >>> connection.root()['file'].data
+  'v3'
+  >>> publish('POST')
+  >>> avoided()
+  [2.0]
+
+As are safe requests with commit hooks registered, like a mail delivery.
+
+  >>> transaction.get().addAfterCommitHook(lambda status: None)
+  >>> publish('HEAD')
+  >>> avoided()
+  [2.0]
+
+Publications are only read-only when asked to.
+
+  >>> publication = ConditionalPublication(
+  ...    zope.app.publication.http.HTTPPublication(db))
+  >>> publish('GET', 304)
+  >>> avoided()
+  [2.0]
+
+Cleanup
+-------
+
+  >>> zope.component.getGlobalSiteManager().unregisterUtility(metrics)
+  True
+  >>> connection.close()
+  >>> db.close()
+
+"""
+
+import transaction
+
+# Key of the database connection of the request in its annotations, see
+# `zope.app.publication.zopepublication.ZopePublication.getApplication`.
+CONNECTION_KEY = "ZODB.interfaces.IConnection"
+
+# Methods which never change anything, see RFC 2616, section 9.1.1.
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+# Statuses of the requests the validators answered without calling the view.
+VALIDATED_STATUSES = (304, 412)
+
+def readOnly(request):
+    """
+    Return whether the transaction of the `request` has nothing to commit.
+    """
+    if request.response.getStatus() in VALIDATED_STATUSES:
+        return True
+    if request.method not in SAFE_METHODS:
+        return False
+    txn = transaction.get()
+    if txn.isDoomed():
+        return True
+    if list(txn.getBeforeCommitHooks()) or list(txn.getAfterCommitHooks()):
+        return False
+    connection = request.annotations.get(CONNECTION_KEY)
+    if connection is None:
+        # The changes can't be told.
+        return False
+    connections = connection.connections.values()
+    stores = [conn.getTransferCounts()[1] for conn in connections]
+    # Connections store their changed objects in the savepoint.
+    txn.savepoint(optimistic = True)
+    return stores == [conn.getTransferCounts()[1] for conn in connections]
@@ -0,0 +1,344 @@
+##############################################################################
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+##############################################################################
+"""
+Replaying access logs to estimate the savings of conditional views.
+
+The GET and HEAD requests of a Common or Combined Log Format file are replayed
+against an application, usually one using the `ConditionalHTTPRequest`. The
+log is read one line at a time, so it can be as big as needed.
+
+  >>> entry = parseLine('10.0.0.1 - - [10/Oct/2008:13:55:36 -0700] '
+  ...                   '"GET /file HTTP/1.1" 200 2326')
+  >>> entry['host'], entry['method'], entry['path'], entry['bytes']
+  ('10.0.0.1', 'GET', '/file', 2326)
+  >>> entry['ifnonematch'] is None
+  True
+  >>> parseLine('garbage') is None
+  True
+
+Logs can capture the conditional headers sent by the clients, after the
+Combined Log Format fields, for example with the Apache format
+`%h %l %u %t "%r" %>s %b "%{Referer}i" "%{User-agent}i" "%{If-None-Match}i"
+"%{If-Modified-Since}i"`.
+
+  >>> entry = parseLine('10.0.0.1 - - [10/Oct/2008:13:55:36 -0700] '
+  ...                   '"GET /file HTTP/1.1" 304 - "-" "Mozilla" '
+  ...                   '"\\\\"file:1\\\\"" "-"')
+  >>> entry['ifnonematch'], entry['ifmodifiedsince'], entry['bytes']
+  ('"file:1"', None, 0)
+
+When the headers were not captured, every client is assumed to keep a copy
+of everything it downloaded, and to revalidate it with the validators it was
+sent the last time.
+
+  >>> auth = 'Basic ' + base64.b64encode('mgr:mgrpw')
+  >>> status, headers, body = call(
+  ...    application, 'PUT', '/f',
+  ...    {'Authorization': auth, 'Content-Type': 'text/plain'}, 'x' * 500)
+  >>> status
+  '201 Created'
+
+  >>> log = StringIO.StringIO('''\\
+  ... 10.0.0.1 - - [10/Oct/2008:13:55:36 -0700] "GET /f HTTP/1.1" 200 500
+  ... 10.0.0.1 - - [10/Oct/2008:13:55:37 -0700] "GET /f HTTP/1.1" 200 500
+  ... 10.0.0.2 - - [10/Oct/2008:13:55:38 -0700] "GET /f HTTP/1.1" 200 500
+  ... 10.0.0.1 - - [10/Oct/2008:13:55:39 -0700] "GET /f HTTP/1.1" 200 500
+  ... 10.0.0.1 - - [10/Oct/2008:13:55:40 -0700] "POST /f HTTP/1.1" 200 0
+  ... ''')
+  >>> from z3c.conditionalviews.metrics import ValidationMetrics
+  >>> gsm = zope.component.getGlobalSiteManager()
+  >>> metrics = ValidationMetrics()
+  >>> gsm.registerUtility(metrics)
+  >>> report = replay(application, log, authorization = auth)
+  >>> report.requests, report.skipped
+  (4, 1)
+
+The metrics utility registered before the replay is restored, and it still
+got the measurements made during the replay.
+
+  >>> zope.component.getUtility(interfaces.IValidationMetrics) is metrics
+  True
+  >>> sum([value for name, labels, value in metrics.collect()
+  ...      if name == 'z3c_conditionalviews_responses_total'])
+  4.0
+  >>> gsm.unregisterUtility(metrics)
+  True
+
+The report projects the ratio of requests answered with `304 Not Modified`,
+and the bytes and render time saved, for every view.
+
+  >>> [view] = report.views.keys()
+  >>> view
+  ('zope.browserpage.metaconfigure.ViewFile', u'index.html')
+  >>> stats = report.views[view]
+  >>> stats.requests, stats.notmodified, stats.bytessaved
+  (4, 2, 1000)
+  >>> stats.rendertimeavoided > 0
+  True
+
+  >>> print report.format()
+  view                   requests  304 ratio  bytes saved  render seconds
+  ViewFile index.html           4       0.50         1000           ...
+  total                         4       0.50         1000           ...
+
+"""
+
+import base64
+import optparse
+import re
+import StringIO
+import sys
+import wsgiref.util
+
+import zope.component
+import zope.interface
+
+import interfaces
+import utils
+
+LINE = re.compile(
+    r'(?P<host>\S+) \S+ \S+ \[[^\]]*\] '
+    r'"(?P<method>[A-Z]+) (?P<path>\S+)[^"]*" '
+    r'(?P<status>\d{3}) (?P<bytes>\d+|-)'
+    r'(?: "(?:[^"\\]|\\.)*" "(?:[^"\\]|\\.)*"'
+    r'(?: "(?P<ifnonematch>(?:[^"\\]|\\.)*)"'
+    r' "(?P<ifmodifiedsince>(?:[^"\\]|\\.)*)")?)?')
+
+def _captured(value):
+    if value is None or value in ("", "-"):
+        return None
+    return value.replace('\\"', '"')
+
+
+def parseLine(line):
+    """
+    Return the fields of a line of an access log, or None if the line
+    couldn't be parsed.
+    """
+    match = LINE.match(line)
+    if match is None:
+        return None
+    entry = match.groupdict()
+    entry["captured"] = entry["ifnonematch"] is not None
+    entry["ifnonematch"] = _captured(entry["ifnonematch"])
+    entry["ifmodifiedsince"] = _captured(entry["ifmodifiedsince"])
+    entry["bytes"] = entry["bytes"] != "-" and int(entry["bytes"]) or 0
+    entry["status"] = int(entry["status"])
+    return entry
+
+
+def readLog(stream):
+    for line in stream:
+        yield parseLine(line)
+
+
+def call(application, method, path, headers = {}, body = ""):
+    """
+    Call a WSGI `application`, returning the status, headers and body of the
+    response.
+    """
+    path, query = (path.split("?", 1) + [""])[:2]
+    environ = {"REQUEST_METHOD": method,
+               "PATH_INFO": path,
+               "QUERY_STRING": query,
+               "CONTENT_LENGTH": str(len(body)),
+               "wsgi.input": StringIO.StringIO(body),
+               }
+    for name, value in headers.items():
+        name = name.upper().replace("-", "_")
+        if name != "CONTENT_TYPE":
+            name = "HTTP_" + name
+        environ[name] = value
+    wsgiref.util.setup_testing_defaults(environ)
+
+    response = []
+    def start_response(status, headers, exc_info = None):
+        response[:] = [status, dict([(name.lower(), value)
+                                     for name, value in headers])]
+    result = application(environ, start_response)
+    try:
+        body = "".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return response[0], response[1], body
+
+
+class ReplayMetrics(object):
+    """
+    Remembers the answer to the last request replayed, passing the
+    measurements on to the `metrics` it stands in for, if any.
+    """
+    zope.interface.implements(interfaces.IValidationMetrics)
+
+    last = None
+
+    def __init__(self, metrics = None):
+        self.metrics = metrics
+
+    def instrument(self, validators):
+        if self.metrics is not None:
+            return self.metrics.instrument(validators)
+        return [validator for name, validator in validators]
+
+    def record(self, view, status, rendertime, result):
+        self.last = (utils.viewKey(view), status, rendertime)
+        if self.metrics is not None:
+            self.metrics.record(view, status, rendertime, result)
+
+    def count(self, name):
+        if self.metrics is not None:
+            self.metrics.count(name)
+
+    def collect(self):
+        if self.metrics is not None:
+            return self.metrics.collect()
+        return []
+
+
+class ViewStats(object):
+
+    def __init__(self):
+        self.requests = self.notmodified = self.bytessaved = 0
+        self.renders = 0
+        self.rendertime = 0.0
+
+    @property
+    def rendertimeavoided(self):
+        if not self.renders:
+            return 0.0
+        return self.notmodified * self.rendertime / self.renders
+
+
+class Report(object):
+
+    def __init__(self):
+        # view key -> ViewStats
+        self.views = {}
+        self.requests = self.skipped = 0
+
+    def add(self, view, entry, notmodified, rendertime):
+        stats = self.views.get(view)
+        if stats is None:
+            stats = self.views[view] = ViewStats()
+        stats.requests += 1
+        if rendertime is not None:
+            stats.renders += 1
+            stats.rendertime += rendertime
+        if notmodified:
+            stats.notmodified += 1
+            # The size of the response sent when the log was written.
+            stats.bytessaved += entry["bytes"]
+
+    def format(self):
+        lines = ["%-22s %8s  %9s  %11s  %14s" % (
+            "view", "requests", "304 ratio", "bytes saved",
+            "render seconds")]
+        total = ViewStats()
+        for view, stats in sorted(self.views.items()):
+            if view is not None:
+                name = "%s %s" % (view[0].split(".")[-1], view[1])
+            else:
+                name = "(not validated)"
+            lines.append("%-22s %8d  %9.2f  %11d  %14.3f" % (
+                name, stats.requests,
+                stats.notmodified / float(stats.requests),
+                stats.bytessaved, stats.rendertimeavoided))
+            total.requests += stats.requests
+            total.notmodified += stats.notmodified
+            total.bytessaved += stats.bytessaved
+        lines.append("%-22s %8d  %9.2f  %11d  %14.3f" % (
+            "total", total.requests,
+            total.notmodified / float(total.requests or 1),
+            total.bytessaved,
+            sum([stats.rendertimeavoided for stats in self.views.values()])))
+        return "\n".join(lines)
+
+
+def replay(application, stream, authorization = None,
+           maxclientcopies = 100000):
+    """
+    Replay the GET and HEAD requests of the access log `stream` against a
+    WSGI `application`, returning a `Report`.
+    """
+    gsm = zope.component.getGlobalSiteManager()
+    previous = gsm.queryUtility(interfaces.IValidationMetrics)
+    metrics = ReplayMetrics(previous)
+    report = Report()
+    # (client, path) -> conditional headers of the client's copy
+    copies = utils.BoundedCache(
+        maxentries = maxclientcopies, maxsize = maxclientcopies,
+        maxage = sys.maxint)
+
+    gsm.registerUtility(metrics)
+    try:
+        for entry in readLog(stream):
+            if entry is None or entry["method"] not in ("GET", "HEAD"):
+                report.skipped += 1
+                continue
+
+            headers = {}
+            if authorization is not None:
+                headers["Authorization"] = authorization
+            if entry["captured"]:
+                copy = {"If-None-Match": entry["ifnonematch"],
+                        "If-Modified-Since": entry["ifmodifiedsince"]}
+            else:
+                copy = copies.get((entry["host"], entry["path"])) or {}
+            for name, value in copy.items():
+                if value is not None:
+                    headers[name] = value
+
+            metrics.last = None
+            status, responseheaders, body = call(
+                application, entry["method"], entry["path"], headers)
+            copies.add((entry["host"], entry["path"]),
+                       {"If-None-Match": responseheaders.get("etag"),
+                        "If-Modified-Since":
+                            responseheaders.get("last-modified")},
+                       1)
+
+            view = rendertime = None
+            if metrics.last is not None:
+                view, invalidstatus, rendertime = metrics.last
+            report.requests += 1
+            report.add(view, entry, status.startswith("304"), rendertime)
+    finally:
+        gsm.unregisterUtility(metrics)
+        if previous is not None:
+            gsm.registerUtility(previous, interfaces.IValidationMetrics)
+    return report
+
+
+def main(argv = None):
+    parser = optparse.OptionParser(
+        usage = "%prog [options] zope.conf access.log",
+        description = "Replay the GET and HEAD requests of an access log "
+                      "against an application, and estimate what "
+                      "conditional views save.")
+    parser.add_option("-u", "--user", metavar = "LOGIN:PASSWORD",
+                      help = "authenticate the replayed requests")
+    options, args = parser.parse_args(argv)
+    if len(args) != 2:
+        parser.error("expected a configuration file and an access log")
+
+    import zope.app.wsgi
+    application = zope.app.wsgi.getWSGIApplication(args[0])
+    authorization = options.user and \
+                    "Basic " + base64.b64encode(options.user) or None
+    log = args[1] == "-" and sys.stdin or open(args[1])
+    try:
+        report = replay(application, log, authorization)
+    finally:
+        log.close()
+    print(report.format())
+    return 0
@@ -0,0 +1,273 @@
+##############################################################################
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+##############################################################################
+"""
+Conditional, fingerprinted browser resources.
+
+Static files registered with the `browser:resource` directive are served by
+`ConditionalFileResource`s when `resources.zcml` is included. Their entity
+tag is the digest of the file, computed once when the resource is
+registered and kept in an in-memory table, so a conditional request is
+answered without reading the file or its modification time again.
+
+The URL of these resources carries the digest of the file, as in
+`http://127.0.0.1/++fp++<digest>/@@/style.css`, so they are cached for a
+year, `immutable`, and a changed file gets a new URL.
+
+  >>> import os
+  >>> import shutil
+  >>> import tempfile
+  >>> import zope.component.hooks
+  >>> from zope.interface.verify import verifyObject
+  >>> from zope.publisher.browser import TestRequest
+  >>> from zope.traversing.browser.interfaces import IAbsoluteURL
+  >>> from zope.traversing.interfaces import ITraversable
+  >>> from z3c.conditionalviews import etag, lastmodification
+
+  >>> tmpdir = tempfile.mkdtemp()
+  >>> path = os.path.join(tmpdir, 'style.css')
+  >>> open(path, 'w').write('body { color: black }')
+  >>> factory = ConditionalFileResourceFactory(path, None, 'style.css')
+
+  >>> gsm = zope.component.getGlobalSiteManager()
+  >>> for adapter in (ResourceETag, ResourceLastModificationDate,
+  ...                 FingerprintedURL):
+  ...    gsm.registerAdapter(adapter)
+  >>> gsm.registerAdapter(FingerprintNamespace, name = 'fp')
+  >>> gsm.registerUtility(etag.ETagValidator(), name = 'http.etag')
+  >>> gsm.registerUtility(lastmodification.ModifiedSinceValidator(),
+  ...                     name = 'http.modifiedsince')
+
+  >>> class Site(object):
+  ...    zope.interface.implements(IAbsoluteURL)
+  ...    def __init__(self, context, request):
+  ...        pass
+  ...    def __str__(self):
+  ...        return 'http://127.0.0.1'
+  >>> gsm.registerAdapter(Site, (None, None), IAbsoluteURL)
+  >>> zope.component.hooks.setSite(None)
+
+  >>> request = TestRequest()
+  >>> resource = factory(request)
+  >>> resource.GET()
+  'body { color: black }'
+  >>> request.response.getHeader('ETag')
+  '"8a68ffec370c578e94e71a6ec039324d"'
+  >>> request.response.getHeader('Content-Type')
+  'text/css'
+  >>> request.response.getHeader('Cache-Control')
+  'public,max-age=86400'
+
+  >>> data = ResourceETag(None, request, resource)
+  >>> verifyObject(interfaces.IETag, data)
+  True
+
+The URL of the resource carries the digest of the file.
+
+  >>> url = resource()
+  >>> url
+  'http://127.0.0.1/++fp++8a68ffec370c578e94e71a6ec039324d/@@/style.css'
+
+The `++fp++` namespace only records the digest requested, and resources
+requested with their current digest are cached for a year.
+
+  >>> def traverse(request, digest):
+  ...    return zope.component.getMultiAdapter(
+  ...        (site, request), ITraversable, name = 'fp').traverse(digest, [])
+  >>> request = TestRequest()
+  >>> site = object()
+  >>> traverse(request, '8a68ffec370c578e94e71a6ec039324d') is site
+  True
+  >>> factory(request).GET()
+  'body { color: black }'
+  >>> request.response.getHeader('Cache-Control')
+  'public, max-age=31536000, immutable'
+
+Resources requested with the digest of a previous version of the file are
+still served, but not cached for long.
+
+  >>> request = TestRequest()
+  >>> traverse(request, '0ld') is site
+  True
+  >>> factory(request).GET()
+  'body { color: black }'
+  >>> request.response.getHeader('Cache-Control')
+  'public,max-age=86400'
+
+Conditional requests are answered from the digest table.
+
+  >>> request = TestRequest(environ = {
+  ...    'IF_NONE_MATCH': '"8a68ffec370c578e94e71a6ec039324d"'})
+  >>> factory(request).GET()
+  ''
+  >>> request.response.getStatus()
+  304
+
+  >>> request = TestRequest(environ = {
+  ...    'IF_NONE_MATCH': '"8a68ffec370c578e94e71a6ec039324d"',
+  ...    'REQUEST_METHOD': 'HEAD'})
+  >>> factory(request).HEAD()
+  ''
+  >>> request.response.getStatus()
+  304
+
+Cleanup
+-------
+
+  >>> for adapter in (ResourceETag, ResourceLastModificationDate,
+  ...                 FingerprintedURL):
+  ...    gsm.unregisterAdapter(adapter)
+  True
+  True
+  True
+  >>> gsm.unregisterAdapter(FingerprintNamespace, name = 'fp')
+  True
+  >>> gsm.unregisterAdapter(Site, (None, None), IAbsoluteURL)
+  True
+  >>> gsm.unregisterUtility(name = 'http.etag',
+  ...    provided = interfaces.IHTTPValidator)
+  True
+  >>> gsm.unregisterUtility(name = 'http.modifiedsince',
+  ...    provided = interfaces.IHTTPValidator)
+  True
+  >>> shutil.rmtree(tmpdir)
+
+"""
+
+import datetime
+import hashlib
+
+import pytz
+import zope.component
+import zope.interface
+import zope.browserresource.file
+import zope.browserresource.resource
+import zope.publisher.interfaces.browser
+import zope.traversing.interfaces
+from zope.browserresource.interfaces import IFileResource
+
+import z3c.conditionalviews
+import interfaces
+
+# Key of the digest requested through the `++fp++` namespace in the request
+# annotations.
+DIGEST_KEY = "z3c.conditionalviews.resources.digest"
+
+# Cache-Control header of the resources requested with their digest.
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+# path of a file -> (modification time, digest of the file)
+_digests = {}
+
+def digest(file):
+    """
+    Return the digest of the `file` of a file resource, computed once.
+    """
+    entry = _digests.get(file.path)
+    if entry is None or entry[0] != file.lmt:
+        entry = _digests[file.path] = (
+            file.lmt, hashlib.md5(file.data).hexdigest())
+    return entry[1]
+
+
+class ConditionalFileResource(zope.browserresource.file.FileResource):
+    """
+    File resource validated by the conditional view validators.
+    """
+
+    def _setHeaders(self, file):
+        response = self.request.response
+        response.setHeader("Content-Type", file.content_type)
+        response.setHeader("Last-Modified", file.lmh)
+        if self.request.annotations.get(DIGEST_KEY) == digest(file):
+            response.setHeader("Cache-Control", IMMUTABLE)
+        else:
+            zope.browserresource.file.setCacheControl(
+                response, self.cacheTimeout)
+
+    @z3c.conditionalviews.ConditionalView
+    def GET(self):
+        file = self.chooseContext()
+        self._setHeaders(file)
+        return file.data
+
+    @z3c.conditionalviews.ConditionalView
+    def HEAD(self):
+        self._setHeaders(self.chooseContext())
+        return ""
+
+
+class ConditionalFileResourceFactory(
+    zope.browserresource.file.FileResourceFactory):
+    """
+    Factory of `ConditionalFileResource`s, computing the digest of the file
+    as the resource is registered.
+    """
+
+    resourceClass = ConditionalFileResource
+
+    def __init__(self, path, checker, name):
+        super(ConditionalFileResourceFactory, self).__init__(
+            path, checker, name)
+        digest(self(None).context)
+
+
+class ResourceETag(object):
+    zope.interface.implements(interfaces.IETag)
+    zope.component.adapts(zope.interface.Interface,
+                          zope.publisher.interfaces.browser.IBrowserRequest,
+                          IFileResource)
+
+    weak = False
+
+    def __init__(self, context, request, view):
+        self.etag = digest(view.chooseContext())
+
+
+class ResourceLastModificationDate(object):
+    zope.interface.implements(interfaces.ILastModificationDate)
+    zope.component.adapts(zope.interface.Interface,
+                          zope.publisher.interfaces.browser.IBrowserRequest,
+                          IFileResource)
+
+    def __init__(self, context, request, view):
+        self.lastmodified = datetime.datetime.fromtimestamp(
+            int(view.chooseContext().lmt), pytz.utc)
+
+
+class FingerprintedURL(zope.browserresource.resource.AbsoluteURL):
+    """
+    URL of a conditional file resource, carrying the digest of its file.
+    """
+    zope.component.adapts(ConditionalFileResource,
+                          zope.publisher.interfaces.browser.IBrowserRequest)
+
+    def _createUrl(self, baseUrl, name):
+        return "%s/++fp++%s/@@/%s" % (
+            baseUrl, digest(self.context.chooseContext()), name)
+
+
+class FingerprintNamespace(object):
+    """
+    The `++fp++<digest>` namespace, recording the digest of the resource
+    requested.
+    """
+    zope.interface.implements(zope.traversing.interfaces.ITraversable)
+    zope.component.adapts(zope.interface.Interface,
+                          zope.publisher.interfaces.browser.IBrowserRequest)
+
+    def __init__(self, context, request):
+        self.context = context
+        self.request = request
+
+    def traverse(self, name, ignored):
+        self.request.annotations[DIGEST_KEY] = name
+        return self.context
@@ -0,0 +1,398 @@
+##############################################################################
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+##############################################################################
+"""
+Validator data cache shared by all the processes on a machine.
+
+With many worker processes, every `ValidatorDataCache` caches the same data
+again. The `SharedValidatorTable` is an `IValidatorDataCache` stored in a
+memory mapped file, shared by all the processes mapping it. It is a fixed
+size open addressing hash table, keyed by the content, view and validator
+data interface, storing entity tags of up to 64 bytes and last modification
+dates.
+
+Reading is lock free. Every slot has a sequence number, odd while the slot is
+being written, and readers retry when it changed while they were reading.
+Writers are serialized with a lock on the file.
+
+  >>> import datetime
+  >>> import os, shutil, tempfile
+  >>> from zope.interface.verify import verifyObject
+  >>> from zope.publisher.browser import TestRequest
+  >>> from z3c.conditionalviews import etag, lastmodification
+
+  >>> tmpdir = tempfile.mkdtemp()
+  >>> path = os.path.join(tmpdir, 'validators.table')
+  >>> table = SharedValidatorTable(path, slots = 64, buckets = 16)
+  >>> verifyObject(interfaces.IValidatorDataCache, table)
+  True
+
+  >>> class Content(object):
+  ...    _p_oid = '\\x00' * 7 + '\\x01'
+
+  >>> computed = []
+  >>> class ContentETag(object):
+  ...    zope.interface.implements(interfaces.IETag)
+  ...    def __init__(self, context, request, view):
+  ...        computed.append('etag')
+  ...    weak = True
+  ...    etag = 'd41d8cd98f00b204e9800998ecf8427e'
+  >>> class ContentLastModified(object):
+  ...    zope.interface.implements(interfaces.ILastModificationDate)
+  ...    def __init__(self, context, request, view):
+  ...        computed.append('lastmodified')
+  ...    lastmodified = datetime.datetime(2007, 2, 5, 5, 43, 23, 500)
+
+  >>> gsm = zope.component.getGlobalSiteManager()
+  >>> gsm.registerAdapter(ContentETag, (None, None, None))
+  >>> gsm.registerAdapter(ContentLastModified, (None, None, None))
+  >>> gsm.registerUtility(table)
+
+  >>> content = Content()
+  >>> etagentry = (utils.viewKey(None), interfaces.IETag)
+  >>> lmentry = (utils.viewKey(None), interfaces.ILastModificationDate)
+  >>> etagvalidator = etag.ETagValidator()
+  >>> lmvalidator = lastmodification.ModifiedSinceValidator()
+  >>> data = etagvalidator.getDataStorage(content, TestRequest(), None)
+  >>> data = lmvalidator.getDataStorage(content, TestRequest(), None)
+  >>> computed
+  ['etag', 'lastmodified']
+
+Another process mapping the same file finds the validator data.
+
+  >>> other = SharedValidatorTable(path)
+  >>> other.slots
+  64
+  >>> data = other.get('0000000000000001', etagentry)
+  >>> data.etag, data.weak
+  ('d41d8cd98f00b204e9800998ecf8427e', True)
+  >>> other.get('0000000000000001', lmentry).lastmodified
+  datetime.datetime(2007, 2, 5, 5, 43, 23, 500, tzinfo=<UTC>)
+
+And so do the validators.
+
+  >>> gsm.unregisterUtility(table)
+  True
+  >>> gsm.registerUtility(other)
+  >>> etagvalidator.getDataStorage(content, TestRequest(), None).etag
+  'd41d8cd98f00b204e9800998ecf8427e'
+  >>> computed
+  ['etag', 'lastmodified']
+
+Invalidating content in one process invalidates it in all of them.
+
+  >>> table.invalidate(['0000000000000001'])
+  >>> other.get('0000000000000001', etagentry) is None
+  True
+  >>> other.generation == table.generation
+  True
+
+Data computed before the invalidation is not stored.
+
+  >>> generation = other.generation
+  >>> table.invalidate(['0000000000000002'])
+  >>> other.set('0000000000000001', etagentry,
+  ...           ContentETag(None, None, None), generation)
+  >>> other.get('0000000000000001', etagentry) is None
+  True
+
+Entity tags longer then 64 bytes, and data of other interfaces, are not
+stored at all.
+
+  >>> class LongETag(object):
+  ...    etag = 'x' * 65
+  ...    weak = False
+  >>> other.set('0000000000000001', etagentry, LongETag())
+  >>> other.get('0000000000000001', etagentry) is None
+  True
+  >>> other.set('0000000000000001', (None, zope.interface.Interface), 'x')
+  >>> other.get('0000000000000001', (None, zope.interface.Interface), 'no')
+  'no'
+
+A slot left half written by a process which died while writing it is a
+miss, until it is written again.
+
+  >>> index = other._hash('0000000000000003', etagentry) % other.slots
+  >>> other.set('0000000000000003', etagentry,
+  ...           ContentETag(None, None, None))
+  >>> offset = other._slotsoffset + index * SLOT.size
+  >>> sequence = struct.unpack_from('<I', other._map, offset)[0]
+  >>> struct.pack_into('<I', other._map, offset, sequence + 1)
+  >>> other.get('0000000000000003', etagentry) is None
+  True
+  >>> other.set('0000000000000003', etagentry,
+  ...           ContentETag(None, None, None))
+  >>> other.get('0000000000000003', etagentry).etag
+  'd41d8cd98f00b204e9800998ecf8427e'
+  >>> struct.unpack_from('<I', other._map, offset)[0] % 2
+  0
+
+Flushing the table drops everything.
+
+  >>> other.set('0000000000000003', etagentry,
+  ...           ContentETag(None, None, None))
+  >>> table.flush()
+  >>> other.get('0000000000000003', etagentry) is None
+  True
+
+Cleanup
+-------
+
+  >>> gsm.unregisterUtility(other)
+  True
+  >>> gsm.unregisterAdapter(ContentETag, (None, None, None))
+  True
+  >>> gsm.unregisterAdapter(ContentLastModified, (None, None, None))
+  True
+  >>> table.close()
+  >>> other.close()
+  >>> shutil.rmtree(tmpdir)
+
+"""
+
+import calendar
+import datetime
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+import pytz
+import zope.interface
+
+import interfaces
+import utils
+
+MAGIC = "Z3CCVT01"
+
+# magic, slots, buckets, generation, flushed generation
+HEADER = struct.Struct("<8sIIQQ")
+
+# sequence number, key hash, generation, kind, weak, length,
+# microseconds since the epoch, etag
+SLOT = struct.Struct("<IQQBBHq64s")
+
+GENERATION = struct.Struct("<Q")
+
+MAXETAG = 64
+
+EMPTY, ETAG, LASTMODIFIED, NODATA = range(4)
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo = pytz.utc)
+
+# Slots probed for a key before overwriting its first slot.
+PROBES = 8
+
+# Reads of a slot being written before it is taken for a miss. A writer
+# which died half way leaves its slot marked as being written until it is
+# written again.
+RETRIES = 100
+
+class SharedValidatorTable(object):
+    zope.interface.implements(interfaces.IValidatorDataCache)
+
+    def __init__(self, path, slots = 65536, buckets = 65536):
+        self.path = path
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            header = os.read(self._fd, HEADER.size)
+            if len(header) == HEADER.size and header[:8] == MAGIC:
+                # Created by another process.
+                magic, slots, buckets, generation, flushed = \
+                       HEADER.unpack(header)
+            else:
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, HEADER.size +
+                             buckets * GENERATION.size + slots * SLOT.size)
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                os.write(self._fd, HEADER.pack(MAGIC, slots, buckets, 0, 0))
+            self.slots = slots
+            self.buckets = buckets
+            self._map = mmap.mmap(
+                self._fd, HEADER.size + buckets * GENERATION.size +
+                slots * SLOT.size)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._slotsoffset = HEADER.size + buckets * GENERATION.size
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    # The generation and the flushed generation are only ever written whole
+    # by a single writer, and only increase.
+
+    def _header(self):
+        return HEADER.unpack_from(self._map, 0)
+
+    @property
+    def generation(self):
+        return self._header()[3]
+
+    def _bucketGeneration(self, key):
+        bucket = int(hashlib.md5(key).hexdigest()[:8], 16) % self.buckets
+        return bucket, HEADER.size + bucket * GENERATION.size
+
+    def _hash(self, key, entry):
+        view, iface = entry
+        digest = hashlib.md5("%s\0%r\0%s.%s" % (
+            key, view, iface.__module__, iface.__name__)).digest()
+        return struct.unpack("<Q", digest[:8])[0] or 1
+
+    def _readSlot(self, index):
+        """
+        Return the values of the slot at `index`, or None when it is still
+        being written after `RETRIES` reads.
+        """
+        offset = self._slotsoffset + index * SLOT.size
+        for retry in range(RETRIES):
+            before = struct.unpack_from("<I", self._map, offset)[0]
+            if before % 2 == 0:
+                slot = SLOT.unpack_from(self._map, offset)
+                if struct.unpack_from("<I", self._map, offset)[0] == before:
+                    return slot
+            # Being written, let the writer run.
+            time.sleep(0)
+        return None
+
+    def _writeSlot(self, index, values):
+        offset = self._slotsoffset + index * SLOT.size
+        sequence = struct.unpack_from("<I", self._map, offset)[0]
+        # Left odd by a writer which died half way.
+        sequence += sequence % 2
+        struct.pack_into("<I", self._map, offset, (sequence + 1) % 2 ** 32)
+        SLOT.pack_into(self._map, offset, (sequence + 1) % 2 ** 32, *values)
+        struct.pack_into("<I", self._map, offset, (sequence + 2) % 2 ** 32)
+
+    def _valid(self, key, slot):
+        magic, slots, buckets, generation, flushed = self._header()
+        bucket, offset = self._bucketGeneration(key)
+        invalidated = GENERATION.unpack_from(self._map, offset)[0]
+        return slot[2] >= max(invalidated, flushed)
+
+    def get(self, key, entry, default = None):
+        if entry[1] not in (interfaces.IETag,
+                            interfaces.ILastModificationDate):
+            return default
+        keyhash = self._hash(key, entry)
+        start = keyhash % self.slots
+        for probe in range(PROBES):
+            slot = self._readSlot((start + probe) % self.slots)
+            if slot is not None and slot[1] == keyhash and \
+                   slot[3] != EMPTY:
+                break
+        else:
+            return default
+        if not self._valid(key, slot):
+            return default
+
+        sequence, keyhash, generation, kind, weak, length, mtime, etag = slot
+        if kind == NODATA:
+            return None
+        if kind == ETAG:
+            data = utils.Snapshot()
+            data.etag = etag[:length]
+            data.weak = bool(weak)
+            zope.interface.alsoProvides(data, interfaces.IETag)
+            return data
+        data = utils.Snapshot()
+        data.lastmodified = EPOCH + datetime.timedelta(microseconds = mtime)
+        zope.interface.alsoProvides(data, interfaces.ILastModificationDate)
+        return data
+
+    def _encode(self, iface, data):
+        if interfaces.IVariantValidatorData.providedBy(data):
+            # The headers the data varies on are not stored.
+            return None
+        if iface == interfaces.IETag:
+            etag = getattr(data, "etag", None)
+            if etag is None:
+                return (NODATA, 0, 0, 0, "")
+            if isinstance(etag, unicode):
+                etag = etag.encode("utf-8")
+            if not isinstance(etag, str) or len(etag) > MAXETAG:
+                return None
+            return (ETAG, data.weak and 1 or 0, len(etag), 0, etag)
+        if iface == interfaces.ILastModificationDate:
+            lastmodified = getattr(data, "lastmodified", None)
+            if lastmodified is None:
+                return (NODATA, 0, 0, 0, "")
+            mtime = calendar.timegm(lastmodified.utctimetuple()) * 1000000 + \
+                    lastmodified.microsecond
+            return (LASTMODIFIED, 0, 0, mtime, "")
+        return None
+
+    def _write(self, func):
+        # Only one writer at a time, in this and all the other processes.
+        self._lock.acquire()
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                return func()
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            self._lock.release()
+
+    def set(self, key, entry, data, generation = None):
+        values = self._encode(entry[1], data)
+        if values is None:
+            return
+        keyhash = self._hash(key, entry)
+        def write():
+            current = self.generation
+            if generation is not None and generation != current:
+                return
+            start = keyhash % self.slots
+            index = None
+            for probe in range(PROBES):
+                candidate = (start + probe) % self.slots
+                slot = self._readSlot(candidate)
+                if slot is None:
+                    # Only a dead writer leaves a slot being written while
+                    # we hold the lock.
+                    if index is None:
+                        index = candidate
+                    continue
+                if slot[1] == keyhash:
+                    index = candidate
+                    break
+                if index is None and (slot[3] == EMPTY or
+                                      slot[2] < current):
+                    # Empty, or possibly stale.
+                    index = candidate
+            if index is None:
+                index = start
+            self._writeSlot(index, (keyhash, current) + values)
+        self._write(write)
+
+    def invalidate(self, keys):
+        def write():
+            magic, slots, buckets, generation, flushed = self._header()
+            generation += 1
+            for key in keys:
+                bucket, offset = self._bucketGeneration(key)
+                GENERATION.pack_into(self._map, offset, generation)
+            HEADER.pack_into(self._map, 0, magic, slots, buckets,
+                             generation, flushed)
+        self._write(write)
+
+    def flush(self):
+        def write():
+            magic, slots, buckets, generation, flushed = self._header()
+            HEADER.pack_into(self._map, 0, magic, slots, buckets,
+                             generation + 1, generation + 1)
+        self._write(write)
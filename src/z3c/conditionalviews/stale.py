@@ -0,0 +1,383 @@
+##############################################################################
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+##############################################################################
+"""
+Serving stale responses while they are revalidated in the background.
+
+Slow views, like reports, keep their users waiting even when a slightly
+stale copy of the response would do. When the `StaleWhileRevalidateFilter`
+is registered, see `stale.zcml`, the last response rendered by a view of
+some content is kept. For as long as it is younger than the staleness window
+it is returned straight away, with the validators it was rendered with, and
+the view is rendered again in a background thread, in its own database
+connection. Only one refresh of a response runs at a time.
+
+Only the GET requests of persistent content to named views providing
+`IStaleWhileRevalidateView`, going through the `__call__` method of the
+view, are served stale.
+
+  >>> import transaction
+  >>> import ZODB.DB
+  >>> import ZODB.MappingStorage
+  >>> from zope.publisher.browser import TestRequest
+  >>> from zope.publisher.interfaces.browser import IBrowserRequest
+  >>> import z3c.conditionalviews
+  >>> from z3c.conditionalviews import etag
+  >>> from z3c.conditionalviews.tests import File
+
+  >>> rendered = []
+  >>> class Report(object):
+  ...    zope.interface.implements(interfaces.IStaleWhileRevalidateView)
+  ...    __name__ = 'report.html'
+  ...    def __init__(self, context, request):
+  ...        self.context, self.request = context, request
+  ...    @z3c.conditionalviews.ConditionalView
+  ...    def __call__(self):
+  ...        rendered.append(self.context.data)
+  ...        return 'Report on %s' % self.context.data
+
+  >>> class FileETag(object):
+  ...    zope.interface.implements(interfaces.IETag)
+  ...    def __init__(self, context, request, view):
+  ...        self.etag = context.data
+  ...    weak = False
+
+  >>> gsm = zope.component.getGlobalSiteManager()
+  >>> gsm.registerAdapter(
+  ...    Report, (File, IBrowserRequest), zope.interface.Interface,
+  ...    name = 'report.html')
+  >>> gsm.registerAdapter(FileETag, (File, None, None))
+  >>> gsm.registerUtility(etag.ETagValidator(), name = 'http.etag')
+  >>> stale = StaleWhileRevalidateFilter(window = 60, fresh = 0)
+  >>> gsm.registerUtility(stale, name = 'http.asyncrevalidate')
+
+  >>> db = ZODB.DB(ZODB.MappingStorage.MappingStorage())
+  >>> connection = db.open()
+  >>> report = connection.root()['report'] = File('v1')
+  >>> transaction.commit()
+
+  >>> def publish():
+  ...    request = TestRequest()
+  ...    result = Report(report, request)()
+  ...    return result, request.response.getHeader('ETag')
+
+  >>> publish()
+  ('Report on v1', '"v1"')
+
+When the content changes, the stale response is returned, with its own
+entity tag, while the view is rendered again in the background.
+
+  >>> report.data = 'v2'
+  >>> transaction.commit()
+  >>> publish()
+  ('Report on v1', '"v1"')
+  >>> stale.join()
+  >>> rendered
+  ['v1', 'v2']
+  >>> publish()
+  ('Report on v2', '"v2"')
+  >>> stale.join()
+
+Stale responses are marked as such.
+
+  >>> request = TestRequest()
+  >>> Report(report, request)()
+  'Report on v2'
+  >>> request.response.getHeader('Warning')
+  '110 - "Response is Stale"'
+  >>> stale.join()
+
+A response younger than the fresh period is served without being
+refreshed, unless the validator data of the view changed since it was
+rendered.
+
+  >>> stale.fresh = 60
+  >>> publish()
+  ('Report on v2', '"v2"')
+  >>> report.data = 'v2.1'
+  >>> transaction.commit()
+  >>> request = TestRequest()
+  >>> Report(report, request)()
+  'Report on v2'
+  >>> request.response.getHeader('Warning')
+  '110 - "Response is Stale"'
+  >>> stale.join()
+  >>> publish()
+  ('Report on v2.1', '"v2.1"')
+  >>> rendered[-1]
+  'v2.1'
+  >>> stale.fresh = 0
+
+Responses vary on the request headers the validator data varies on.
+
+  >>> class NegotiatedETag(FileETag):
+  ...    zope.interface.implements(interfaces.IVariantValidatorData)
+  ...    vary = ('Accept-Language',)
+  >>> gsm.registerAdapter(
+  ...    NegotiatedETag, (File, None, None), interfaces.IETag)
+  >>> def negotiate(language):
+  ...    request = TestRequest(environ = {'HTTP_ACCEPT_LANGUAGE': language})
+  ...    return Report(report, request)()
+  >>> negotiate('en')
+  'Report on v2.1'
+  >>> len(rendered)
+  6
+  >>> negotiate('fr')
+  'Report on v2.1'
+  >>> len(rendered)
+  7
+  >>> stale.join()
+  >>> gsm.unregisterAdapter(
+  ...    NegotiatedETag, (File, None, None), interfaces.IETag)
+  True
+  >>> gsm.registerAdapter(FileETag, (File, None, None))
+
+Views not marked as `IStaleWhileRevalidateView` are always rendered.
+
+  >>> class Page(Report):
+  ...    zope.interface.implementsOnly()
+  >>> Page(report, TestRequest())()
+  'Report on v2.1'
+  >>> Page(report, TestRequest())()
+  'Report on v2.1'
+  >>> len(rendered)
+  9
+
+Responses older then the staleness window are not returned.
+
+  >>> stale.window = 0
+  >>> report.data = 'v3'
+  >>> transaction.commit()
+  >>> publish()
+  ('Report on v3', '"v3"')
+
+Cleanup
+-------
+
+  >>> stale.shutdown()
+  >>> connection.close()
+  >>> db.close()
+  >>> gsm.unregisterUtility(stale, name = 'http.asyncrevalidate')
+  True
+  >>> gsm.unregisterUtility(name = 'http.etag',
+  ...    provided = interfaces.IHTTPValidator)
+  True
+  >>> gsm.unregisterAdapter(FileETag, (File, None, None))
+  True
+  >>> gsm.unregisterAdapter(
+  ...    Report, (File, IBrowserRequest), zope.interface.Interface,
+  ...    name = 'report.html')
+  True
+
+"""
+
+import logging
+import Queue
+import StringIO
+import sys
+import threading
+import time
+
+import transaction
+import zope.component
+import zope.component.hooks
+import zope.interface
+import zope.publisher.browser
+import zope.security.management
+from zope.security.proxy import removeSecurityProxy
+
+import etag
+import interfaces
+import utils
+
+logger = logging.getLogger("z3c.conditionalviews")
+
+MARKER = "z3c.conditionalviews.stale"
+
+REFRESH_KEY = "z3c.conditionalviews.stale.refresh"
+
+# Headers of the stored response that are sent with it.
+HEADERS = ("Content-Type", "ETag", "Last-Modified")
+
+class StaleWhileRevalidateFilter(object):
+    zope.interface.implements(interfaces.ICachingResponseFilter)
+
+    def __init__(self, window = 60, fresh = 5, maxworkers = 2,
+                 maxentries = 100, maxsize = 10 * 1024 * 1024):
+        # Seconds a response is served for after it was rendered.
+        self.window = window
+        # Seconds a response is served for without being refreshed.
+        self.fresh = fresh
+        self.maxworkers = maxworkers
+        # The age of the responses is checked against the current window.
+        self.store = utils.BoundedCache(maxentries, maxsize,
+                                        maxage = sys.maxint)
+        self._jobs = Queue.Queue()
+        self._workers = []
+        # keys of the responses being refreshed.
+        self._pending = set()
+        self._lock = threading.Lock()
+        self.etagvalidator = etag.ETagValidator()
+
+    def _key(self, context, request, view):
+        if request.method != "GET" or \
+               getattr(view, "__name__", None) is None or \
+               not interfaces.IStaleWhileRevalidateView.providedBy(view):
+            return None
+        key = utils.contentKey(context)
+        if key is None:
+            return None
+        principal = getattr(request, "principal", None)
+        vary = []
+        for iface in (interfaces.IETag, interfaces.ILastModificationDate):
+            for name in utils.varyHeaders(utils.queryValidatorData(
+                    context, request, view, iface)):
+                vary.append((name.lower(), request.getHeader(name, None)))
+        return (key, utils.viewKey(view), request.get("QUERY_STRING", ""),
+                getattr(principal, "id", None), tuple(sorted(set(vary))))
+
+    def _validators(self, context, request, view):
+        # The validator data the response is rendered with.
+        data = utils.queryValidatorData(
+            context, request, view, interfaces.ILastModificationDate)
+        return (self.etagvalidator.currentETag(context, request, view),
+                getattr(data, "lastmodified", None))
+
+    def lookup(self, context, request, view):
+        if REFRESH_KEY in request.annotations:
+            return None
+        key = self._key(context, request, view)
+        entry = key is not None and self.store.get(key) or None
+        if entry is None:
+            return None
+        rendered, validators, body, headers = entry
+        age = time.time() - rendered
+        if age > self.window:
+            return None
+
+        for name, value in headers.items():
+            # The validators don't replace these.
+            request.response.setHeader(name, value)
+        if age > self.fresh or \
+               validators != self._validators(context, request, view):
+            request.response.setHeader("Warning", '110 - "Response is Stale"')
+            self.schedule(key, context, request, view)
+        request.annotations[MARKER] = True
+        return body
+
+    def filter(self, context, request, view, result):
+        if request.annotations.pop(MARKER, None):
+            return result
+        response = request.response
+        if response.getStatus() not in (200, 599) or \
+               not isinstance(result, basestring) or \
+               response.getHeader("Content-Encoding", None) is not None:
+            return result
+        key = request.annotations.get(REFRESH_KEY) or \
+              self._key(context, request, view)
+        if key is not None:
+            headers = {}
+            for name in HEADERS:
+                value = response.getHeader(name, None)
+                if value is not None:
+                    headers[name] = value
+            self.store.add(key, (time.time(),
+                                 self._validators(context, request, view),
+                                 result, headers), len(result))
+        return result
+
+    def schedule(self, key, context, request, view):
+        context = removeSecurityProxy(context)
+        site = zope.component.hooks.getSite()
+        environ = dict(getattr(request, "_orig_env", request._environ))
+        for name in environ.keys():
+            # The refresh must render the view.
+            if name.startswith("HTTP_IF_"):
+                del environ[name]
+
+        self._lock.acquire()
+        try:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+            if len(self._workers) < self.maxworkers:
+                worker = threading.Thread(target = self._worker)
+                worker.setDaemon(True)
+                worker.start()
+                self._workers.append(worker)
+        finally:
+            self._lock.release()
+        self._jobs.put((key, context._p_jar.db(), context._p_oid,
+                        getattr(site, "_p_oid", None), environ,
+                        zope.interface.directlyProvidedBy(request),
+                        getattr(request, "principal", None), view.__name__))
+
+    def _worker(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                if job is None:
+                    return
+                try:
+                    self.refresh(*job)
+                except Exception:
+                    logger.exception("Failed to refresh a stale response")
+                self._lock.acquire()
+                try:
+                    self._pending.discard(job[0])
+                finally:
+                    self._lock.release()
+            finally:
+                self._jobs.task_done()
+
+    def refresh(self, key, db, oid, siteoid, environ, provided, principal,
+                name):
+        manager = transaction.TransactionManager()
+        connection = db.open(transaction_manager = manager)
+        try:
+            ob = connection.get(oid)
+            site = siteoid is not None and connection.get(siteoid) or None
+            zope.component.hooks.setSite(site)
+            request = zope.publisher.browser.BrowserRequest(
+                StringIO.StringIO(""), environ)
+            zope.interface.directlyProvides(request, provided)
+            request.setPrincipal(principal)
+            request.annotations[REFRESH_KEY] = key
+            zope.security.management.newInteraction(request)
+            try:
+                view = zope.component.queryMultiAdapter(
+                    (ob, request), name = name)
+                if view is not None:
+                    # Stored by the filter method.
+                    view()
+            finally:
+                zope.security.management.endInteraction()
+                zope.component.hooks.setSite(None)
+        finally:
+            manager.abort()
+            connection.close()
+
+    def join(self):
+        """
+        Wait for all the scheduled refreshes to finish.
+        """
+        self._jobs.join()
+
+    def shutdown(self):
+        self._lock.acquire()
+        try:
+            workers, self._workers = self._workers, []
+        finally:
+            self._lock.release()
+        for worker in workers:
+            self._jobs.put(None)
+        for worker in workers:
+            worker.join()
@@ -0,0 +1,169 @@
+##############################################################################
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+##############################################################################
+
+import zope.interface
+import zope.component
+
+import interfaces
+import utils
+
+def treeKey(key):
+    """
+    Return the surrogate key tagging all responses rendered from the
+    descendants of the object identified by the content `key`.
+
+      >>> treeKey('0000000000000001')
+      'tree-0000000000000001'
+
+    """
+    return "tree-%s" % key
+
+
+def surrogateKeys(context):
+    """
+    Return the surrogate keys for responses rendered from `context`.
+
+    The first key identifies the context itself, followed by one `tree-`
+    key for each parent so a whole branch of the site can be purged at
+    once.
+
+      >>> class Content(object):
+      ...    def __init__(self, oid, parent = None):
+      ...        self._p_oid = oid
+      ...        self.__parent__ = parent
+      >>> root = Content('\\x00' * 8)
+      >>> ob = Content('\\x00' * 7 + '\\x01', root)
+
+      >>> surrogateKeys(ob)
+      ['0000000000000001', 'tree-0000000000000000']
+      >>> surrogateKeys(root)
+      ['0000000000000000']
+
+    Objects that are not yet stored in the database have no keys.
+
+      >>> surrogateKeys(object())
+      []
+
+    """
+    key = utils.contentKey(context)
+    if key is None:
+        return []
+    return [key] + [treeKey(parent) for parent in utils.parentKeys(context)]
+
+
+class SurrogateKeyValidator(object):
+    """
+    The SurrogateKeyValidator never takes part in deciding whether a request
+    is valid or not, it only tags the response with `Surrogate-Key` and
+    `xkey` headers so that a fronting HTTP cache can hold the response until
+    the content changes, see the `purge` module.
+
+      >>> from zope.interface.verify import verifyObject
+      >>> from zope.publisher.interfaces.browser import IBrowserRequest
+      >>> from zope.publisher.browser import TestRequest
+      >>> from zope.publisher.browser import BrowserView
+
+      >>> validator = SurrogateKeyValidator()
+      >>> verifyObject(interfaces.IHTTPValidator, validator)
+      True
+
+      >>> class Content(object):
+      ...    def __init__(self, oid, parent = None):
+      ...        self._p_oid = oid
+      ...        self.__parent__ = parent
+      >>> root = Content('\\x00' * 8)
+      >>> content = Content('\\x00' * 7 + '\\x01', root)
+
+      >>> request = TestRequest(environ = {'IF_NONE_MATCH': '"xyzzy"'})
+      >>> view = BrowserView(content, request)
+
+      >>> validator.evaluate(content, request, view)
+      False
+      >>> validator.valid(content, request, view)
+      True
+
+    Only responses that can be validated against an entity tag are tagged,
+    so with no IETag adapter no headers are set.
+
+      >>> validator.updateResponse(content, request, view)
+      >>> request.response.getHeader('Surrogate-Key') is None
+      True
+
+      >>> class CurrentETag(object):
+      ...    zope.interface.implements(interfaces.IETag)
+      ...    def __init__(self, context, request, view):
+      ...        pass
+      ...    weak = False
+      ...    etag = 'xyzzy'
+
+      >>> zope.component.getGlobalSiteManager().registerAdapter(
+      ...    CurrentETag, (None, IBrowserRequest, None))
+
+      >>> validator.updateResponse(content, request, view)
+      >>> request.response.getHeader('Surrogate-Key')
+      '0000000000000001 tree-0000000000000000'
+      >>> request.response.getHeader('xkey')
+      '0000000000000001 tree-0000000000000000'
+
+    Headers set by the view are not overridden.
+
+      >>> request = TestRequest()
+      >>> request.response.setHeader('Surrogate-Key', 'custom')
+      >>> validator.updateResponse(content, request, view)
+      >>> request.response.getHeader('Surrogate-Key')
+      'custom'
+      >>> request.response.getHeader('xkey') is None
+      True
+
+    As with the other validators the data doesn't apply to requests with a
+    query string.
+
+      >>> request = TestRequest(environ = {'QUERY_STRING': 'argument=value'})
+      >>> validator.updateResponse(content, request, view)
+      >>> request.response.getHeader('Surrogate-Key') is None
+      True
+
+    Cleanup
+    -------
+
+      >>> zope.component.getGlobalSiteManager().unregisterAdapter(
+      ...    CurrentETag, (None, IBrowserRequest, None))
+      True
+
+    """
+    zope.interface.implements(interfaces.IHTTPValidator)
+
+    def evaluate(self, context, request, view):
+        return False
+
+    def valid(self, context, request, view):
+        return True
+
+    def invalidStatus(self, context, request, view):
+        # Never called since this validator never evaluates a request.
+        return 304
+
+    def updateResponse(self, context, request, view):
+        if request.response.getHeader("Surrogate-Key", None) is not None or \
+               request.get("QUERY_STRING", "") != "":
+            return
+
+        etag = utils.queryValidatorData(
+            context, request, view, interfaces.IETag)
+        if etag is None or not etag.etag:
+            return
+
+        keys = surrogateKeys(context)
+        if keys:
+            keys = " ".join(keys)
+            request.response.setHeader("Surrogate-Key", keys)
+            request.response.setHeader("xkey", keys)
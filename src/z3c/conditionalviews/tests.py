@@ -15,6 +15,7 @@ import doctest
 import unittest
 
 import persistent
+import zope.component.testing
 import zope.interface
 import zope.schema
 import zope.filerepresentation.interfaces
@@ -22,6 +23,7 @@ import zope.annotation.interfaces
 import zope.publisher.browser
 from zope.security.proxy import removeSecurityProxy
 import zope.app.wsgi.testlayer
+import zope.testbrowser.wsgi
 
 import z3c.conditionalviews
 import z3c.conditionalviews.interfaces
@@ -116,18 +118,83 @@ def integrationTeardown(test):
     del test.globs["http"]
 
 
+def loadtestSetup(test):
+    test.globs["application"] = zope.testbrowser.wsgi.Layer.get_app()
+
+
 def test_suite():
     readme = doctest.DocFileSuite(
         "README.txt",
         setUp = integrationSetup,
         tearDown = integrationTeardown,
         optionflags = doctest.NORMALIZE_WHITESPACE)
-    readme.layer = zope.app.wsgi.testlayer.BrowserLayer(z3c.conditionalviews)
+    layer = zope.app.wsgi.testlayer.BrowserLayer(z3c.conditionalviews)
+    readme.layer = layer
+
+    loadtest = doctest.DocTestSuite(
+        "z3c.conditionalviews.loadtest",
+        setUp = loadtestSetup,
+        optionflags = doctest.ELLIPSIS | doctest.NORMALIZE_WHITESPACE)
+    loadtest.layer = layer
+
+    replay = doctest.DocTestSuite(
+        "z3c.conditionalviews.replay",
+        setUp = loadtestSetup,
+        optionflags = doctest.ELLIPSIS | doctest.NORMALIZE_WHITESPACE)
+    replay.layer = layer
 
     return unittest.TestSuite((
         doctest.DocFileSuite("validation.txt"),
         doctest.DocTestSuite("z3c.conditionalviews.lastmodification"),
         doctest.DocTestSuite("z3c.conditionalviews.etag"),
         doctest.DocTestSuite("z3c.conditionalviews.adapters"),
+        doctest.DocTestSuite("z3c.conditionalviews.utils"),
+        doctest.DocTestSuite("z3c.conditionalviews.surrogatekeys"),
+        doctest.DocTestSuite("z3c.conditionalviews.purge"),
+        doctest.DocTestSuite("z3c.conditionalviews.aggregate"),
+        doctest.DocTestSuite("z3c.conditionalviews.delta"),
+        doctest.DocTestSuite("z3c.conditionalviews.compression"),
+        doctest.DocTestSuite(
+            "z3c.conditionalviews.prefetch",
+            optionflags = doctest.ELLIPSIS),
+        doctest.DocTestSuite("z3c.conditionalviews.invalidation"),
+        doctest.DocTestSuite("z3c.conditionalviews.precompute"),
+        doctest.DocTestSuite("z3c.conditionalviews.sharedtable"),
+        doctest.DocTestSuite("z3c.conditionalviews.cas"),
+        doctest.DocTestSuite("z3c.conditionalviews.readonly"),
+        doctest.DocTestSuite("z3c.conditionalviews.fingerprint"),
+        doctest.DocTestSuite("z3c.conditionalviews.stale"),
+        doctest.DocTestSuite(
+            "z3c.conditionalviews.fragments",
+            optionflags = doctest.ELLIPSIS),
+        doctest.DocTestSuite("z3c.conditionalviews.dispatch"),
+        doctest.DocTestSuite(
+            "z3c.conditionalviews.metaconfigure",
+            optionflags = doctest.ELLIPSIS),
+        doctest.DocTestSuite("z3c.conditionalviews.resources"),
+        doctest.DocTestSuite("z3c.conditionalviews.metrics"),
+        doctest.DocTestSuite(
+            "z3c.conditionalviews.tracing",
+            optionflags = doctest.NORMALIZE_WHITESPACE),
+        doctest.DocTestSuite(
+            "z3c.conditionalviews.benchmark",
+            optionflags = doctest.ELLIPSIS | doctest.NORMALIZE_WHITESPACE),
+        doctest.DocTestSuite(
+            "z3c.conditionalviews.wsgi",
+            setUp = zope.component.testing.setUp,
+            tearDown = zope.component.testing.tearDown,
+            optionflags = doctest.NORMALIZE_WHITESPACE),
+        doctest.DocFileSuite(
+            "changes.txt",
+            setUp = zope.component.testing.setUp,
+            tearDown = zope.component.testing.tearDown,
+            optionflags = doctest.NORMALIZE_WHITESPACE),
+        doctest.DocFileSuite(
+            "batch.txt",
+            setUp = zope.component.testing.setUp,
+            tearDown = zope.component.testing.tearDown,
+            optionflags = doctest.NORMALIZE_WHITESPACE),
         readme,
+        loadtest,
+        replay,
         ))
@@ -0,0 +1,278 @@
+##############################################################################
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+##############################################################################
+"""
+Tracing and profiling the validation of requests to conditional views.
+
+When the `ValidationTracer` utility is registered, a sample of the requests
+to conditional views are traced. The validation of a traced request is split
+into spans:
+
+- `lookup`, looking up the validators,
+
+- `fetch`, fetching the validator data in advance, see the prefetch module,
+
+- `decision`, deciding whether the request is valid, including the `data`
+  spans looking up the validator data,
+
+- `cache`, looking for a cached result, see `ICachingResponseFilter`,
+
+- `render`, calling the view,
+
+- `update`, updating and filtering the response.
+
+The spans of a trace are passed to the exporter of the tracer when the trace
+is finished. By default they are logged as JSON.
+
+  >>> import zope.component
+  >>> from zope.interface.verify import verifyObject
+  >>> from zope.publisher.browser import TestRequest
+  >>> import z3c.conditionalviews
+  >>> from z3c.conditionalviews import etag
+
+  >>> traces = []
+  >>> tracer = ValidationTracer(samplerate = 1, exporter = traces.append)
+  >>> verifyObject(interfaces.IValidationTracer, tracer)
+  True
+
+  >>> class CurrentETag(object):
+  ...    zope.interface.implements(interfaces.IETag)
+  ...    def __init__(self, context, request, view):
+  ...        pass
+  ...    weak = False
+  ...    etag = 'xyzzy'
+
+  >>> gsm = zope.component.getGlobalSiteManager()
+  >>> gsm.registerAdapter(CurrentETag, (None, None, None))
+  >>> gsm.registerUtility(etag.ETagValidator(), name = 'http.etag')
+  >>> gsm.registerUtility(tracer)
+
+  >>> class View(object):
+  ...    def __init__(self, context, request):
+  ...        self.context, self.request = context, request
+  ...    def render(self):
+  ...        return 'rendered'
+  >>> def publish(**environ):
+  ...    request = TestRequest(environ = environ)
+  ...    return z3c.conditionalviews.validate(
+  ...        None, request, View.render.im_func, View(None, request))
+
+  >>> publish(IF_NONE_MATCH = '"other"')
+  'rendered'
+
+  >>> spans = traces[0]
+  >>> [(span['name'], span['parent']) for span in spans]
+  [('validate', None), ('lookup', 'validate'), ('decision', 'validate'),
+   ('data', 'decision'), ('render', 'validate'), ('update', 'validate'),
+   ('data', 'update')]
+  >>> spans[0]['attributes']
+  {'view': 'z3c.conditionalviews.tracing.View'}
+  >>> spans[3]['attributes']
+  {'interface': 'IETag'}
+  >>> len(set([span['trace'] for span in spans]))
+  1
+  >>> min([span['duration'] for span in spans]) >= 0
+  True
+
+Only a sample of the requests are traced.
+
+  >>> tracer.samplerate = 0
+  >>> publish()
+  'rendered'
+  >>> len(traces)
+  1
+
+Profiling
+=========
+
+Trusted clients can ask for the validation of a request to be profiled. The
+profile is written to the profile directory of the tracer.
+
+  >>> import os, pstats, shutil, tempfile
+  >>> tracer.profiledir = tempfile.mkdtemp()
+  >>> tracer.trustedips = ('10.0.0.1',)
+
+  >>> publish(REMOTE_ADDR = '10.0.0.1', HTTP_X_CONDITIONAL_PROFILE = 'cpu')
+  'rendered'
+  >>> len(traces)
+  2
+  >>> [profile] = os.listdir(tracer.profiledir)
+  >>> profile.endswith('.prof')
+  True
+  >>> stats = pstats.Stats(os.path.join(tracer.profiledir, profile))
+
+Requests from untrusted clients are never profiled.
+
+  >>> publish(REMOTE_ADDR = '10.0.0.2', HTTP_X_CONDITIONAL_PROFILE = 'cpu')
+  'rendered'
+  >>> len(os.listdir(tracer.profiledir))
+  1
+
+Cleanup
+-------
+
+  >>> shutil.rmtree(tracer.profiledir)
+  >>> gsm.unregisterUtility(tracer)
+  True
+  >>> gsm.unregisterUtility(name = 'http.etag',
+  ...    provided = interfaces.IHTTPValidator)
+  True
+  >>> gsm.unregisterAdapter(CurrentETag, (None, None, None))
+  True
+
+"""
+
+import cProfile
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+
+import zope.interface
+
+import interfaces
+import utils
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+logger = logging.getLogger("z3c.conditionalviews.trace")
+
+def logSpans(spans):
+    for span in spans:
+        logger.info(json.dumps(span, sort_keys = True))
+
+
+class Span(object):
+
+    def __init__(self, trace, name, attributes):
+        self.trace = trace
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        self.trace._enter(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.duration = time.time() - self.start
+        self.trace._exit(self)
+        return False
+
+
+class Trace(object):
+    zope.interface.implements(interfaces.ITrace)
+
+    def __init__(self, tracer, view, profile = None):
+        self.tracer = tracer
+        self.id = uuid.uuid4().hex
+        self.profile = profile
+        self.spans = []
+        # thread -> stack of the spans entered
+        self._stacks = {}
+        self._root = self.span("validate", view = utils.viewKey(view)[0])
+        self._root.__enter__()
+
+    def span(self, name, **attributes):
+        return Span(self, name, attributes)
+
+    def _enter(self, span):
+        # The validator data can be fetched in other threads.
+        stack = self._stacks.setdefault(threading.currentThread().ident, [])
+        span.parent = stack and stack[-1].name or (
+            self.spans and self.spans[0].name or None)
+        stack.append(span)
+        self.spans.append(span)
+
+    def _exit(self, span):
+        stack = self._stacks.get(threading.currentThread().ident)
+        if stack and stack[-1] is span:
+            stack.pop()
+
+    def run(self, func, *args, **kw):
+        if self.profile is None:
+            return func(*args, **kw)
+
+        if self.profile == "memory":
+            if tracemalloc is None:
+                logger.warning("Memory profiling needs tracemalloc")
+                return func(*args, **kw)
+            tracemalloc.start()
+            try:
+                return func(*args, **kw)
+            finally:
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+                snapshot.dump(self._profilePath("tracemalloc"))
+
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(func, *args, **kw)
+        finally:
+            profiler.dump_stats(self._profilePath("prof"))
+
+    def _profilePath(self, extension):
+        return os.path.join(
+            self.tracer.profiledir, "%s-%s.%s" % (
+                time.strftime("%Y%m%d%H%M%S"), self.id, extension))
+
+    def finish(self):
+        self._root.__exit__(None, None, None)
+        spans = [{"trace": self.id,
+                  "name": span.name,
+                  "parent": span.parent,
+                  "start": span.start,
+                  "duration": getattr(span, "duration", None),
+                  "attributes": span.attributes,
+                  }
+                 for span in sorted(self.spans, key = lambda span: span.start)]
+        try:
+            self.tracer.exporter(spans)
+        except Exception:
+            logger.exception("Failed to export trace %s", self.id)
+
+
+class ValidationTracer(object):
+    zope.interface.implements(interfaces.IValidationTracer)
+
+    def __init__(self, samplerate = 0.01, exporter = logSpans,
+                 profiledir = None, trustedips = ("127.0.0.1",),
+                 profileheader = "X-Conditional-Profile"):
+        self.samplerate = samplerate
+        self.exporter = exporter
+        self.profiledir = profiledir
+        self.trustedips = trustedips
+        self.profileheader = profileheader
+
+    def profile(self, request):
+        """
+        Return the kind of profile, `cpu` or `memory`, asked for by a trusted
+        client, or None.
+        """
+        if self.profiledir is None:
+            return None
+        profile = request.getHeader(self.profileheader, None)
+        if profile is None or \
+               request.get("REMOTE_ADDR") not in self.trustedips:
+            return None
+        return profile.strip().lower() == "memory" and "memory" or "cpu"
+
+    def start(self, request, view):
+        profile = self.profile(request)
+        if profile is None and random.random() >= self.samplerate:
+            return None
+        return Trace(self, view, profile)
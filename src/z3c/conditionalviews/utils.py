@@ -0,0 +1,426 @@
+##############################################################################
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+##############################################################################
+"""
+Helpers shared by the different parts of this package.
+"""
+
+import binascii
+import collections
+import hashlib
+import threading
+import time
+
+import zope.component
+import zope.interface
+import zope.interface.interface
+from zope.security.proxy import removeSecurityProxy
+
+import dispatch
+import interfaces
+
+# Key of the validator data fetched in advance in the request annotations.
+DATA_KEY = "z3c.conditionalviews.data"
+# Key of the generation of the validator data cache when the request started,
+# in the request annotations.
+GENERATION_KEY = "z3c.conditionalviews.generation"
+
+# Key of the current trace in the request annotations, see the tracing
+# module.
+TRACE_KEY = "z3c.conditionalviews.trace"
+
+_marker = object()
+
+def contentKey(ob):
+    """
+    Return a string identifing the persistent object `ob`, or None if the
+    object has not been stored in the database yet.
+
+      >>> class Content(object):
+      ...    pass
+      >>> ob = Content()
+      >>> contentKey(ob) is None
+      True
+      >>> ob._p_oid = '\\x00\\x00\\x00\\x00\\x00\\x00\\x01\\x2a'
+      >>> contentKey(ob)
+      '000000000000012a'
+
+    """
+    oid = getattr(removeSecurityProxy(ob), "_p_oid", None)
+    if oid is None:
+        return None
+    return binascii.hexlify(oid)
+
+
+def parentKeys(ob):
+    """
+    Return the content keys of all the parents of `ob`, starting with the
+    closest parent.
+
+      >>> class Content(object):
+      ...    def __init__(self, oid, parent = None):
+      ...        self._p_oid = oid
+      ...        self.__parent__ = parent
+      >>> root = Content('\\x00' * 8)
+      >>> folder = Content('\\x00' * 7 + '\\x01', root)
+      >>> ob = Content('\\x00' * 7 + '\\x02', folder)
+      >>> parentKeys(ob)
+      ['0000000000000001', '0000000000000000']
+      >>> parentKeys(root)
+      []
+
+    """
+    keys = []
+    ob = getattr(removeSecurityProxy(ob), "__parent__", None)
+    while ob is not None:
+        key = contentKey(ob)
+        if key is not None:
+            keys.append(key)
+        ob = getattr(removeSecurityProxy(ob), "__parent__", None)
+    return keys
+
+
+def addVaryHeader(response, *names):
+    """
+    Add the request header `names` to the `Vary` header of the response.
+
+      >>> from zope.publisher.http import HTTPResponse
+      >>> response = HTTPResponse()
+      >>> addVaryHeader(response, 'Accept-Encoding')
+      >>> response.getHeader('Vary')
+      'Accept-Encoding'
+      >>> addVaryHeader(response, 'accept-encoding', 'Accept-Language')
+      >>> response.getHeader('Vary')
+      'Accept-Encoding, Accept-Language'
+
+    """
+    vary = response.getHeader("Vary", None)
+    values = vary and [value.strip() for value in vary.split(",")] or []
+    if "*" in values:
+        return
+    current = [value.lower() for value in values]
+    for name in names:
+        if name.lower() not in current:
+            values.append(name)
+            current.append(name.lower())
+    if values:
+        response.setHeader("Vary", ", ".join(values))
+
+
+def varyHeaders(data):
+    """
+    Return the names of the request headers the validator `data` varies on.
+
+      >>> class ETag(object):
+      ...    zope.interface.implements(
+      ...        interfaces.IETag, interfaces.IVariantValidatorData)
+      ...    vary = ('Accept-Language',)
+      >>> varyHeaders(ETag())
+      ('Accept-Language',)
+      >>> varyHeaders(None)
+      ()
+
+    """
+    if not interfaces.IVariantValidatorData.providedBy(data):
+        return ()
+    return tuple(data.vary or ())
+
+
+def variantETag(etag, request, vary):
+    """
+    Return the entity tag of the variant of the representation with entity
+    tag `etag` selected by the values of the request headers `vary`.
+
+      >>> from zope.publisher.browser import TestRequest
+      >>> french = TestRequest(environ = {'HTTP_ACCEPT_LANGUAGE': 'fr, en'})
+      >>> variantETag('xyzzy', french, ())
+      'xyzzy'
+      >>> variantETag('xyzzy', french, ('Accept-Language',))
+      'xyzzy-v814cabde'
+      >>> english = TestRequest(environ = {'HTTP_ACCEPT_LANGUAGE': 'en'})
+      >>> variantETag('xyzzy', english, ('Accept-Language',))
+      'xyzzy-v9cfefed8'
+
+    """
+    if not vary:
+        return etag
+    # Only the values matter, not how they are spaced.
+    values = ["".join((request.getHeader(name, None) or "").split())
+              for name in vary]
+    return "%s-v%s" % (etag, hashlib.md5("\n".join(values)).hexdigest()[:8])
+
+
+def principalFingerprint(request):
+    """
+    Return the fingerprint of the principal of the request, see
+    `interfaces.IPrincipalFingerprint`, or None.
+    """
+    fingerprinter = zope.component.queryUtility(
+        interfaces.IPrincipalFingerprint)
+    if fingerprinter is None:
+        return None
+    return fingerprinter.fingerprint(request)
+
+
+def personalETag(etag, fingerprint):
+    """
+    Return the entity tag of the representation with entity tag `etag` for
+    the principal with the `fingerprint`.
+
+      >>> personalETag('xyzzy', 'a1b2c3d4')
+      'xyzzy-pa1b2c3d4'
+      >>> personalETag('xyzzy', None)
+      'xyzzy'
+
+    """
+    if fingerprint is None:
+        return etag
+    return "%s-p%s" % (etag, fingerprint)
+
+
+def setPrivate(response):
+    """
+    Only let the client cache the response, not any shared cache.
+
+      >>> from zope.publisher.http import HTTPResponse
+      >>> response = HTTPResponse()
+      >>> setPrivate(response)
+      >>> response.getHeader('Cache-Control')
+      'private'
+      >>> response.setHeader('Cache-Control', 'public, max-age=60')
+      >>> setPrivate(response)
+      >>> response.getHeader('Cache-Control')
+      'max-age=60, private'
+
+    """
+    value = response.getHeader("Cache-Control", None)
+    directives = value and [directive.strip()
+                            for directive in value.split(",")] or []
+    if "private" in directives or "no-store" in directives:
+        return
+    directives = [directive for directive in directives
+                  if directive.lower() != "public"]
+    response.setHeader("Cache-Control", ", ".join(directives + ["private"]))
+
+
+def validatorDataKey(context, view, iface):
+    return (id(context), id(view), iface)
+
+
+class Snapshot(object):
+    """
+    Copy of the attributes of some validator data, so that they are only
+    computed once.
+    """
+
+
+def snapshot(data, iface):
+    """
+    Return a copy of the attributes of the `iface` validator `data`, and of
+    the interfaces extending `iface` it provides.
+
+      >>> class ETag(object):
+      ...    zope.interface.implements(interfaces.IETag)
+      ...    weak = False
+      ...    @property
+      ...    def etag(self):
+      ...        return 'xyzzy'
+      >>> copy = snapshot(ETag(), interfaces.IETag)
+      >>> interfaces.IETag.providedBy(copy), copy.etag, copy.weak
+      (True, 'xyzzy', False)
+      >>> snapshot(None, interfaces.IETag) is None
+      True
+
+      >>> class TimestampedETag(ETag):
+      ...    zope.interface.implements(interfaces.ITimestampedETag)
+      ...    timestamp = 'yesterday'
+      >>> copy = snapshot(TimestampedETag(), interfaces.IETag)
+      >>> interfaces.ITimestampedETag.providedBy(copy), copy.timestamp
+      (True, 'yesterday')
+
+    """
+    if data is None:
+        return None
+    copy = Snapshot()
+    provided = [other for other in zope.interface.providedBy(data)
+                if other.isOrExtends(iface)] or [iface]
+    if interfaces.IVariantValidatorData.providedBy(data):
+        # The headers the data varies on are kept with it.
+        provided.append(interfaces.IVariantValidatorData)
+    for other in provided:
+        for name in other.names(all = True):
+            if not isinstance(other[name], zope.interface.interface.Method):
+                setattr(copy, name, getattr(data, name, None))
+    zope.interface.alsoProvides(copy, *provided)
+    return copy
+
+
+def viewKey(view):
+    view = removeSecurityProxy(view)
+    return ("%s.%s" % (view.__class__.__module__, view.__class__.__name__),
+            getattr(view, "__name__", None))
+
+
+def queryValidatorData(context, request, view, iface):
+    """
+    Return the `iface` validator data for the view, as fetched in advance
+    by an `IValidatorDataFetcher`, or as cached by an `IValidatorDataCache`
+    if possible.
+
+      >>> from zope.publisher.browser import TestRequest
+      >>> class IData(zope.interface.Interface):
+      ...    pass
+      >>> request = TestRequest()
+      >>> queryValidatorData(None, request, None, IData) is None
+      True
+
+      >>> request.annotations[DATA_KEY] = {
+      ...    validatorDataKey(None, None, IData): 'prefetched'}
+      >>> queryValidatorData(None, request, None, IData)
+      'prefetched'
+
+    """
+    trace = getattr(request, "annotations", {}).get(TRACE_KEY)
+    if trace is None:
+        return _queryValidatorData(context, request, view, iface)
+    with trace.span("data", interface = iface.__name__):
+        return _queryValidatorData(context, request, view, iface)
+
+
+def recordGeneration(request):
+    """
+    Remember the generation of the validator data cache when the request
+    starts, before it reads any content. Data invalidated since then is not
+    cached by the request.
+    """
+    cache = zope.component.queryUtility(interfaces.IValidatorDataCache)
+    if cache is not None:
+        request.annotations[GENERATION_KEY] = cache.generation
+
+
+def _queryValidatorData(context, request, view, iface):
+    prefetched = getattr(request, "annotations", {}).get(DATA_KEY)
+    if prefetched is not None:
+        key = validatorDataKey(context, view, iface)
+        if key in prefetched:
+            return prefetched[key]
+
+    cache = key = None
+    # Requests with other methods can change the validator data before
+    # the transaction is committed, or aborted.
+    if getattr(request, "method", None) in ("GET", "HEAD"):
+        cache = zope.component.queryUtility(interfaces.IValidatorDataCache)
+        key = cache is not None and contentKey(context) or None
+    if key is None:
+        return adaptValidatorData(context, request, view, iface)
+
+    # Data invalidated after the request started might have been computed
+    # from the content as it was before the change, and must not be cached.
+    # Requests not published by the `ConditionalPublication` didn't record
+    # when they started, the first use of the cache is the best guess.
+    generation = request.annotations.setdefault(
+        GENERATION_KEY, cache.generation)
+    entry = (viewKey(view), iface)
+    data = cache.get(key, entry, _marker)
+    if data is _marker:
+        data = snapshot(adaptValidatorData(context, request, view, iface),
+                        iface)
+        cache.set(key, entry, data, generation)
+    return data
+
+
+def adaptValidatorData(context, request, view, iface):
+    """
+    Compute the `iface` validator data for the view, with the factory
+    configured for the view by the `conditional:view` directive if any.
+    """
+    factory = dispatch.queryValidatorDataFactory(view, iface)
+    if factory is not None:
+        return factory(context, request, view)
+    return zope.component.queryMultiAdapter((context, request, view), iface)
+
+
+class BoundedCache(object):
+    """
+    Thread safe in-memory cache bounded by the number of entries, the total
+    size of the entries and their age. When the cache is full the oldest
+    entries are removed first.
+
+      >>> cache = BoundedCache(maxentries = 2, maxsize = 10, maxage = 60)
+      >>> cache.add('a', 'aaa', 3)
+      >>> cache.add('b', 'bbb', 3)
+      >>> cache.get('a')
+      'aaa'
+      >>> cache.get('c') is None
+      True
+
+      >>> cache.add('c', 'ccc', 3)
+      >>> cache.get('a') is None
+      True
+      >>> cache.add('d', 'dddddddd', 8)
+      >>> cache.get('b') is None, cache.get('c') is None, cache.get('d')
+      (True, True, 'dddddddd')
+
+    Entries bigger then the cache are never kept.
+
+      >>> cache.add('e', 'eeeeeeeeeeee', 12)
+      >>> cache.get('e') is None
+      True
+
+    And entries are forgotten after a while.
+
+      >>> cache.add('f', 'f', 1)
+      >>> cache._entries['f'] = (time.time() - 61, 'f', 1)
+      >>> cache.get('f') is None
+      True
+
+    """
+
+    def __init__(self, maxentries = 100, maxsize = 10 * 1024 * 1024,
+                 maxage = 3600):
+        self.maxentries = maxentries
+        self.maxsize = maxsize
+        self.maxage = maxage
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _remove(self, key):
+        added, value, size = self._entries.pop(key)
+        self._size -= size
+
+    def add(self, key, value, size):
+        if size > self.maxsize:
+            return
+        self._lock.acquire()
+        try:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.time(), value, size)
+            self._size += size
+            while len(self._entries) > self.maxentries or \
+                      self._size > self.maxsize:
+                self._remove(next(iter(self._entries)))
+        finally:
+            self._lock.release()
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] + self.maxage < time.time():
+                self._remove(key)
+                return None
+            return entry[1]
+        finally:
+            self._lock.release()
@@ -0,0 +1,230 @@
+##############################################################################
+# Copyright (c) 2007 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+##############################################################################
+"""
+WSGI middleware validating conditional requests before the wrapped
+application is called.
+
+Applications that are not published through `zope.app.publication` can't use
+the `ConditionalHTTPRequest`, so the middleware runs the validators against a
+lightweight request built from the WSGI environment instead. The validator
+data comes from a `lookup` callable which is given the path of the request,
+and returns an `IWSGIResource`, or None if nothing is known about the path.
+The lookup should be cheap, the whole point is not to do the work of the
+application. The resource is handed to the validators as their validator
+data, so nothing needs to be registered.
+
+  >>> import datetime
+  >>> import pytz
+
+  >>> calls = []
+  >>> def application(environ, start_response):
+  ...    calls.append(environ['PATH_INFO'])
+  ...    start_response('200 OK', [('Content-Type', 'text/plain')])
+  ...    return ['Hello, World!']
+
+  >>> resources = {
+  ...    '/hello': Resource(
+  ...        etag = 'xyzzy',
+  ...        lastmodified = datetime.datetime(2007, 2, 5, 5, 43, 23,
+  ...                                         tzinfo = pytz.utc)),
+  ...    }
+  >>> middleware = ConditionalMiddleware(application, resources.get)
+
+  >>> def publish(path, method = 'GET', **headers):
+  ...    environ = {'REQUEST_METHOD': method, 'PATH_INFO': path}
+  ...    for name, value in headers.items():
+  ...        environ['HTTP_' + name.upper()] = value
+  ...    response = []
+  ...    def start_response(status, headers, exc_info = None):
+  ...        response.append(status)
+  ...        response.append(sorted(headers))
+  ...    response.append(''.join(middleware(environ, start_response)))
+  ...    return response
+
+The first request for a resource is passed on to the application, and the
+validator headers are added to its response.
+
+  >>> status, headers, body = publish('/hello')
+  >>> status, body
+  ('200 OK', 'Hello, World!')
+  >>> headers
+  [('Content-Type', 'text/plain'), ('ETag', '"xyzzy"'),
+   ('Last-Modified', 'Mon, 05 Feb 2007 05:43:23 GMT')]
+  >>> calls
+  ['/hello']
+
+When the client's copy is still current, the application isn't called.
+
+  >>> publish('/hello', if_none_match = '"xyzzy"')
+  ['304 Not Modified', [('ETag', '"xyzzy"'),
+   ('Last-Modified', 'Mon, 05 Feb 2007 05:43:23 GMT')], '']
+  >>> publish('/hello', if_modified_since = 'Mon, 05 Feb 2007 05:43:23 GMT')[0]
+  '304 Not Modified'
+  >>> publish('/hello', method = 'PUT', if_match = '"plugh"')[0]
+  '412 Precondition Failed'
+  >>> calls
+  ['/hello']
+
+  >>> publish('/hello', if_none_match = '"plugh"')[0]
+  '200 OK'
+  >>> calls
+  ['/hello', '/hello']
+
+Requests for resources the lookup knows nothing about are passed on
+untouched.
+
+  >>> del calls[:]
+  >>> status, headers, body = publish('/other', if_none_match = '"xyzzy"')
+  >>> status, headers
+  ('200 OK', [('Content-Type', 'text/plain')])
+  >>> calls
+  ['/other']
+
+The headers set by the application are never replaced.
+
+  >>> def application(environ, start_response):
+  ...    start_response('200 OK', [('ETag', '"other"')])
+  ...    return ['']
+  >>> middleware = ConditionalMiddleware(application, resources.get)
+  >>> publish('/hello')[1]
+  [('ETag', '"other"'), ('Last-Modified', 'Mon, 05 Feb 2007 05:43:23 GMT')]
+
+The middleware registers nothing in the component registry.
+
+  >>> zope.component.queryMultiAdapter(
+  ...    (resources['/hello'], WSGIRequest({}), None), interfaces.IETag)
+
+"""
+
+import httplib
+
+import zope.component
+import zope.interface
+
+import z3c.conditionalviews
+import interfaces
+import etag
+import lastmodification
+import utils
+
+class Resource(object):
+    zope.interface.implements(interfaces.IWSGIResource)
+
+    def __init__(self, etag = None, weak = False, lastmodified = None):
+        self.etag = etag
+        self.weak = weak
+        self.lastmodified = lastmodified
+
+
+class WSGIResponse(object):
+
+    def __init__(self):
+        self._status = 200
+        self._reason = None
+        self.headers = []
+
+    def getStatus(self):
+        return self._status
+
+    def setStatus(self, status, reason = None):
+        self._status = status
+        self._reason = reason
+
+    def getStatusString(self):
+        reason = self._reason or httplib.responses.get(self._status, "Unknown")
+        return "%d %s" % (self._status, reason)
+
+    def getHeader(self, name, default = None):
+        name = name.lower()
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value
+        return default
+
+    def setHeader(self, name, value):
+        self.headers = [(key, val) for key, val in self.headers
+                        if key.lower() != name.lower()]
+        self.headers.append((name, value))
+
+
+class WSGIRequest(object):
+    zope.interface.implements(interfaces.IWSGIRequest)
+
+    def __init__(self, environ):
+        self.environ = environ
+        self.method = environ.get("REQUEST_METHOD", "GET").upper()
+        self.response = WSGIResponse()
+        self.annotations = {}
+
+    def getHeader(self, name, default = None):
+        name = name.upper().replace("-", "_")
+        value = self.environ.get("HTTP_" + name, None)
+        if value is None:
+            value = self.environ.get(name, default)
+        return value
+
+    def get(self, key, default = None):
+        return self.environ.get(key, default)
+
+    def getURL(self):
+        return self.environ.get("SCRIPT_NAME", "") + \
+               self.environ.get("PATH_INFO", "")
+
+
+class ConditionalMiddleware(object):
+
+    def __init__(self, application, lookup):
+        self.application = application
+        self.lookup = lookup
+
+    def getValidators(self):
+        validators = z3c.conditionalviews.getValidators()
+        if not validators:
+            validators = [etag.ETagValidator(),
+                          lastmodification.ModifiedSinceValidator()]
+        return validators
+
+    def __call__(self, environ, start_response):
+        request = WSGIRequest(environ)
+        context = self.lookup(request.getURL())
+        if context is None:
+            return self.application(environ, start_response)
+
+        # The resource is the validator data, as if it had been fetched in
+        # advance, see `utils.queryValidatorData`.
+        request.annotations[utils.DATA_KEY] = dict(
+            [(utils.validatorDataKey(context, None, iface), context)
+             for iface in (interfaces.IETag,
+                           interfaces.ILastModificationDate)])
+        validators = self.getValidators()
+        status = z3c.conditionalviews.invalidStatus(
+            context, request, None, validators)
+        for validator in validators:
+            validator.updateResponse(context, request, None)
+
+        response = request.response
+        if status is not None:
+            response.setStatus(status)
+            start_response(response.getStatusString(), response.headers)
+            return []
+
+        def conditional_start_response(status, headers, exc_info = None):
+            if status[:1] == "2":
+                names = [name.lower() for name, value in headers]
+                headers = list(headers) + [
+                    (name, value) for name, value in response.headers
+                    if name.lower() not in names]
+            if exc_info is None:
+                return start_response(status, headers)
+            return start_response(status, headers, exc_info)
+
+        return self.application(environ, conditional_start_response)